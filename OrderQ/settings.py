@@ -150,7 +150,7 @@ AUTH_USER_MODEL = 'orders.User'
 # REST Framework settings
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'orders.authentication.ClaimsJWTAuthentication',
     ),
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.IsAuthenticated',
@@ -177,6 +177,7 @@ SIMPLE_JWT = {
     'ALGORITHM': 'HS256',
     'SIGNING_KEY': SECRET_KEY,
     'AUTH_HEADER_TYPES': ('Bearer',),
+    'TOKEN_REFRESH_SERIALIZER': 'orders.authentication.IdentityTokenRefreshSerializer',
 }
 
 # CORS settings
@@ -191,9 +192,22 @@ CORS_ALLOWED_ORIGINS = [
 # CORS settings - Allow all origins
 CORS_ALLOW_CREDENTIALS = True
 
+# Conditional order reads: clients send If-None-Match and read the ETag back
+from corsheaders.defaults import default_headers
+CORS_ALLOW_HEADERS = (*default_headers, 'if-none-match')
+CORS_EXPOSE_HEADERS = ['ETag']
+
 # Frontend URL for share messages
 FRONTEND_URL = os.environ.get('FRONTEND_URL', 'http://localhost:19991')
 
+# Public backend URL, used for absolute media URLs in cached order snapshots
+BACKEND_URL = os.environ.get('BACKEND_URL', 'http://localhost:19992')
+
+# Order change feed (/api/orders/<id>/changes/): clients further behind than this many
+# versions get a full snapshot instead of a delta
+ORDER_CHANGES_MAX_GAP = int(os.environ.get('ORDER_CHANGES_MAX_GAP', 50))
+ORDER_EVENT_LOG_WINDOW = int(os.environ.get('ORDER_EVENT_LOG_WINDOW', 50))  # versions of WebSocket events kept per order for reconnect replay
+
 # Cite API base URL
 CITE_API_BASE_URL = os.environ.get('CITE_API_BASE_URL', '')
 
@@ -206,6 +220,18 @@ CELERY_RESULT_SERIALIZER = 'json'
 CELERY_TIMEZONE = TIME_ZONE
 CELERY_BEAT_SCHEDULER = 'django_celery_beat.schedulers:DatabaseScheduler'
 
+# Cache (shared by all backend processes) - holds serialized order snapshots
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': f"redis://{os.environ.get('REDIS_HOST', 'localhost')}:{os.environ.get('REDIS_PORT', 6379)}/1",
+    }
+}
+
+# Serialized order snapshots (orders/snapshots.py)
+ORDER_SNAPSHOT_TTL = int(os.environ.get('ORDER_SNAPSHOT_TTL', 600))  # seconds in the shared cache
+ORDER_SNAPSHOT_LRU_SIZE = int(os.environ.get('ORDER_SNAPSHOT_LRU_SIZE', 256))  # orders kept per process
+
 # Channels Configuration
 ASGI_APPLICATION = 'OrderQ.asgi.application'
 CHANNEL_LAYERS = {
@@ -216,3 +242,14 @@ CHANNEL_LAYERS = {
         },
     },
 }
+
+# Broadcasts are sent after commit from a background thread (orders/outbox.py); set to send inline instead
+ORDER_BROADCAST_SYNC = os.environ.get('ORDER_BROADCAST_SYNC', 'False') == 'True'
+ORDER_BROADCAST_COALESCE_MS = int(os.environ.get('ORDER_BROADCAST_COALESCE_MS', 150))  # merge broadcasts of one order within this window
+
+# WebSocket auth: cached user principals per process (orders/middleware.py)
+WS_PRINCIPAL_CACHE_TTL = int(os.environ.get('WS_PRINCIPAL_CACHE_TTL', 60))  # seconds
+WS_PRINCIPAL_CACHE_SIZE = int(os.environ.get('WS_PRINCIPAL_CACHE_SIZE', 1024))
+WS_STREAM_MAX_SUBSCRIPTIONS = int(os.environ.get('WS_STREAM_MAX_SUBSCRIPTIONS', 100))  # orders + topics per ws/stream/ socket
+WS_SEND_QUEUE_SIZE = int(os.environ.get('WS_SEND_QUEUE_SIZE', 64))  # unsent frames per socket before it is closed as a slow consumer
+WS_SEND_TIMEOUT = int(os.environ.get('WS_SEND_TIMEOUT', 30))  # seconds the oldest unsent frame may wait
@@ -39,8 +39,12 @@ api.interceptors.response.use(
           refresh: refreshToken,
         })
         
-        const { access } = response.data
+        const { access, refresh } = response.data
         localStorage.setItem('access_token', access)
+        if (refresh) {
+          // Refresh tokens are rotated
+          localStorage.setItem('refresh_token', refresh)
+        }
         
         originalRequest.headers.Authorization = `Bearer ${access}`
         return api(originalRequest)
@@ -0,0 +1,109 @@
+import { defineStore } from 'pinia'
+import { ref } from 'vue'
+import api from '../api'
+
+// What the user owes and is owed - fetched once from /orders/balance/, then kept current
+// by balance_update frames on the personal "balance" stream topic (see orders/balances.py)
+export const useBalanceStore = defineStore('balance', () => {
+  const owedByMe = ref([])
+  const owedToMe = ref([])
+  const totalOwedByMe = ref(0)
+  const totalOwedToMe = ref(0)
+  const version = ref(null)
+  const loading = ref(false)
+  let socket = null
+  let stopped = true
+  const reconnectDelay = 3000
+
+  function getStreamUrl() {
+    const protocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:'
+    const token = localStorage.getItem('access_token')
+    return `${protocol}//${window.location.host}/ws/stream/` + (token ? `?token=${encodeURIComponent(token)}` : '')
+  }
+
+  async function fetchBalance() {
+    loading.value = true
+    try {
+      const response = await api.get('/orders/balance/')
+      if (version.value !== null && response.data.version < version.value) {
+        return  // A newer balance_update already arrived
+      }
+      owedByMe.value = response.data.owed_by_me
+      owedToMe.value = response.data.owed_to_me
+      totalOwedByMe.value = response.data.total_owed_by_me
+      totalOwedToMe.value = response.data.total_owed_to_me
+      version.value = response.data.version
+    } finally {
+      loading.value = false
+    }
+  }
+
+  // A balance_update carries one order's current rows plus the new totals
+  function applyUpdate(update) {
+    if (version.value !== null && update.version <= version.value) {
+      return
+    }
+    owedByMe.value = [...owedByMe.value.filter(row => row.order_id !== update.order_id), ...update.owed_by_me]
+    owedToMe.value = [...owedToMe.value.filter(row => row.order_id !== update.order_id), ...update.owed_to_me]
+    totalOwedByMe.value = update.total_owed_by_me
+    totalOwedToMe.value = update.total_owed_to_me
+    version.value = update.version
+  }
+
+  function connect() {
+    const ws = new WebSocket(getStreamUrl())
+
+    ws.onopen = () => {
+      ws.send(JSON.stringify({ type: 'subscribe', topics: ['balance'] }))
+      // Changes made while disconnected were not pushed - start from a fresh snapshot
+      fetchBalance().catch(error => console.error('Failed to fetch balance:', error))
+    }
+
+    ws.onmessage = (event) => {
+      try {
+        const message = JSON.parse(event.data)
+        if (message.sub === 'balance' && message.data.type === 'balance_update') {
+          applyUpdate(message.data)
+        }
+      } catch (error) {
+        console.error('Error parsing balance message:', error)
+      }
+    }
+
+    ws.onclose = () => {
+      socket = null
+      if (!stopped) {
+        setTimeout(() => {
+          if (!stopped && !socket) connect()
+        }, reconnectDelay)
+      }
+    }
+
+    socket = ws
+  }
+
+  function start() {
+    stopped = false
+    if (!socket) connect()
+  }
+
+  function stop() {
+    stopped = true
+    if (socket) {
+      socket.close(1000, 'Client disconnecting')
+      socket = null
+    }
+  }
+
+  return {
+    owedByMe,
+    owedToMe,
+    totalOwedByMe,
+    totalOwedToMe,
+    version,
+    loading,
+    fetchBalance,
+    start,
+    stop
+  }
+})
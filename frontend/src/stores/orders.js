@@ -12,7 +12,8 @@ export const useOrdersStore = defineStore('orders', () => {
 
   async function fetchOrders(status = null) {
     try {
-      const params = status ? { status } : {}
+      // The list only shows code, restaurant, status and totals - ask for the slim representation
+      const params = status ? { status, view: 'summary' } : { view: 'summary' }
       const response = await api.get('/orders/', { params })
       orders.value = response.data.results || response.data
       return { success: true }
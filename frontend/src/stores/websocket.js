@@ -7,6 +7,8 @@ export const useWebSocketStore = defineStore('websocket', () => {
   const reconnectAttempts = ref(0)
   const maxReconnectAttempts = 5
   const reconnectDelay = 3000
+  // Last order state received - kept across reconnects so only missed events are replayed
+  let currentOrder = null
 
   function getWebSocketUrl(orderId) {
     // Use the same host and protocol as the current page
@@ -17,11 +19,15 @@ export const useWebSocketStore = defineStore('websocket', () => {
     const token = localStorage.getItem('access_token')
     
     // Build WebSocket URL - use same host as current page
-    let wsUrl = `${protocol}//${host}/ws/orders/${orderId}/`
+    // protocol=2: full snapshot on connect, then typed delta events
+    let wsUrl = `${protocol}//${host}/ws/orders/${orderId}/?protocol=2`
+    if (currentOrder && currentOrder.id === orderId) {
+      wsUrl += `&after_seq=${currentOrder.version}`
+    }
     
     // Add token as query parameter for JWT authentication
     if (token) {
-      wsUrl += `?token=${encodeURIComponent(token)}`
+      wsUrl += `&token=${encodeURIComponent(token)}`
     } else {
       console.warn('No access token found for WebSocket authentication')
     }
@@ -29,6 +35,42 @@ export const useWebSocketStore = defineStore('websocket', () => {
     return wsUrl
   }
 
+  function upsertRow(rows, row, prepend) {
+    const index = rows.findIndex(r => r.id === row.id)
+    if (index === -1) {
+      return prepend ? [row, ...rows] : [...rows, row]
+    }
+    return rows.map(r => (r.id === row.id ? row : r))
+  }
+
+  // Apply protocol 2 events (see orders/deltas.py) to the last known order
+  function applyOrderEvents(order, events) {
+    let updated = { ...order }
+    for (const event of events) {
+      switch (event.type) {
+        case 'item_added':
+        case 'item_updated':
+          updated.items = upsertRow(updated.items || [], event.item, true)
+          break
+        case 'item_removed':
+          updated.items = (updated.items || []).filter(item => item.id !== event.item_id)
+          break
+        case 'payment_updated':
+          updated.payments = upsertRow(updated.payments || [], event.payment, false)
+          break
+        case 'payment_removed':
+          updated.payments = (updated.payments || []).filter(payment => payment.id !== event.payment_id)
+          break
+        case 'status_changed':
+        case 'fees_updated':
+        case 'order_updated':
+          updated = { ...updated, ...event.fields }
+          break
+      }
+    }
+    return updated
+  }
+
   function connect(orderId, onMessage) {
     if (socket.value && socket.value.readyState === WebSocket.OPEN) {
       // Already connected to this order
@@ -55,7 +97,16 @@ export const useWebSocketStore = defineStore('websocket', () => {
         try {
           const data = JSON.parse(event.data)
           if (data.type === 'order_update' && data.order) {
+            currentOrder = data.order
             onMessage(data.order)
+          } else if (data.type === 'order_delta') {
+            if (!currentOrder || currentOrder.version !== data.from_version) {
+              // Missed an update - ask for the full order
+              ws.send(JSON.stringify({ type: 'snapshot' }))
+              return
+            }
+            currentOrder = { ...applyOrderEvents(currentOrder, data.events), version: data.version }
+            onMessage(currentOrder)
           } else if (data.type === 'pong') {
             // Heartbeat response
           }
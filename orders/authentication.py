@@ -0,0 +1,126 @@
+"""
+JWT authentication without a user row load per request.
+
+Access tokens carry the user's username, role and auth_version as claims. REST requests
+get a lazy User built from those claims - any other field is loaded from the database
+only when a view reads it. Tokens go stale when the user's auth_version moves on (role,
+username or active-state change): the request is rejected with 401 and the client
+refreshes, which re-reads the claims from the database.
+"""
+import logging
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.utils.translation import gettext_lazy as _
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+from rest_framework_simplejwt.serializers import TokenRefreshSerializer
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import RefreshToken
+
+logger = logging.getLogger(__name__)
+
+User = get_user_model()
+
+PRINCIPAL_FIELDS = ['id', 'username', 'role', 'is_active']
+
+
+def build_principal(values):
+    """
+    User instance holding only the principal fields - other fields are deferred and
+    loaded on first access. Usable in ORM filters like a fetched user.
+    """
+    # from_db() takes the values in model field order
+    field_names = [f.attname for f in User._meta.concrete_fields if f.attname in PRINCIPAL_FIELDS]
+    return User.from_db('default', field_names, [values[name] for name in field_names])
+
+
+def auth_state_cache_key(user_id):
+    return f'user-auth-state:{user_id}'
+
+
+def store_auth_state(user):
+    """Publish the user's current (auth_version, is_active) for token checks"""
+    try:
+        cache.set(auth_state_cache_key(user.pk), (user.auth_version, user.is_active), settings.SIMPLE_JWT['ACCESS_TOKEN_LIFETIME'].total_seconds())
+    except Exception as e:
+        logger.warning(f"Auth state cache unavailable: {e}")
+
+
+def clear_auth_state(user_id):
+    """Drop a user's published auth state, so token checks fall back to the database"""
+    try:
+        cache.delete(auth_state_cache_key(user_id))
+    except Exception as e:
+        logger.warning(f"Auth state cache unavailable: {e}")
+
+
+def get_auth_state(user_id):
+    """(auth_version, is_active) of a user from the shared cache, else the database; None if no such user"""
+    try:
+        state = cache.get(auth_state_cache_key(user_id))
+    except Exception as e:
+        logger.warning(f"Auth state cache unavailable: {e}")
+        state = None
+    if state is None:
+        user = User.objects.filter(pk=user_id).only('auth_version', 'is_active').first()
+        if user is None:
+            return None
+        store_auth_state(user)
+        state = (user.auth_version, user.is_active)
+    return state
+
+
+class IdentityRefreshToken(RefreshToken):
+    """Refresh token whose access tokens carry username, role and auth_version claims"""
+
+    @classmethod
+    def for_user(cls, user):
+        token = super().for_user(user)
+        add_identity_claims(token, user)
+        return token
+
+
+def add_identity_claims(token, user):
+    token['username'] = user.username
+    token['role'] = user.role
+    token['auth_version'] = user.auth_version
+
+
+class IdentityTokenRefreshSerializer(TokenRefreshSerializer):
+    """Refresh that re-reads the identity claims, so a role change takes effect on the next refresh"""
+    token_class = IdentityRefreshToken
+
+    def validate(self, attrs):
+        refresh = self.token_class(attrs['refresh'])
+        user = User.objects.filter(**{api_settings.USER_ID_FIELD: refresh[api_settings.USER_ID_CLAIM]}).first()
+        if user is None or not user.is_active:
+            raise AuthenticationFailed(_("User is inactive or deleted"), code='user_inactive')
+        add_identity_claims(refresh, user)
+        return super().validate({**attrs, 'refresh': str(refresh)})
+
+
+class ClaimsJWTAuthentication(JWTAuthentication):
+    """JWTAuthentication that builds request.user from the token's identity claims"""
+
+    def get_user(self, validated_token):
+        if 'auth_version' not in validated_token:
+            # Issued before identity claims were added - load the user as before
+            return super().get_user(validated_token)
+
+        user_id = validated_token[api_settings.USER_ID_CLAIM]
+        state = get_auth_state(user_id)
+        if state is None:
+            raise AuthenticationFailed(_("User not found"), code='user_not_found')
+        auth_version, is_active = state
+        if not is_active:
+            raise AuthenticationFailed(_("User is inactive"), code='user_inactive')
+        if auth_version != validated_token['auth_version']:
+            raise InvalidToken(_("Token claims are out of date"))
+
+        return build_principal({
+            'id': user_id,
+            'username': validated_token['username'],
+            'role': validated_token['role'],
+            'is_active': True,
+        })
@@ -0,0 +1,146 @@
+"""
+Per-user payment balances: what a user owes and what they are owed.
+
+Every user has a balance_version, bumped in the same transaction as any change to the
+payments they pay or collect (payments calculated on lock, deleted on unlock or with the
+order, marked paid, or written through the payments API).
+GET /api/orders/balance/ returns the snapshot at that version; after each change the
+affected users' personal groups get a balance_update frame carrying that order's rows
+and the new totals, so clients never need to poll.
+"""
+from django.db.models import F, Q, Sum
+from .models import CollectionOrder, OrderItem, Payment, User
+
+# Orders whose unpaid payments count towards balances
+BALANCE_STATUSES = ['LOCKED', 'ORDERED', 'CLOSED']
+
+
+def balance_users_q(order_id, collector_id):
+    """Users whose balance an order's payments touch: collector, participants and payers"""
+    return (
+        Q(pk=collector_id) |
+        Q(pk__in=OrderItem.objects.filter(order_id=order_id).values('user')) |
+        Q(pk__in=Payment.objects.filter(order_id=order_id).values('user'))
+    )
+
+
+def balance_user_ids(order):
+    """
+    Ids of the users the order's payments touch - read them before deleting payments
+    (or the order), since balance_users_q looks them up through the payments
+    """
+    return list(User.objects.filter(balance_users_q(order.pk, order.collector_id)).values_list('id', flat=True))
+
+
+def bump_balance_versions(order, user_ids=()):
+    """
+    Increment balance_version of every user the order's payments touch, plus `user_ids`
+    (users a change just removed from them), in one UPDATE
+    """
+    User.objects.filter(balance_users_q(order.pk, order.collector_id) | Q(pk__in=user_ids)).update(
+        balance_version=F('balance_version') + 1
+    )
+
+
+def owed_by_row(payment):
+    return {
+        'order_id': payment.order.id,
+        'order_code': payment.order.code,
+        'restaurant_name': payment.order.restaurant.name,
+        'collector_name': payment.order.collector.username,
+        'amount': float(payment.amount),
+        'payment_id': payment.id,
+        'order_status': payment.order.status,
+        'payment_type': 'owed_by_me',  # User owes this payment
+    }
+
+
+def owed_to_row(payment):
+    return {
+        'order_id': payment.order.id,
+        'order_code': payment.order.code,
+        'restaurant_name': payment.order.restaurant.name,
+        'payer_name': payment.user.username,
+        'amount': float(payment.amount),
+        'payment_id': payment.id,
+        'order_status': payment.order.status,
+        'payment_type': 'owed_to_me',  # Others owe this to user
+    }
+
+
+def unpaid_payments():
+    return Payment.objects.filter(is_paid=False, order__status__in=BALANCE_STATUSES)
+
+
+def payments_owed_by(user):
+    """Rows of the unpaid payments a user owes to other collectors"""
+    payments = unpaid_payments().filter(user=user).exclude(
+        order__collector=F('user')
+    ).select_related('order', 'order__restaurant', 'order__collector')
+    return [owed_by_row(payment) for payment in payments]
+
+
+def payments_owed_to(user):
+    """Rows of the unpaid payments others owe to a user as collector"""
+    payments = unpaid_payments().filter(order__collector=user).exclude(
+        user=user
+    ).select_related('order', 'order__restaurant', 'user')
+    return [owed_to_row(payment) for payment in payments]
+
+
+def balance_snapshot(user):
+    """Current balance of a user: {version, owed_by_me, owed_to_me, total_owed_by_me, total_owed_to_me}"""
+    # Version first - a change racing this read is followed by a newer balance_update
+    version = User.objects.values_list('balance_version', flat=True).get(pk=user.pk)
+    owed_by_me = payments_owed_by(user)
+    owed_to_me = payments_owed_to(user)
+    return {
+        'version': version,
+        'owed_by_me': owed_by_me,
+        'owed_to_me': owed_to_me,
+        'total_owed_by_me': sum(row['amount'] for row in owed_by_me),
+        'total_owed_to_me': sum(row['amount'] for row in owed_to_me),
+    }
+
+
+def balance_deltas(order_id, user_ids=()):
+    """
+    User id -> balance_update payload for each user the order's payments touch, plus
+    `user_ids` (users a change just removed from them): that order's current rows for
+    the user plus their new totals. Once the order is deleted, `user_ids` get empty rows.
+    A fixed number of queries, however many participants the order has.
+    """
+    order = CollectionOrder.objects.select_related('restaurant', 'collector').filter(pk=order_id).first()
+    users_q = Q(pk__in=user_ids)
+    if order is not None:
+        users_q |= balance_users_q(order.pk, order.collector_id)
+    versions = dict(User.objects.filter(users_q).values_list('id', 'balance_version'))
+    if not versions:
+        return {}
+
+    payments = []
+    if order is not None and order.status in BALANCE_STATUSES:
+        payments = list(Payment.objects.filter(order=order, is_paid=False).exclude(user_id=order.collector_id).select_related('user'))
+    for payment in payments:
+        payment.order = order
+
+    owed_by_totals = dict(
+        unpaid_payments().filter(user_id__in=versions).exclude(order__collector=F('user'))
+        .values('user').annotate(total=Sum('amount')).values_list('user', 'total')
+    )
+    owed_to_totals = dict(
+        unpaid_payments().filter(order__collector_id__in=versions).exclude(order__collector=F('user'))
+        .values('order__collector').annotate(total=Sum('amount')).values_list('order__collector', 'total')
+    )
+
+    deltas = {}
+    for user_id, version in versions.items():
+        deltas[user_id] = {
+            'version': version,
+            'order_id': order_id,
+            'owed_by_me': [owed_by_row(payment) for payment in payments if payment.user_id == user_id],
+            'owed_to_me': [owed_to_row(payment) for payment in payments] if order is not None and user_id == order.collector_id else [],
+            'total_owed_by_me': float(owed_by_totals.get(user_id, 0)),
+            'total_owed_to_me': float(owed_to_totals.get(user_id, 0)),
+        }
+    return deltas
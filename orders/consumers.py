@@ -1,39 +1,125 @@
+import asyncio
+import itertools
 import json
+import time
+from collections import OrderedDict
+from django.conf import settings
+from urllib.parse import parse_qs
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
 from django.contrib.auth import get_user_model
-from .models import CollectionOrder
-from .serializers import CollectionOrderSerializer
+from .models import CollectionOrder, OrderEventLog
+from .frames import delta_frame, order_frames, select_order_frame
+from .metrics import metrics
+from .snapshots import get_order_snapshot
+from .websocket_utils import notification_groups, user_group
 
 User = get_user_model()
 
 
-class NotificationsConsumer(AsyncWebsocketConsumer):
+class BoundedSendMixin:
     """
-    General notifications consumer for broadcasting new orders and other events
-    to all authenticated users
+    Bounded per-connection outbound queue, drained by a sender task so a client on a slow
+    link never blocks the consumer's channel-layer handling or grows memory without bound.
+    
+    A frame queued under a `key` (e.g. one order's state) replaces a still-unsent frame with
+    the same key - later full-state updates supersede earlier ones. A connection whose queue
+    reaches WS_SEND_QUEUE_SIZE frames, or whose oldest unsent frame has waited longer than
+    WS_SEND_TIMEOUT seconds, is closed with SLOW_CONSUMER_CLOSE_CODE; clients reconnect and
+    resume from the last version they have.
+    """
+    SLOW_CONSUMER_CLOSE_CODE = 4008
+    
+    def start_send_queue(self):
+        self._send_queue = OrderedDict()  # key -> (frame text, time queued)
+        self._send_ready = asyncio.Event()
+        self._send_keys = itertools.count()
+        self._sender = asyncio.create_task(self._drain_send_queue())
+    
+    def stop_send_queue(self):
+        sender = getattr(self, '_sender', None)
+        if sender is None:
+            return
+        sender.cancel()
+        self._sender = None
+        metrics.incr('ws_send_queue_depth', -len(self._send_queue))
+        self._send_queue.clear()
+    
+    async def send(self, text_data=None, bytes_data=None, close=False):
+        if getattr(self, '_sender', None) is None or text_data is None or close:
+            await super().send(text_data=text_data, bytes_data=bytes_data, close=close)
+        else:
+            await self.queue_send(text_data)
+    
+    async def queue_send(self, text, key=None, superseding_text=None):
+        """
+        Queue a frame for sending. If a frame with the same key is still queued, it is
+        replaced in place by `superseding_text` (default `text`) instead.
+        """
+        if getattr(self, '_sender', None) is None:
+            return  # Connection closed
+        queue = self._send_queue
+        if key is not None and key in queue:
+            queue[key] = (superseding_text or text, queue[key][1])
+            metrics.incr('ws_frames_superseded')
+            return
+        if queue and (
+            len(queue) >= getattr(settings, 'WS_SEND_QUEUE_SIZE', 64) or
+            time.monotonic() - next(iter(queue.values()))[1] > getattr(settings, 'WS_SEND_TIMEOUT', 30)
+        ):
+            metrics.incr('ws_slow_consumers_closed')
+            self.stop_send_queue()
+            await self.close(code=self.SLOW_CONSUMER_CLOSE_CODE)
+            return
+        queue[key if key is not None else next(self._send_keys)] = (text, time.monotonic())
+        metrics.incr('ws_send_queue_depth')
+        metrics.set_max('ws_send_queue_depth_max', len(queue))
+        self._send_ready.set()
+    
+    async def _drain_send_queue(self):
+        while True:
+            await self._send_ready.wait()
+            self._send_ready.clear()
+            while self._send_queue:
+                _, (text, _) = self._send_queue.popitem(last=False)
+                metrics.incr('ws_send_queue_depth', -1)
+                await super().send(text_data=text)
+
+
+class NotificationsConsumer(BoundedSendMixin, AsyncWebsocketConsumer):
+    """
+    Notifications consumer for new orders. Each user only hears about orders they can see:
+    the socket joins the user's own group, the public-orders group and, for managers and
+    admins, the staff group (see websocket_utils.notification_groups). The user's own group
+    also carries their balance_update frames (see orders/balances.py).
     """
     async def connect(self):
+        self.group_names = []
+        
         # Verify user is authenticated
         if not self.scope['user'].is_authenticated:
             await self.close()
             return
         
-        # Join the general notifications group
-        self.group_name = 'notifications'
-        await self.channel_layer.group_add(
-            self.group_name,
-            self.channel_name
-        )
+        # Join the user's notification groups
+        self.group_names = notification_groups(self.scope['user'])
+        for group_name in self.group_names:
+            await self.channel_layer.group_add(
+                group_name,
+                self.channel_name
+            )
         
         await self.accept()
+        self.start_send_queue()
     
     async def disconnect(self, close_code):
-        # Leave notifications group
-        await self.channel_layer.group_discard(
-            self.group_name,
-            self.channel_name
-        )
+        self.stop_send_queue()
+        # Leave notification groups
+        for group_name in self.group_names:
+            await self.channel_layer.group_discard(
+                group_name,
+                self.channel_name
+            )
     
     # Receive message from WebSocket
     async def receive(self, text_data):
@@ -45,33 +131,54 @@ class NotificationsConsumer(AsyncWebsocketConsumer):
     
     # Receive message from room group
     async def new_order(self, event):
-        """Handle new_order event from channel layer"""
-        await self.send(text_data=json.dumps({
-            'type': 'new_order',
-            'order': event['order']
-        }))
+        """Handle new_order claim check from channel layer"""
+        frames = await order_frames.get(event['order_id'], event['version'])
+        if frames:
+            await self.queue_send(frames['new_order'], key=('new_order', event['order_id']))
     
     async def order_update(self, event):
-        """Handle order_update event (for general notifications)"""
-        await self.send(text_data=json.dumps({
-            'type': 'order_update',
-            'order': event['order']
-        }))
+        """Handle order_update claim check (for general notifications)"""
+        frames = await order_frames.get(event['order_id'], event['version'])
+        if frames:
+            await self.queue_send(frames['order_update'], key=('order', event['order_id']))
+    
+    async def balance_update(self, event):
+        """Forward the user's balance_update frame - a newer one for the same order supersedes it"""
+        await self.queue_send(event['frame'], key=('balance', event['order_id']))
 
 
-class OrderConsumer(AsyncWebsocketConsumer):
+class OrderConsumer(BoundedSendMixin, AsyncWebsocketConsumer):
+    """
+    Live updates for one order room.
+    
+    Protocol 1 (default): every change is pushed as a full `order_update` snapshot.
+    Protocol 2 (`?protocol=2`): after the initial snapshot, changes arrive as `order_delta`
+    frames with typed events (see orders/deltas.py) and the new version. When the server
+    can't build a delta from the client's version it sends a full `order_update` instead;
+    clients can also ask for one at any time with {"type": "snapshot"}.
+    
+    Protocol 2 clients reconnecting with `?after_seq=<version they have>` get only the
+    order_delta frames they missed, replayed from the order's event log, or nothing if they
+    are current. When the log no longer covers the gap they get a full snapshot instead.
+    
+    While the order is open, every update is followed by an `order_shares` frame with what
+    each participant would currently pay (see orders/shares.py).
+    """
     async def connect(self):
         self.order_id = self.scope['url_route']['kwargs']['order_id']
         self.room_group_name = f'order_{self.order_id}'
+        self.protocol = self.get_protocol()
+        self.version = None  # Last order version sent to this client
         
         # Verify user is authenticated
         if not self.scope['user'].is_authenticated:
             await self.close()
             return
         
-        # Verify user has access to this order
-        has_access = await self.check_order_access(self.order_id, self.scope['user'])
-        if not has_access:
+        # Verify user has access to this order and fetch its current state in one hop
+        after_seq = self.get_after_seq() if self.protocol >= 2 else None
+        result = await self.get_connect_frames(self.order_id, self.scope['user'], after_seq)
+        if result is None:
             await self.close()
             return
         
@@ -82,16 +189,15 @@ class OrderConsumer(AsyncWebsocketConsumer):
         )
         
         await self.accept()
+        self.start_send_queue()
         
-        # Send current order state
-        order_data = await self.get_order_data(self.order_id)
-        if order_data:
-            await self.send(text_data=json.dumps({
-                'type': 'order_update',
-                'order': order_data
-            }))
+        # Send current order state (or what the client missed)
+        self.version, frames = result
+        for frame in frames:
+            await self.send(text_data=frame)
     
     async def disconnect(self, close_code):
+        self.stop_send_queue()
         # Leave room group
         await self.channel_layer.group_discard(
             self.room_group_name,
@@ -105,54 +211,237 @@ class OrderConsumer(AsyncWebsocketConsumer):
         
         if message_type == 'ping':
             await self.send(text_data=json.dumps({'type': 'pong'}))
+        elif message_type == 'snapshot':
+            # Client detected a version gap - resend the full order
+            order_data = await self.get_order_data(self.order_id)
+            if order_data:
+                await self.send_snapshot(order_data)
     
-    # Receive message from room group
+    # Receive claim check from room group - the frames are resolved once per version per process
     async def order_update(self, event):
-        # Send message to WebSocket
-        await self.send(text_data=json.dumps({
+        if self.protocol >= 2 and self.version is not None and event['version'] <= self.version:
+            return  # Client already has this version
+        frames = await order_frames.get(event['order_id'], event['version'])
+        if not frames:
+            return  # Order was deleted
+        if self.protocol < 2:
+            await self.queue_send(frames['order_update'], key='order')
+        else:
+            frame = select_order_frame(frames, self.version)
+            self.version = frames['version']
+            # An unsent earlier frame is replaced by the full order - a delta could no longer apply
+            await self.queue_send(frame, key='order', superseding_text=frames['order_update'])
+        if frames['order_shares']:
+            await self.queue_send(frames['order_shares'], key='shares')
+    
+    async def send_snapshot(self, order_data):
+        self.version = order_data['version']
+        await self.queue_send(json.dumps({
             'type': 'order_update',
-            'order': event['order']
-        }))
+            'order': order_data
+        }), key='order')
     
-    @database_sync_to_async
-    def check_order_access(self, order_id, user):
-        """Check if user has access to this order"""
+    def get_protocol(self):
+        query_params = parse_qs(self.scope.get('query_string', b'').decode())
         try:
-            order = CollectionOrder.objects.get(id=order_id)
-            # Allow if:
-            # - User is manager or admin
-            # - User is collector
-            # - Order is not private
-            # - User is assigned to the order
-            # - User has items in the order
-            if user.role in ['manager', 'admin']:
-                return True
-            if order.collector == user:
-                return True
-            if not order.is_private:
-                return True
-            if order.assigned_users.filter(id=user.id).exists():
-                return True
-            if order.items.filter(user=user).exists():
-                return True
-            return False
-        except CollectionOrder.DoesNotExist:
-            return False
+            return int(query_params.get('protocol', ['1'])[0])
+        except ValueError:
+            return 1
     
-    @database_sync_to_async
-    def get_order_data(self, order_id):
-        """Get serialized order data"""
+    def get_after_seq(self):
+        query_params = parse_qs(self.scope.get('query_string', b'').decode())
         try:
-            from django.db.models import Prefetch
-            from .models import OrderItem, Payment
-            
-            order = CollectionOrder.objects.prefetch_related(
-                Prefetch('items', queryset=OrderItem.objects.select_related('user', 'menu_item').order_by('-created_at')),
-                Prefetch('payments', queryset=Payment.objects.select_related('user').order_by('-created_at')),
-                'assigned_users'
-            ).select_related('restaurant', 'menu', 'collector').get(id=order_id)
-            serializer = CollectionOrderSerializer(order)
-            return serializer.data
-        except CollectionOrder.DoesNotExist:
+            return int(query_params['after_seq'][0])
+        except (KeyError, ValueError):
+            return None
+    
+    @database_sync_to_async
+    def get_connect_frames(self, order_id, user, after_seq=None):
+        """
+        (version, frames to send) on connect if the user has access to the order, else None.
+        Frames are the events logged after `after_seq` when they cover the gap, else the full order.
+        """
+        # Same visibility rule as the REST API: managers/admins, the collector, public orders,
+        # assigned users and participants. One query checks access and reads the version the
+        # snapshot is looked up by, so a cached snapshot costs nothing more.
+        version = CollectionOrder.objects.visible_to(user).filter(id=order_id).values_list('version', flat=True).first()
+        if version is None:
             return None
+        if after_seq is not None and 0 <= after_seq <= version:
+            entries = OrderEventLog.replay(order_id, after_seq, version)
+            if entries is not None:
+                return version, [delta_frame(*entry) for entry in entries]
+        order_data = get_order_snapshot(order_id, version)
+        if order_data is None:
+            return None
+        return order_data['version'], [json.dumps({'type': 'order_update', 'order': order_data})]
+    
+    @database_sync_to_async
+    def get_order_data(self, order_id):
+        """Get serialized order data (shared snapshot of the current version)"""
+        return get_order_snapshot(order_id)
+
 
+class StreamConsumer(BoundedSendMixin, AsyncWebsocketConsumer):
+    """
+    One socket for many subscriptions (ws/stream/).
+    
+    Client messages:
+        {"type": "subscribe", "orders": [ids], "topics": ["notifications", "balance"]}
+        {"type": "unsubscribe", "orders": [ids], "topics": [...]}
+        {"type": "snapshot", "order": id}     full order for a subscribed order
+        {"type": "ping"}
+    Access to all requested orders is checked in one query; the reply is a `subscribed` frame
+    listing the granted and denied ids. Every event is then wrapped as
+    {"sub": "order:<id>" | "<topic>", "seq": n, "data": <frame>}, where seq counts the
+    frames sent on that subscription - a gap means queued frames were superseded by the full
+    state that follows (see BoundedSendMixin). Order subscriptions follow protocol 2: a full
+    order_update first, then order_delta frames (see OrderConsumer). The balance topic carries
+    the user's balance_update frames (see orders/balances.py).
+    """
+    TOPICS = ['notifications', 'balance']
+    
+    async def connect(self):
+        if not self.scope['user'].is_authenticated:
+            await self.close()
+            return
+        
+        self.orders = {}  # Subscribed order id -> last version sent
+        self.topics = set()
+        self.seqs = {}  # Subscription -> last sequence number sent
+        await self.accept()
+        self.start_send_queue()
+    
+    async def disconnect(self, close_code):
+        self.stop_send_queue()
+        for order_id in getattr(self, 'orders', {}):
+            await self.channel_layer.group_discard(f'order_{order_id}', self.channel_name)
+        for group_name in self.joined_topic_groups():
+            await self.channel_layer.group_discard(group_name, self.channel_name)
+    
+    async def receive(self, text_data):
+        text_data_json = json.loads(text_data)
+        message_type = text_data_json.get('type')
+        
+        if message_type == 'ping':
+            await self.send(text_data=json.dumps({'type': 'pong'}))
+        elif message_type == 'subscribe':
+            await self.subscribe(self.parse_order_ids(text_data_json.get('orders')), text_data_json.get('topics') or [])
+        elif message_type == 'unsubscribe':
+            await self.unsubscribe(self.parse_order_ids(text_data_json.get('orders')), text_data_json.get('topics') or [])
+        elif message_type == 'snapshot':
+            order_id = self.parse_order_ids([text_data_json.get('order')])
+            if order_id and order_id[0] in self.orders:
+                self.orders[order_id[0]] = None
+                version = await self.get_order_version(order_id[0])
+                if version is not None:
+                    await self.order_update({'order_id': order_id[0], 'version': version})
+    
+    async def subscribe(self, order_ids, topics):
+        order_ids = [order_id for order_id in order_ids if order_id not in self.orders]
+        topics = [topic for topic in topics if topic in self.TOPICS and topic not in self.topics]
+        available = getattr(settings, 'WS_STREAM_MAX_SUBSCRIPTIONS', 100) - len(self.orders) - len(self.topics)
+        topics = topics[:max(available, 0)]
+        order_ids = order_ids[:max(available - len(topics), 0)]
+        
+        versions = await self.get_accessible_versions(order_ids, self.scope['user']) if order_ids else {}
+        for order_id in versions:
+            await self.channel_layer.group_add(f'order_{order_id}', self.channel_name)
+            self.orders[order_id] = None
+            self.seqs.pop(f'order:{order_id}', None)
+        for topic in topics:
+            for group_name in self.topic_groups(topic):
+                await self.channel_layer.group_add(group_name, self.channel_name)
+            self.topics.add(topic)
+            self.seqs.pop(topic, None)
+        
+        await self.send(text_data=json.dumps({
+            'type': 'subscribed',
+            'orders': sorted(versions),
+            'denied': sorted(set(order_ids) - set(versions)),
+            'topics': topics
+        }))
+        # Current state of every newly subscribed order
+        for order_id, version in versions.items():
+            await self.order_update({'order_id': order_id, 'version': version})
+    
+    async def unsubscribe(self, order_ids, topics):
+        for order_id in order_ids:
+            if order_id in self.orders:
+                del self.orders[order_id]
+                await self.channel_layer.group_discard(f'order_{order_id}', self.channel_name)
+        joined = self.joined_topic_groups()
+        self.topics -= set(topics)
+        # Topics share the user's own group - only leave groups no remaining topic needs
+        for group_name in joined - self.joined_topic_groups():
+            await self.channel_layer.group_discard(group_name, self.channel_name)
+        await self.send(text_data=json.dumps({
+            'type': 'unsubscribed',
+            'orders': order_ids,
+            'topics': topics
+        }))
+    
+    async def send_subscription_frame(self, subscription, frame, key=None, superseding_frame=None):
+        seq = self.seqs.get(subscription, 0) + 1
+        self.seqs[subscription] = seq
+        wrap = lambda data: f'{{"sub": {json.dumps(subscription)}, "seq": {seq}, "data": {data}}}'
+        await self.queue_send(wrap(frame), key=key, superseding_text=wrap(superseding_frame) if superseding_frame else None)
+    
+    # Receive claim checks from the subscribed groups
+    async def order_update(self, event):
+        order_id = event['order_id']
+        if order_id not in self.orders:
+            return  # Unsubscribed while the event was in flight
+        client_version = self.orders[order_id]
+        if client_version is not None and event['version'] <= client_version:
+            return
+        frames = await order_frames.get(order_id, event['version'])
+        if not frames or order_id not in self.orders:
+            return
+        frame = select_order_frame(frames, client_version)
+        self.orders[order_id] = frames['version']
+        await self.send_subscription_frame(
+            f'order:{order_id}', frame, key=('order', order_id), superseding_frame=frames['order_update']
+        )
+        if frames['order_shares']:
+            await self.send_subscription_frame(f'order:{order_id}', frames['order_shares'], key=('shares', order_id))
+    
+    async def new_order(self, event):
+        if 'notifications' not in self.topics:
+            return
+        frames = await order_frames.get(event['order_id'], event['version'])
+        if frames:
+            await self.send_subscription_frame('notifications', frames['new_order'], key=('new_order', event['order_id']))
+    
+    async def balance_update(self, event):
+        if 'balance' not in self.topics:
+            return
+        await self.send_subscription_frame('balance', event['frame'], key=('balance', event['order_id']))
+    
+    def topic_groups(self, topic):
+        if topic == 'balance':
+            return [user_group(self.scope['user'].pk)]
+        # 'notifications': new orders this user can see
+        return notification_groups(self.scope['user'])
+    
+    def joined_topic_groups(self):
+        return {group_name for topic in getattr(self, 'topics', set()) for group_name in self.topic_groups(topic)}
+    
+    @staticmethod
+    def parse_order_ids(values):
+        order_ids = []
+        for value in values or []:
+            try:
+                order_ids.append(int(value))
+            except (TypeError, ValueError):
+                continue
+        return list(dict.fromkeys(order_ids))
+    
+    @database_sync_to_async
+    def get_accessible_versions(self, order_ids, user):
+        """Order id -> current version for the requested orders the user has access to (one query)"""
+        return dict(CollectionOrder.objects.visible_to(user).filter(id__in=order_ids).values_list('id', 'version'))
+    
+    @database_sync_to_async
+    def get_order_version(self, order_id):
+        return CollectionOrder.objects.filter(id=order_id).values_list('version', flat=True).first()
@@ -0,0 +1,58 @@
+"""
+Typed change events between two snapshots of an order (WebSocket protocol 2).
+
+Each event carries only what changed:
+    item_added / item_updated      {'item': row}
+    item_removed                   {'item_id': id}
+    payment_updated                {'payment': row}
+    payment_removed                {'payment_id': id}
+    status_changed                 {'status': status, 'fields': {status, locked_at, ...}}
+    fees_updated                   {'fields': {delivery_fee, tip, ...}}
+    order_updated                  {'fields': {any other changed top-level field}}
+Applying the events in order to the old snapshot yields the new one.
+"""
+
+ROW_FIELDS = ('items', 'payments')
+STATUS_FIELDS = ('status', 'locked_at', 'ordered_at', 'closed_at')
+FEE_FIELDS = ('delivery_fee', 'tip', 'service_fee', 'fee_split_rule', 'fee_split_custom')
+
+
+def diff_rows(old_rows, new_rows):
+    """(added, updated, removed ids) between two lists of serialized rows keyed by id"""
+    old_by_id = {row['id']: row for row in old_rows}
+    new_ids = {row['id'] for row in new_rows}
+    added = [row for row in new_rows if row['id'] not in old_by_id]
+    updated = [row for row in new_rows if row['id'] in old_by_id and old_by_id[row['id']] != row]
+    removed = [row_id for row_id in old_by_id if row_id not in new_ids]
+    return added, updated, removed
+
+
+def order_events(old, new):
+    """Events that turn snapshot `old` into snapshot `new`"""
+    events = []
+
+    added, updated, removed = diff_rows(old.get('items', []), new.get('items', []))
+    events += [{'type': 'item_added', 'item': row} for row in added]
+    events += [{'type': 'item_updated', 'item': row} for row in updated]
+    events += [{'type': 'item_removed', 'item_id': row_id} for row_id in removed]
+
+    added, updated, removed = diff_rows(old.get('payments', []), new.get('payments', []))
+    events += [{'type': 'payment_updated', 'payment': row} for row in added + updated]
+    events += [{'type': 'payment_removed', 'payment_id': row_id} for row_id in removed]
+
+    changed = {
+        key: value for key, value in new.items()
+        if key not in ROW_FIELDS and key != 'version' and old.get(key) != value
+    }
+    if 'status' in changed:
+        events.append({
+            'type': 'status_changed',
+            'status': changed['status'],
+            'fields': {key: changed.pop(key) for key in STATUS_FIELDS if key in changed},
+        })
+    fees = {key: changed.pop(key) for key in FEE_FIELDS if key in changed}
+    if fees:
+        events.append({'type': 'fees_updated', 'fields': fees})
+    if changed:
+        events.append({'type': 'order_updated', 'fields': changed})
+    return events
@@ -0,0 +1,181 @@
+"""
+Fee split engine.
+
+Pure functions from per-user item totals and an order's fees to exact two-decimal
+amounts. Each rule turns the fees into weights (or fixed amounts) per participant;
+fees are then allocated in whole cents with the largest-remainder method, so the
+shares always sum back to the fee total. New rules are added to SPLIT_RULES.
+
+Custom splits read CollectionOrder.fee_split_custom:
+    {"fixed": {"<user id>": "20.00", ...}, "weights": {"<user id>": 2, ...}}
+Fixed amounts are taken out of the fees first; the rest is split by weight
+(equally among participants without a fixed amount when no weights are given).
+Negative fees (discounts) can only be split by weight.
+"""
+from decimal import Decimal, InvalidOperation
+from fractions import Fraction
+from math import lcm
+
+CENT = Decimal('0.01')
+
+
+class FeeSplitError(ValueError):
+    """Fees can't be split as configured (e.g. fixed amounts exceed the fees)"""
+
+
+def to_cents(amount):
+    """Whole cents of a money amount"""
+    try:
+        value = Decimal(str(amount))
+    except InvalidOperation:
+        raise FeeSplitError(f"Invalid amount: {amount!r}")
+    if not value.is_finite():
+        raise FeeSplitError(f"Invalid amount: {amount!r}")
+    return int(value.quantize(CENT) * 100)
+
+
+def from_cents(cents):
+    return (Decimal(cents) / 100).quantize(CENT)
+
+
+def integer_weights(weights):
+    """The weights scaled to integers with the same ratios"""
+    fractions = [weight if isinstance(weight, int) else Fraction(weight) for weight in weights]
+    denominator = lcm(*(weight.denominator for weight in fractions))
+    return [int(weight * denominator) for weight in fractions]
+
+
+def allocate(total_cents, weights):
+    """
+    Split `total_cents` over the keys of `weights` in proportion to their weights,
+    in whole cents summing exactly to the total. Cents left after flooring go to the
+    largest remainders, ties to the earlier key.
+    """
+    scaled = integer_weights(weights.values())
+    total_weight = sum(scaled)
+    if total_weight <= 0:
+        raise FeeSplitError("Nothing to split the fees over")
+    sign = -1 if total_cents < 0 else 1
+    total_cents = abs(total_cents)
+
+    shares = {}
+    remainders = []
+    for index, (key, weight) in enumerate(zip(weights, scaled)):
+        shares[key], remainder = divmod(total_cents * weight, total_weight)
+        remainders.append((-remainder, index, key))
+    residue = total_cents - sum(shares.values())
+    for _, _, key in sorted(remainders)[:residue]:
+        shares[key] += 1
+    return {key: sign * cents for key, cents in shares.items()}
+
+
+def split_equal(items_totals, fee_cents, collector_id, custom):
+    return allocate(fee_cents, {user_id: 1 for user_id in items_totals})
+
+
+def split_proportional(items_totals, fee_cents, collector_id, custom):
+    if not any(items_totals.values()):
+        # Nothing ordered yet to be proportional to
+        return split_equal(items_totals, fee_cents, collector_id, custom)
+    return allocate(fee_cents, items_totals)
+
+
+def split_collector_pays(items_totals, fee_cents, collector_id, custom):
+    # The collector's own payment carries the fees - it is created already paid
+    return {**{user_id: 0 for user_id in items_totals}, collector_id: fee_cents}
+
+
+def split_custom(items_totals, fee_cents, collector_id, custom):
+    fixed, weights = parse_custom(custom)
+    shares = {user_id: fixed.get(user_id, 0) for user_id in items_totals}
+    fixed_cents = sum(shares.values())
+    remaining = fee_cents - fixed_cents
+    if fixed_cents and fee_cents < 0:
+        # A discount bigger than the fees - it can only be shared out by weight
+        raise FeeSplitError(
+            f"Fixed fee amounts can't be used when the order's fees are negative ({from_cents(fee_cents)})"
+        )
+    if fixed_cents and remaining < 0:
+        raise FeeSplitError(
+            f"Fixed fee amounts ({from_cents(fixed_cents)}) exceed the order's fees ({from_cents(fee_cents)})"
+        )
+    if remaining == 0:
+        return shares
+
+    split_weights = {user_id: weights[user_id] for user_id in items_totals if weights.get(user_id)}
+    if not split_weights:
+        split_weights = {user_id: 1 for user_id in items_totals if user_id not in fixed} or {user_id: 1 for user_id in items_totals}
+    for user_id, cents in allocate(remaining, split_weights).items():
+        shares[user_id] += cents
+    return shares
+
+
+SPLIT_RULES = {
+    'equal': split_equal,
+    'proportional': split_proportional,
+    'collector_pays': split_collector_pays,
+    'custom': split_custom,
+}
+
+
+def to_weight(value):
+    if isinstance(value, bool):
+        raise FeeSplitError(f"Invalid weight: {value!r}")
+    try:
+        weight = Decimal(str(value))
+    except InvalidOperation:
+        raise FeeSplitError(f"Invalid weight: {value!r}")
+    if not weight.is_finite():
+        raise FeeSplitError(f"Invalid weight: {value!r}")
+    return Fraction(weight)
+
+
+def parse_entries(custom, name, parse):
+    entries = custom.get(name) or {}
+    if not isinstance(entries, dict):
+        raise FeeSplitError(f"Custom split '{name}' must map user ids to values")
+    values = {}
+    for user_id, value in entries.items():
+        try:
+            user_id = int(user_id)
+        except (TypeError, ValueError):
+            raise FeeSplitError(f"Invalid user id in custom split '{name}': {user_id!r}")
+        values[user_id] = parse(value)
+        if values[user_id] < 0:
+            raise FeeSplitError(f"Custom split '{name}' can't be negative")
+    return values
+
+
+def parse_custom(custom):
+    """({user id: fixed cents}, {user id: weight}) of a fee_split_custom value"""
+    custom = custom or {}
+    if not isinstance(custom, dict):
+        raise FeeSplitError("Custom split must be an object with 'fixed' and/or 'weights'")
+    unknown = set(custom) - {'fixed', 'weights'}
+    if unknown:
+        raise FeeSplitError(f"Unknown custom split keys: {', '.join(sorted(unknown))}")
+    return parse_entries(custom, 'fixed', to_cents), parse_entries(custom, 'weights', to_weight)
+
+
+def split_fees(items_totals, fees, rule, collector_id=None, custom=None):
+    """
+    Fee share per user under `rule`, as two-decimal Decimals summing exactly to `fees`.
+    `items_totals` maps each participant to their item total; the order's participants
+    (in key order) are the tie-breaker for leftover cents.
+    """
+    if rule not in SPLIT_RULES:
+        raise FeeSplitError(f"Unknown fee split rule: {rule}")
+    items_totals = dict(sorted(items_totals.items()))
+    if not items_totals:
+        return {}
+    shares = SPLIT_RULES[rule](items_totals, to_cents(fees), collector_id, custom)
+    return {user_id: from_cents(cents) for user_id, cents in shares.items()}
+
+
+def payment_amounts(items_totals, fees, rule, collector_id=None, custom=None):
+    """What each user pays: their item total plus their fee share"""
+    shares = split_fees(items_totals, fees, rule, collector_id, custom)
+    return {
+        user_id: (Decimal(items_totals.get(user_id, 0)) + share).quantize(CENT)
+        for user_id, share in shares.items()
+    }
@@ -0,0 +1,146 @@
+"""
+Pre-encoded WebSocket frames for order broadcasts.
+
+Broadcasts through the channel layer are claim checks - {order_id, version} - rather than
+the order itself. Each ASGI process resolves the frames for a version once, from the shared
+snapshot cache, and memoizes them so every socket on the node forwards the same text.
+"""
+import asyncio
+import json
+import logging
+import threading
+from collections import OrderedDict
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from .serializers import CollectionOrderSummarySerializer
+from .shares import snapshot_shares
+from .snapshots import get_order_snapshot
+
+logger = logging.getLogger(__name__)
+
+
+def encode_order(order_data):
+    """JSON text of an order snapshot - encoded once per version, not once per socket"""
+    return json.dumps(order_data)
+
+
+def order_frame(frame_type, order_json):
+    """WebSocket frame text {"type": frame_type, "order": ...} around an already-encoded order"""
+    return f'{{"type": {json.dumps(frame_type)}, "order": {order_json}}}'
+
+
+def order_summary(order_data):
+    """Compact new-order payload: the summary-view fields (CollectionOrderSummarySerializer) of a snapshot"""
+    return {name: order_data[name] for name in CollectionOrderSummarySerializer().fields}
+
+
+def delta_frame(from_version, version, events):
+    """WebSocket protocol 2 order_delta frame text"""
+    return json.dumps({
+        'type': 'order_delta',
+        'from_version': from_version,
+        'version': version,
+        'events': events
+    })
+
+
+def delta_cache_key(order_id, version):
+    return f'order-delta:{order_id}:{version}'
+
+
+def store_delta_frame(order_id, version, from_version, delta_frame):
+    """Publish the protocol 2 order_delta frame that leads up to `version`"""
+    try:
+        cache.set(delta_cache_key(order_id, version), (from_version, delta_frame), getattr(settings, 'ORDER_SNAPSHOT_TTL', 600))
+    except Exception as e:
+        logger.warning(f"Order delta cache unavailable: {e}")
+
+
+def build_order_frames(order_id, version):
+    """
+    Frames for one order version: the full `order_update` frame, the compact `new_order`
+    summary frame, the `order_delta` frame from `delta_from_version` when one was published,
+    and while the order is open the `order_shares` frame (see orders/shares.py), unless
+    the order has moved past the version.
+    `version` is the version actually resolved - newer than requested if the requested one
+    has already left the cache. None if the order no longer exists.
+    """
+    order_data = get_order_snapshot(order_id, version)
+    if order_data is None:
+        return None
+    frames = {
+        'version': order_data['version'],
+        'order_update': order_frame('order_update', encode_order(order_data)),
+        'new_order': order_frame('new_order', encode_order(order_summary(order_data))),
+        'delta_from_version': None,
+        'delta_frame': None,
+        'order_shares': None,
+    }
+    shares = snapshot_shares(order_data) if order_data['status'] == 'OPEN' else None
+    if shares is not None:
+        frames['order_shares'] = json.dumps({'type': 'order_shares', **shares})
+    try:
+        delta = cache.get(delta_cache_key(order_id, order_data['version']))
+    except Exception as e:
+        logger.warning(f"Order delta cache unavailable: {e}")
+        delta = None
+    if delta is not None:
+        frames['delta_from_version'], frames['delta_frame'] = delta
+    return frames
+
+
+def select_order_frame(frames, client_version):
+    """
+    Frame that brings a protocol 2 client from `client_version` to frames['version']:
+    the order_delta if it starts exactly there, else the full order_update
+    """
+    if frames['delta_frame'] and frames['delta_from_version'] == client_version:
+        return frames['delta_frame']
+    return frames['order_update']
+
+
+class FrameMemo:
+    """
+    Per-process memo of (order id, version) -> frames.
+    Concurrent lookups of the same version share one in-flight fetch.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    async def get(self, order_id, version):
+        key = (order_id, version)
+        with self._lock:
+            frames = self._entries.get(key)
+            if frames is not None:
+                self._entries.move_to_end(key)
+                return frames
+        if key in self._inflight:
+            return await asyncio.shield(self._inflight[key])
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        frames = None
+        try:
+            frames = await database_sync_to_async(build_order_frames)(order_id, version)
+        finally:
+            del self._inflight[key]
+            # Waiters get None if the fetch failed - they skip this broadcast
+            future.set_result(frames)
+        if frames is not None:
+            with self._lock:
+                self._entries[key] = frames
+                while len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+        return frames
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+order_frames = FrameMemo(getattr(settings, 'ORDER_SNAPSHOT_LRU_SIZE', 256))
@@ -0,0 +1,51 @@
+import random
+import time
+from decimal import Decimal
+from django.core.management.base import BaseCommand
+from orders.fee_split import SPLIT_RULES, payment_amounts
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the fee split engine on generated item totals (no database access)'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--participants',
+            type=int,
+            default=200,
+            help='Number of participants per split',
+        )
+        parser.add_argument(
+            '--runs',
+            type=int,
+            default=200,
+            help='Number of timed splits per rule',
+        )
+        parser.add_argument(
+            '--seed',
+            type=int,
+            default=0,
+            help='Random seed for the generated orders',
+        )
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        participants = options['participants']
+        items_totals = {user_id: Decimal(rng.randint(0, 50000)) / 100 for user_id in range(1, participants + 1)}
+        fees = Decimal(rng.randint(0, 20000)) / 100
+        custom = {
+            'fixed': {str(user_id): '1.50' for user_id in range(1, participants + 1, 10)},
+            'weights': {str(user_id): rng.randint(1, 3) for user_id in range(1, participants + 1, 2)},
+        }
+
+        self.stdout.write(f'{participants} participants, fees {fees}, {options["runs"]} run(s) per rule')
+        for rule in SPLIT_RULES:
+            timings = []
+            for _ in range(options['runs']):
+                start = time.perf_counter()
+                payment_amounts(items_totals, fees, rule, collector_id=1, custom=custom)
+                timings.append(time.perf_counter() - start)
+            timings.sort()
+            self.stdout.write(self.style.SUCCESS(
+                f'{rule:>15}: best {timings[0] * 1000:.3f} ms, median {timings[len(timings) // 2] * 1000:.3f} ms'
+            ))
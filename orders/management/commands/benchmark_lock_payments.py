@@ -0,0 +1,79 @@
+import time
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from orders.models import User, Restaurant, CollectionOrder, OrderItem, Payment, ParticipantTotal
+from orders.views import CollectionOrderViewSet
+
+
+class Command(BaseCommand):
+    help = 'Benchmark payment calculation on lock for a large office order (all data is rolled back)'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--participants',
+            type=int,
+            default=200,
+            help='Number of participants in the order',
+        )
+        parser.add_argument(
+            '--items',
+            type=int,
+            default=2,
+            help='Items per participant',
+        )
+        parser.add_argument(
+            '--rule',
+            type=str,
+            default='equal',
+            choices=[choice for choice, _ in CollectionOrder.FEE_SPLIT_CHOICES],
+            help='Fee split rule of the order',
+        )
+        parser.add_argument(
+            '--runs',
+            type=int,
+            default=5,
+            help='Number of timed runs',
+        )
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            order = self.build_order(options['participants'], options['items'], options['rule'])
+            view = CollectionOrderViewSet()
+
+            timings = []
+            for _ in range(options['runs']):
+                with CaptureQueriesContext(connection) as ctx:
+                    start = time.perf_counter()
+                    view._calculate_payments(order)
+                    timings.append(time.perf_counter() - start)
+
+            payments = Payment.objects.filter(order=order).count()
+            transaction.set_rollback(True)
+
+        timings.sort()
+        self.stdout.write(
+            f'{options["participants"]} participants x {options["items"]} item(s), rule={options["rule"]}: '
+            f'{payments} payments, {len(ctx.captured_queries)} queries'
+        )
+        self.stdout.write(self.style.SUCCESS(
+            f'best {timings[0] * 1000:.1f} ms, median {timings[len(timings) // 2] * 1000:.1f} ms over {len(timings)} run(s)'
+        ))
+
+    def build_order(self, participant_count, items_per_participant, rule):
+        restaurant = Restaurant.objects.create(name='Benchmark Restaurant')
+        users = User.objects.bulk_create([
+            User(username=f'benchmark-participant-{i}') for i in range(participant_count)
+        ])
+        order = CollectionOrder.objects.create(
+            restaurant=restaurant, collector=users[0], fee_split_rule=rule,
+            delivery_fee=45, tip=20, service_fee=12, status='LOCKED'
+        )
+        OrderItem.objects.bulk_create([
+            OrderItem(order=order, user=user, custom_name=f'Item {i}', quantity=1, unit_price=50 + i, total_price=50 + i)
+            for user in users for i in range(items_per_participant)
+        ])
+        order.refresh_totals()
+        ParticipantTotal.rebuild(order.pk)
+        order.refresh_from_db()
+        return order
@@ -0,0 +1,89 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Count, Sum
+from orders.models import CollectionOrder, OrderItem, ParticipantTotal
+from orders.snapshots import bump_order_versions
+
+
+class Command(BaseCommand):
+    help = 'Recompute denormalized order totals (items_total, item_count, participant_count, per-participant totals) and repair any drift'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--order',
+            type=str,
+            help='Only recompute the order with this code',
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Report drifted orders without updating them',
+        )
+
+    def handle(self, *args, **options):
+        orders = CollectionOrder.objects.all()
+        if options['order']:
+            orders = orders.filter(code=options['order'].upper())
+
+        orders = orders.annotate(
+            actual_items_total=Sum('items__total_price'),
+            actual_item_count=Count('items'),
+            actual_participant_count=Count('items__user', distinct=True),
+        ).order_by('id')
+
+        checked = 0
+        drifted = 0
+        repaired_ids = []
+        for order in orders.iterator():
+            checked += 1
+            actual = (
+                order.actual_items_total or 0,
+                order.actual_item_count,
+                order.actual_participant_count,
+            )
+            stored = (order.items_total, order.item_count, order.participant_count)
+            totals_drifted = stored != actual
+            participants_drifted = self.participant_totals(order) != self.actual_participant_totals(order)
+            if not totals_drifted and not participants_drifted:
+                continue
+
+            drifted += 1
+            if totals_drifted:
+                self.stdout.write(
+                    self.style.WARNING(
+                        f'Order {order.code}: stored (total={stored[0]}, items={stored[1]}, participants={stored[2]}) '
+                        f'!= actual (total={actual[0]}, items={actual[1]}, participants={actual[2]})'
+                    )
+                )
+            if participants_drifted:
+                self.stdout.write(self.style.WARNING(f'Order {order.code}: participant totals differ from its items'))
+            if not options['dry_run']:
+                if totals_drifted:
+                    order.refresh_totals()
+                if participants_drifted:
+                    ParticipantTotal.rebuild(order.pk)
+                repaired_ids.append(order.pk)
+
+        # New versions, so cached snapshots and ETags stop serving the drifted totals
+        if repaired_ids:
+            bump_order_versions(CollectionOrder.objects.filter(id__in=repaired_ids))
+
+        if options['dry_run']:
+            self.stdout.write(self.style.SUCCESS(f'\nChecked {checked} order(s), {drifted} drifted (dry run, nothing updated)'))
+        else:
+            self.stdout.write(self.style.SUCCESS(f'\nChecked {checked} order(s), repaired {drifted}'))
+
+    def participant_totals(self, order):
+        """User id -> (items total, item count) as stored in ParticipantTotal"""
+        return {
+            user_id: (total, count)
+            for user_id, total, count in ParticipantTotal.objects.filter(order=order).values_list('user', 'items_total', 'item_count')
+        }
+
+    def actual_participant_totals(self, order):
+        """User id -> (items total, item count) summed from the order's items"""
+        return {
+            user_id: (total, count)
+            for user_id, total, count in OrderItem.objects.filter(order=order).order_by().values('user').annotate(
+                total=Sum('total_price'), count=Count('id')
+            ).values_list('user', 'total', 'count')
+        }
@@ -0,0 +1,41 @@
+"""
+In-process counters for the realtime pipeline.
+
+Counters are per process and reset on restart; they are exposed to admins at
+GET /api/metrics/ for spotting broadcast storms and slow consumers.
+"""
+import threading
+from collections import Counter
+
+
+class Metrics:
+    """Thread-safe named counters"""
+
+    def __init__(self):
+        self._counters = Counter()
+        self._lock = threading.Lock()
+
+    def incr(self, name, amount=1):
+        with self._lock:
+            self._counters[name] += amount
+
+    def set_max(self, name, value):
+        """Record `value` if it is the highest seen for `name`"""
+        with self._lock:
+            if value > self._counters[name]:
+                self._counters[name] = value
+
+    def get(self, name):
+        with self._lock:
+            return self._counters[name]
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._counters)
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+
+
+metrics = Metrics()
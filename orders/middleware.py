@@ -1,16 +1,68 @@
 """
 Custom middleware for WebSocket JWT authentication
 """
+import threading
+import time
+from collections import OrderedDict
 from urllib.parse import parse_qs
 from channels.middleware import BaseMiddleware
 from channels.db import database_sync_to_async
+from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import AnonymousUser
 from rest_framework_simplejwt.tokens import AccessToken
 from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
+from .authentication import PRINCIPAL_FIELDS, build_principal
 
 User = get_user_model()
 
+class PrincipalCache:
+    """
+    Bounded TTL cache of user id -> (id, username, role, is_active), so reconnect storms
+    don't run a user lookup per WebSocket connect. Entries are dropped when the user is
+    saved or deleted in this process (orders/signals.py); the TTL bounds staleness for
+    changes made by other processes.
+    """
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return None
+            expires_at, values = entry
+            if expires_at < time.monotonic():
+                del self._entries[user_id]
+                return None
+            self._entries.move_to_end(user_id)
+            return values
+
+    def set(self, user_id, values):
+        with self._lock:
+            self._entries[user_id] = (time.monotonic() + self.ttl, values)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def discard(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+principal_cache = PrincipalCache(
+    getattr(settings, 'WS_PRINCIPAL_CACHE_SIZE', 1024),
+    getattr(settings, 'WS_PRINCIPAL_CACHE_TTL', 60),
+)
+
 
 class JWTAuthMiddleware(BaseMiddleware):
     """
@@ -49,16 +101,27 @@ class JWTAuthMiddleware(BaseMiddleware):
         
         return await super().__call__(scope, receive, send)
     
-    @database_sync_to_async
-    def get_user_from_token(self, token):
-        """Validate JWT token and return user"""
+    async def get_user_from_token(self, token):
+        """Validate JWT token and return the user principal (cached per user id)"""
         try:
             access_token = AccessToken(token)
             user_id = access_token['user_id']
-            user = User.objects.get(id=user_id)
-            return user
-        except (InvalidToken, TokenError, User.DoesNotExist):
+        except (InvalidToken, TokenError, KeyError):
             raise InvalidToken("Invalid token")
+        
+        values = principal_cache.get(user_id)
+        if values is None:
+            values = await self.get_principal_values(user_id)
+            if values is None:
+                raise InvalidToken("Invalid token")
+            principal_cache.set(user_id, values)
+        if not values['is_active']:
+            raise InvalidToken("User is inactive")
+        return build_principal(values)
+    
+    @database_sync_to_async
+    def get_principal_values(self, user_id):
+        return User.objects.filter(id=user_id).values(*PRINCIPAL_FIELDS).first()
 
 
 def JWTAuthMiddlewareStack(inner):
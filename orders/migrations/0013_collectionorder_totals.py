@@ -0,0 +1,45 @@
+# Generated by Django 5.2.8 on 2026-10-16 20:31
+
+from django.db import migrations, models
+from django.db.models import Count, Sum
+
+
+def backfill_order_totals(apps, schema_editor):
+    CollectionOrder = apps.get_model('orders', 'CollectionOrder')
+    orders = CollectionOrder.objects.annotate(
+        actual_items_total=Sum('items__total_price'),
+        actual_item_count=Count('items'),
+        actual_participant_count=Count('items__user', distinct=True),
+    )
+    for order in orders.iterator():
+        CollectionOrder.objects.filter(pk=order.pk).update(
+            items_total=order.actual_items_total or 0,
+            item_count=order.actual_item_count,
+            participant_count=order.actual_participant_count,
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0012_add_admin_role'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='collectionorder',
+            name='item_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='collectionorder',
+            name='items_total',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=12),
+        ),
+        migrations.AddField(
+            model_name='collectionorder',
+            name='participant_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_order_totals, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.8 on 2026-10-16 20:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0013_collectionorder_totals'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='orderitem',
+            index=models.Index(fields=['user', 'order'], name='orders_orde_user_id_e45504_idx'),
+        ),
+    ]
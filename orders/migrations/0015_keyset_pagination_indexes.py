@@ -0,0 +1,33 @@
+# Generated by Django 5.2.8 on 2026-10-16 20:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0014_orderitem_user_order_index'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='auditlog',
+            index=models.Index(fields=['-created_at', '-id'], name='orders_audi_created_bbc74f_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='auditlog',
+            index=models.Index(fields=['order', '-created_at', '-id'], name='orders_audi_order_i_9f640c_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='collectionorder',
+            index=models.Index(fields=['-created_at', '-id'], name='orders_coll_created_6c2163_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='orderitem',
+            index=models.Index(fields=['-created_at', '-id'], name='orders_orde_created_3f073e_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='payment',
+            index=models.Index(fields=['-created_at', '-id'], name='orders_paym_created_d818f7_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.8 on 2026-10-16 20:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0015_keyset_pagination_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='collectionorder',
+            name='version',
+            field=models.PositiveIntegerField(default=1),
+        ),
+    ]
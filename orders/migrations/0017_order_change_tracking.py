@@ -0,0 +1,39 @@
+# Generated by Django 5.2.8 on 2026-10-16 20:36
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0016_collectionorder_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='orderitem',
+            name='changed_version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='payment',
+            name='changed_version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.CreateModel(
+            name='OrderTombstone',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('item', 'Order Item'), ('payment', 'Payment')], max_length=10)),
+                ('object_id', models.BigIntegerField()),
+                ('version', models.PositiveIntegerField(help_text='Order version at which the row was deleted')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('order', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='tombstones', to='orders.collectionorder')),
+            ],
+            options={
+                'ordering': ['version'],
+                'indexes': [models.Index(fields=['order', 'version'], name='orders_orde_order_i_2c8026_idx')],
+            },
+        ),
+    ]
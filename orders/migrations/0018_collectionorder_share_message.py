@@ -0,0 +1,56 @@
+# Generated by Django 5.2.8 on 2026-10-16 20:38
+
+import datetime
+
+from django.conf import settings
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def render_share_message(order):
+    """
+    Share message of a historical order, as orders.utils rendered it when this migration
+    was written - frozen here so later changes to the live helpers can't alter the backfill
+    """
+    cutoff_time = order.cutoff_time
+    if cutoff_time:
+        if timezone.is_naive(cutoff_time):
+            cutoff_time = timezone.make_aware(cutoff_time, datetime.timezone.utc)
+        cutoff_str = timezone.localtime(cutoff_time).strftime('%I:%M %p')
+    else:
+        cutoff_str = 'N/A'
+    frontend_url = getattr(settings, 'FRONTEND_URL', None)
+    join_url = f"{frontend_url}/join/{order.code}" if frontend_url else f'/join/{order.code}'
+
+    message = (f"🍽️ OrderQ: Order from {order.restaurant.name}\n"
+               f"📋 Join code: {order.code}\n"
+               f"⏰ Cutoff: {cutoff_str}\n"
+               f"🔗 Add your items here: {join_url}\n"
+               f"👤 Collector: {order.collector.username}")
+    assigned_usernames = [u.username for u in order.assigned_users.all()]
+    if assigned_usernames:
+        message += f"\n👥 Assigned to: {', '.join(assigned_usernames)}"
+    return message
+
+
+def backfill_share_messages(apps, schema_editor):
+    CollectionOrder = apps.get_model('orders', 'CollectionOrder')
+    orders = CollectionOrder.objects.select_related('restaurant', 'collector').prefetch_related('assigned_users')
+    for order in orders.iterator(chunk_size=500):
+        CollectionOrder.objects.filter(pk=order.pk).update(share_message=render_share_message(order))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0017_order_change_tracking'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='collectionorder',
+            name='share_message',
+            field=models.TextField(blank=True),
+        ),
+        migrations.RunPython(backfill_share_messages, migrations.RunPython.noop),
+    ]
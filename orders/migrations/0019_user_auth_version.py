@@ -0,0 +1,18 @@
+# Generated by Django 5.2.8 on 2026-10-16 23:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0018_collectionorder_share_message'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='auth_version',
+            field=models.PositiveIntegerField(default=1, help_text='Bumped when identity claims change - access tokens carrying an older version are rejected'),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.2.8 on 2026-10-16 20:50
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0019_user_auth_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OrderEventLog',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('from_version', models.PositiveIntegerField()),
+                ('version', models.PositiveIntegerField()),
+                ('events', models.JSONField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('order', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='event_log', to='orders.collectionorder')),
+            ],
+            options={
+                'ordering': ['version'],
+                'indexes': [models.Index(fields=['order', 'version'], name='orders_orde_order_i_19623a_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.8 on 2026-10-16 21:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0020_ordereventlog'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='balance_version',
+            field=models.PositiveIntegerField(default=0, help_text='Bumped when payments this user pays or collects change (see orders/balances.py)'),
+        ),
+    ]
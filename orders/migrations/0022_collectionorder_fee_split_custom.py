@@ -0,0 +1,18 @@
+# Generated by Django 5.2.8 on 2026-10-16 22:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0021_user_balance_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='collectionorder',
+            name='fee_split_custom',
+            field=models.JSONField(blank=True, default=dict, help_text='Fixed amounts and/or weights per user id for the custom fee split rule (see orders/fee_split.py)'),
+        ),
+    ]
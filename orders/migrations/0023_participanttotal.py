@@ -0,0 +1,41 @@
+# Generated by Django 5.2.8 on 2026-10-16 22:50
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, Sum
+
+
+def backfill_participant_totals(apps, schema_editor):
+    OrderItem = apps.get_model('orders', 'OrderItem')
+    ParticipantTotal = apps.get_model('orders', 'ParticipantTotal')
+    totals = OrderItem.objects.order_by().values('order', 'user').annotate(total=Sum('total_price'), count=Count('id'))
+    ParticipantTotal.objects.bulk_create([
+        ParticipantTotal(order_id=row['order'], user_id=row['user'], items_total=row['total'], item_count=row['count'])
+        for row in totals.iterator(chunk_size=2000)
+    ], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0022_collectionorder_fee_split_custom'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ParticipantTotal',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('items_total', models.DecimalField(decimal_places=2, default=0, max_digits=10)),
+                ('item_count', models.PositiveIntegerField(default=0)),
+                ('order', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='participant_totals', to='orders.collectionorder')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='participant_totals', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['user_id'],
+                'unique_together': {('order', 'user')},
+            },
+        ),
+        migrations.RunPython(backfill_participant_totals, migrations.RunPython.noop),
+    ]
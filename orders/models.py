@@ -1,11 +1,43 @@
-from django.db import models
+from django.conf import settings
+from django.db import models, transaction
+from django.db.models import Sum, Count, F, Q, Exists, OuterRef, Prefetch
 from django.contrib.auth.models import AbstractUser
 from django.utils import timezone
+from decimal import Decimal
+from .utils import render_share_message, build_join_url
 import secrets
 import string
 
 
-class User(AbstractUser):
+class SnapshotFieldsMixin:
+    """
+    Tracks the fields of a model that order snapshots copy (SNAPSHOT_FIELDS). After a save,
+    `changed_snapshot_fields` holds the ones that changed, so the orders showing the old
+    values can be moved to a new version (see orders/signals.py).
+    """
+    SNAPSHOT_FIELDS = []
+    
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_snapshot_fields = {name: instance.__dict__[name] for name in cls.SNAPSHOT_FIELDS if name in instance.__dict__}
+        return instance
+    
+    def save(self, *args, **kwargs):
+        loaded = getattr(self, '_loaded_snapshot_fields', None)
+        update_fields = kwargs.get('update_fields')
+        if self._state.adding or (update_fields is not None and not set(update_fields) & set(self.SNAPSHOT_FIELDS)):
+            self.changed_snapshot_fields = set()
+        elif loaded is None:
+            # Instances not loaded from the database may differ in anything
+            self.changed_snapshot_fields = set(self.SNAPSHOT_FIELDS)
+        else:
+            self.changed_snapshot_fields = {name for name, value in loaded.items() if getattr(self, name) != value}
+        super().save(*args, **kwargs)
+        self._loaded_snapshot_fields = {name: self.__dict__[name] for name in self.SNAPSHOT_FIELDS if name in self.__dict__}
+
+
+class User(SnapshotFieldsMixin, AbstractUser):
     """Extended user model with role"""
     ROLE_CHOICES = [
         ('admin', 'Administrator'),
@@ -17,18 +49,54 @@ class User(AbstractUser):
     phone = models.CharField(max_length=20, blank=True)
     instapay_link = models.URLField(max_length=500, blank=True, help_text="Instapay payment link for this user")
     instapay_qr_code = models.ImageField(upload_to='qr_codes/', blank=True, null=True, help_text="QR code image for Instapay")
+    auth_version = models.PositiveIntegerField(default=1, help_text="Bumped when identity claims change - access tokens carrying an older version are rejected")
+    balance_version = models.PositiveIntegerField(default=0, help_text="Bumped when payments this user pays or collects change (see orders/balances.py)")
+    
+    # Carried as claims in access tokens (see orders/authentication.py)
+    IDENTITY_FIELDS = ['username', 'role', 'is_active']
+    
+    # Shown in order snapshots (names, participant emails, the collector's payment link)
+    SNAPSHOT_FIELDS = ['username', 'email', 'instapay_link', 'instapay_qr_code']
+    
+    # Maintained with targeted UPDATEs (bump_balance_versions) - never written back by plain saves
+    DERIVED_FIELDS = ['balance_version']
     
     def __str__(self):
         return f"{self.username} ({self.get_role_display()})"
+    
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_identity = {name: instance.__dict__[name] for name in cls.IDENTITY_FIELDS if name in instance.__dict__}
+        return instance
+    
+    def save(self, *args, **kwargs):
+        loaded = getattr(self, '_loaded_identity', None)
+        if loaded and any(getattr(self, name) != value for name, value in loaded.items()):
+            # Role, username or active state changed - force clients to refresh their tokens
+            self.auth_version += 1
+            if kwargs.get('update_fields') is not None:
+                kwargs['update_fields'] = {*kwargs['update_fields'], 'auth_version'}
+        if not self._state.adding and kwargs.get('update_fields') is None:
+            # Deferred fields stay unloaded, as with a plain save of a deferred instance
+            deferred = self.get_deferred_fields()
+            kwargs['update_fields'] = [
+                f.name for f in self._meta.concrete_fields
+                if not f.primary_key and f.name not in self.DERIVED_FIELDS and f.attname not in deferred
+            ]
+        super().save(*args, **kwargs)
+        self._loaded_identity = {name: getattr(self, name) for name in self.IDENTITY_FIELDS}
 
 
-class Restaurant(models.Model):
+class Restaurant(SnapshotFieldsMixin, models.Model):
     """Restaurant model"""
     name = models.CharField(max_length=200)
     description = models.TextField(blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     created_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, related_name='created_restaurants')
     
+    SNAPSHOT_FIELDS = ['name']
+    
     class Meta:
         ordering = ['-created_at']
     
@@ -36,7 +104,7 @@ class Restaurant(models.Model):
         return self.name
 
 
-class Menu(models.Model):
+class Menu(SnapshotFieldsMixin, models.Model):
     """Menu model for a restaurant"""
     restaurant = models.ForeignKey(Restaurant, on_delete=models.CASCADE, related_name='menus')
     name = models.CharField(max_length=200)
@@ -48,6 +116,8 @@ class Menu(models.Model):
     menu_hash = models.CharField(max_length=64, blank=True, null=True, help_text="SHA256 hash of menu items for change detection")
     last_synced_at = models.DateTimeField(null=True, blank=True, help_text="Last time menu was synced from Talabat")
     
+    SNAPSHOT_FIELDS = ['name']
+    
     class Meta:
         ordering = ['-created_at']
     
@@ -55,7 +125,7 @@ class Menu(models.Model):
         return f"{self.restaurant.name} - {self.name}"
 
 
-class MenuItem(models.Model):
+class MenuItem(SnapshotFieldsMixin, models.Model):
     """Menu item model"""
     menu = models.ForeignKey(Menu, on_delete=models.CASCADE, related_name='items')
     name = models.CharField(max_length=200)
@@ -69,6 +139,8 @@ class MenuItem(models.Model):
     item_hash = models.CharField(max_length=64, blank=True, null=True, db_index=True, help_text="SHA256 hash for change detection")
     section_name = models.CharField(max_length=200, blank=True, help_text="Section/category name from Talabat")
     
+    SNAPSHOT_FIELDS = ['name']
+    
     class Meta:
         ordering = ['name']
         indexes = [
@@ -91,6 +163,69 @@ class FeePreset(models.Model):
         return self.name
 
 
+def order_visibility_q(user, prefix=''):
+    """
+    Filter matching orders a normal user can see: public orders and orders they collect,
+    have items in or are assigned to. Participation and assignment are correlated EXISTS
+    subqueries, so the filter never multiplies rows and needs no DISTINCT.
+    `prefix` (e.g. 'order__') applies the filter through another model's order FK.
+    """
+    order_ref = OuterRef(f'{prefix}pk')
+    return (
+        Q(**{f'{prefix}is_private': False}) |
+        Q(**{f'{prefix}collector': user}) |
+        Exists(OrderItem.objects.filter(order_id=order_ref, user=user)) |
+        Exists(CollectionOrder.assigned_users.through.objects.filter(collectionorder_id=order_ref, user=user))
+    )
+
+
+def order_member_q(user, rows, prefix=''):
+    """
+    Filter matching orders whose items or payments a normal user may change: orders they
+    collect or have rows of `rows` (OrderItem or Payment) in. Narrower than visibility -
+    public orders are readable by everyone but writable only by their members.
+    """
+    return (
+        Q(**{f'{prefix}collector': user}) |
+        Exists(rows.objects.filter(order_id=OuterRef(f'{prefix}pk'), user=user))
+    )
+
+
+class CollectionOrderQuerySet(models.QuerySet):
+    def visible_to(self, user):
+        """Orders the user may see - managers and admins see everything"""
+        if user.role in ['manager', 'admin']:
+            return self
+        return self.filter(order_visibility_q(user))
+    
+    def with_related(self):
+        """Select/prefetch everything CollectionOrderSerializer reads, so serializing is query-free per row"""
+        return self.select_related('restaurant', 'menu', 'collector').prefetch_related(
+            Prefetch('items', queryset=OrderItem.objects.select_related('user', 'menu_item').order_by('-created_at')),
+            Prefetch('payments', queryset=Payment.objects.select_related('user').order_by('-created_at')),
+            'assigned_users'
+        )
+    
+    def with_changes_since(self, since):
+        """Like with_related(), but only prefetch items and payments changed after order version `since`"""
+        return self.select_related('restaurant', 'menu', 'collector').prefetch_related(
+            Prefetch('items', queryset=OrderItem.objects.filter(changed_version__gt=since).select_related('user', 'menu_item').order_by('-created_at')),
+            Prefetch('payments', queryset=Payment.objects.filter(changed_version__gt=since).select_related('user').order_by('-created_at')),
+            'assigned_users'
+        )
+    
+    def summary(self):
+        """Flat rows for CollectionOrderSummarySerializer - columns and joins only, no per-row relation traversal"""
+        return self.values(
+            'id', 'code', 'restaurant_id', 'collector_id', 'status', 'cutoff_time', 'is_private', 'created_at',
+            'item_count', 'participant_count', 'version',
+            restaurant_name=F('restaurant__name'),
+            collector_name=F('collector__username'),
+            total_items_cost=F('items_total'),
+            total_cost=F('items_total') + F('delivery_fee') + F('tip') + F('service_fee'),
+        )
+
+
 class CollectionOrder(models.Model):
     """Collection order model"""
     STATUS_CHOICES = [
@@ -121,17 +256,39 @@ class CollectionOrder(models.Model):
     tip = models.DecimalField(max_digits=10, decimal_places=2, default=30)
     service_fee = models.DecimalField(max_digits=10, decimal_places=2, default=0)
     fee_split_rule = models.CharField(max_length=20, choices=FEE_SPLIT_CHOICES, default='equal')
+    fee_split_custom = models.JSONField(default=dict, blank=True, help_text="Fixed amounts and/or weights per user id for the custom fee split rule (see orders/fee_split.py)")
     
     # Assigned users - if set, only these users can join the order
     assigned_users = models.ManyToManyField(User, related_name='assigned_orders', blank=True, help_text="Users assigned to this order (e.g., for birthday cake)")
     
+    # Denormalized item totals - kept in sync by refresh_totals() on every item mutation
+    items_total = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    item_count = models.PositiveIntegerField(default=0)
+    participant_count = models.PositiveIntegerField(default=0)
+    
+    # Monotonic change counter, bumped by every mutation of the order, its items or payments
+    version = models.PositiveIntegerField(default=1)
+    
+    # Pre-rendered share message - see refresh_share_message()
+    share_message = models.TextField(blank=True)
+    
     created_at = models.DateTimeField(auto_now_add=True)
     locked_at = models.DateTimeField(null=True, blank=True)
     ordered_at = models.DateTimeField(null=True, blank=True)
     closed_at = models.DateTimeField(null=True, blank=True)
     
+    objects = CollectionOrderQuerySet.as_manager()
+    
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            # Keyset pagination on (created_at, id)
+            models.Index(fields=['-created_at', '-id']),
+        ]
+    
+    # Columns maintained with targeted UPDATEs (refresh_totals, bump_version, refresh_share_message).
+    # Plain saves of an existing order must not write back a stale in-memory copy.
+    DERIVED_FIELDS = ['items_total', 'item_count', 'participant_count', 'version', 'share_message']
     
     def __str__(self):
         return f"Order {self.code} - {self.restaurant.name} ({self.status})"
@@ -146,11 +303,75 @@ class CollectionOrder(models.Model):
     def save(self, *args, **kwargs):
         if not self.code:
             self.code = self.generate_code()
+        if self._state.adding and not self.share_message:
+            # New orders have no assigned users yet - those are added by refresh_share_message()
+            self.share_message = self.render_share_message([])
+        if not self._state.adding and kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = [
+                f.name for f in self._meta.concrete_fields
+                if not f.primary_key and f.name not in self.DERIVED_FIELDS
+            ]
         super().save(*args, **kwargs)
     
+    def bump_version(self):
+        """Atomically increment the order version, invalidate cached snapshots and return the new value"""
+        from .snapshots import invalidate_order_snapshot
+        
+        CollectionOrder.objects.filter(pk=self.pk).update(version=F('version') + 1)
+        self.version = CollectionOrder.objects.values_list('version', flat=True).get(pk=self.pk)
+        invalidate_order_snapshot(self.pk, self.version - 1)
+        return self.version
+    
+    def get_join_url(self):
+        return build_join_url(self.code)
+    
+    def render_share_message(self, assigned_usernames):
+        return render_share_message(
+            restaurant_name=self.restaurant.name,
+            code=self.code,
+            cutoff_time=self.cutoff_time,
+            join_url=self.get_join_url(),
+            collector_username=self.collector.username,
+            assigned_usernames=assigned_usernames,
+        )
+    
+    def refresh_share_message(self):
+        """
+        Re-render and store the share message.
+        Call whenever the cutoff, restaurant, collector or assigned users change (or are renamed).
+        """
+        self.share_message = self.render_share_message([u.username for u in self.assigned_users.all()])
+        CollectionOrder.objects.filter(pk=self.pk).update(share_message=self.share_message)
+    
+    @property
+    def etag(self):
+        """HTTP entity tag for the order representation at its current version"""
+        return f'"order-{self.pk}-v{self.version}"'
+    
     def get_total_items_cost(self):
-        """Calculate total cost of all items"""
-        return sum(item.total_price for item in self.items.all())
+        """Total cost of all items (denormalized, see refresh_totals)"""
+        return self.items_total
+    
+    def refresh_totals(self):
+        """
+        Recalculate items_total, item_count and participant_count from the order's items.
+        The order row is locked first so concurrent item mutations can't overwrite each other's totals.
+        """
+        with transaction.atomic():
+            CollectionOrder.objects.select_for_update().only('pk').get(pk=self.pk)
+            totals = OrderItem.objects.filter(order_id=self.pk).aggregate(
+                items_total=Sum('total_price'),
+                item_count=Count('id'),
+                participant_count=Count('user', distinct=True),
+            )
+            self.items_total = totals['items_total'] or Decimal('0')
+            self.item_count = totals['item_count']
+            self.participant_count = totals['participant_count']
+            CollectionOrder.objects.filter(pk=self.pk).update(
+                items_total=self.items_total,
+                item_count=self.item_count,
+                participant_count=self.participant_count,
+            )
     
     def get_total_cost(self):
         """Calculate total cost including fees"""
@@ -176,20 +397,105 @@ class OrderItem(models.Model):
     total_price = models.DecimalField(max_digits=10, decimal_places=2)
     note = models.TextField(blank=True, help_text="Special instructions or modifications for this item")
     
+    # Order version at which this item was last created/changed (see CollectionOrder.version)
+    changed_version = models.PositiveIntegerField(default=0)
+    
     created_at = models.DateTimeField(auto_now_add=True)
     
     class Meta:
         ordering = ['-created_at']
         unique_together = [['order', 'user', 'menu_item', 'custom_name']]
+        indexes = [
+            # Serves the per-user participation EXISTS in order_visibility_q
+            models.Index(fields=['user', 'order']),
+            # Keyset pagination on (created_at, id)
+            models.Index(fields=['-created_at', '-id']),
+        ]
     
     def __str__(self):
         item_name = self.menu_item.name if self.menu_item else self.custom_name
         return f"{self.user.username} - {item_name} x{self.quantity}"
     
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_share = (instance.__dict__.get('user_id'), instance.__dict__.get('total_price'))
+        return instance
+    
     def save(self, *args, **kwargs):
         if not self.total_price:
             self.total_price = self.unit_price * self.quantity
+        # (user id, total) the running participant totals counted for this item before the save,
+        # None if unknown (see orders/signals.py)
+        loaded = getattr(self, '_loaded_share', None)
+        self.previous_share = None if self._state.adding or loaded is None or None in loaded else loaded
         super().save(*args, **kwargs)
+        self._loaded_share = (self.user_id, self.total_price)
+
+
+class ParticipantTotal(models.Model):
+    """
+    Running item total of one user in one order, adjusted on every item add, update and
+    delete (see orders/signals.py) so share previews and lock never re-aggregate the
+    order's items
+    """
+    order = models.ForeignKey(CollectionOrder, on_delete=models.CASCADE, related_name='participant_totals')
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='participant_totals')
+    items_total = models.DecimalField(max_digits=10, decimal_places=2, default=0)
+    item_count = models.PositiveIntegerField(default=0)
+    
+    class Meta:
+        ordering = ['user_id']
+        unique_together = [['order', 'user']]
+    
+    def __str__(self):
+        return f"{self.order_id} - {self.user_id}: {self.items_total} ({self.item_count} items)"
+    
+    @classmethod
+    def record(cls, order_id, user_id, amount, count):
+        """
+        Add `amount` and `count` items to the user's total in the order (negative to remove),
+        after the item change is saved. Callers hold the order row lock (see
+        CollectionOrder.refresh_totals).
+        A user's first item inserts their running total. When a change or removal finds no
+        running total, or fewer items in it than removed - items written by bulk updates,
+        which send no signals - the order's totals are rebuilt from its items instead.
+        Returns False if so: the rebuilt totals already include every saved change.
+        """
+        updated = cls.objects.filter(order_id=order_id, user_id=user_id, item_count__gte=-count).update(
+            items_total=F('items_total') + amount,
+            item_count=F('item_count') + count,
+        )
+        if not updated:
+            if count > 0:
+                cls.objects.create(order_id=order_id, user_id=user_id, items_total=amount, item_count=count)
+                return True
+            cls.rebuild(order_id)
+            return False
+        if count < 0:
+            # The user's last item is gone - they are no longer a participant
+            cls.objects.filter(order_id=order_id, user_id=user_id, item_count=0).delete()
+        return True
+    
+    @classmethod
+    def record_item_change(cls, item, old_user_id, old_total):
+        """Move an updated item's old total out of `old_user_id`'s running total and its new one in"""
+        if old_user_id != item.user_id:
+            if cls.record(item.order_id, old_user_id, -old_total, -1):
+                cls.record(item.order_id, item.user_id, item.total_price, 1)
+        elif old_total != item.total_price:
+            cls.record(item.order_id, item.user_id, item.total_price - old_total, 0)
+    
+    @classmethod
+    def rebuild(cls, order_id):
+        """Recompute an order's running totals from its items (bulk item changes)"""
+        cls.objects.filter(order_id=order_id).delete()
+        cls.objects.bulk_create([
+            cls(order_id=order_id, user_id=user_id, items_total=total, item_count=count)
+            for user_id, total, count in OrderItem.objects.filter(order_id=order_id).order_by().values('user').annotate(
+                total=Sum('total_price'), count=Count('id')
+            ).values_list('user', 'total', 'count')
+        ])
 
 
 class Payment(models.Model):
@@ -199,16 +505,105 @@ class Payment(models.Model):
     amount = models.DecimalField(max_digits=10, decimal_places=2)
     is_paid = models.BooleanField(default=False)
     paid_at = models.DateTimeField(null=True, blank=True)
+    
+    # Order version at which this payment was last created/changed (see CollectionOrder.version)
+    changed_version = models.PositiveIntegerField(default=0)
+    
     created_at = models.DateTimeField(auto_now_add=True)
     
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            # Keyset pagination on (created_at, id)
+            models.Index(fields=['-created_at', '-id']),
+        ]
     
     def __str__(self):
         status = "Paid" if self.is_paid else "Pending"
         return f"{self.user.username} - {self.amount} EGP ({status})"
 
 
+class OrderTombstone(models.Model):
+    """Marker for an item or payment deleted from an order, so change feeds can report the deletion"""
+    KIND_CHOICES = [
+        ('item', 'Order Item'),
+        ('payment', 'Payment'),
+    ]
+    
+    order = models.ForeignKey(CollectionOrder, on_delete=models.CASCADE, related_name='tombstones')
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES)
+    object_id = models.BigIntegerField()
+    version = models.PositiveIntegerField(help_text="Order version at which the row was deleted")
+    created_at = models.DateTimeField(auto_now_add=True)
+    
+    class Meta:
+        ordering = ['version']
+        indexes = [
+            models.Index(fields=['order', 'version']),
+        ]
+    
+    def __str__(self):
+        return f"{self.order_id} - {self.kind} {self.object_id} deleted at v{self.version}"
+    
+    @classmethod
+    def record(cls, order, kind, object_ids):
+        """
+        Tombstone deleted rows at the order's current version and prune tombstones
+        older than any change feed can still ask for (see ORDER_CHANGES_MAX_GAP)
+        """
+        cls.objects.bulk_create([
+            cls(order=order, kind=kind, object_id=object_id, version=order.version)
+            for object_id in object_ids
+        ])
+        max_gap = getattr(settings, 'ORDER_CHANGES_MAX_GAP', 50)
+        cls.objects.filter(order=order, version__lte=order.version - max_gap).delete()
+
+
+class OrderEventLog(models.Model):
+    """
+    Protocol 2 events of one order broadcast (from_version -> version), kept for a bounded
+    window of versions so reconnecting WebSocket clients can replay what they missed
+    """
+    order = models.ForeignKey(CollectionOrder, on_delete=models.CASCADE, related_name='event_log')
+    from_version = models.PositiveIntegerField()
+    version = models.PositiveIntegerField()
+    events = models.JSONField()
+    created_at = models.DateTimeField(auto_now_add=True)
+    
+    class Meta:
+        ordering = ['version']
+        indexes = [
+            models.Index(fields=['order', 'version']),
+        ]
+    
+    def __str__(self):
+        return f"{self.order_id} - v{self.from_version} -> v{self.version}"
+    
+    @classmethod
+    def record(cls, order_id, from_version, version, events):
+        """Log a broadcast's events and prune entries older than ORDER_EVENT_LOG_WINDOW versions"""
+        cls.objects.create(order_id=order_id, from_version=from_version, version=version, events=events)
+        window = getattr(settings, 'ORDER_EVENT_LOG_WINDOW', 50)
+        cls.objects.filter(order_id=order_id, version__lte=version - window).delete()
+    
+    @classmethod
+    def replay(cls, order_id, after_version, current_version):
+        """
+        Logged (from_version, version, events) entries leading from `after_version` to
+        `current_version`, or None if the chain has a gap or left the window
+        """
+        entries = []
+        expected = after_version
+        for from_version, version, events in cls.objects.filter(
+            order_id=order_id, version__gt=after_version, version__lte=current_version
+        ).values_list('from_version', 'version', 'events'):
+            if from_version != expected:
+                return None
+            entries.append((from_version, version, events))
+            expected = version
+        return entries if expected == current_version else None
+
+
 class AuditLog(models.Model):
     """Audit log for order changes"""
     ACTION_CHOICES = [
@@ -230,6 +625,11 @@ class AuditLog(models.Model):
     
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            # Keyset pagination on (created_at, id), overall and per order
+            models.Index(fields=['-created_at', '-id']),
+            models.Index(fields=['order', '-created_at', '-id']),
+        ]
     
     def __str__(self):
         return f"{self.order.code} - {self.get_action_display()} by {self.user.username if self.user else 'System'}"
@@ -0,0 +1,97 @@
+"""
+On-commit broadcast outbox.
+
+Views only record which orders changed. Once the surrounding transaction commits, the
+broadcast is handed to a background thread that builds the snapshot and does the
+channel-layer group_send, so REST responses no longer wait on serialization or Redis,
+and rolled-back writes never broadcast. The deployment runs a single uvicorn process and
+no Celery worker, so the outbox is drained in-process.
+
+Broadcasts are coalesced per (handler, order id): everything queued within
+ORDER_BROADCAST_COALESCE_MS of the first request is sent as one broadcast of the latest
+state, since handlers read the order's current snapshot when they run.
+"""
+import heapq
+import itertools
+import logging
+import threading
+import time
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from .metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class BroadcastOutbox:
+    """Debounced (handler, order_id) jobs drained by a daemon thread started on first use"""
+
+    def __init__(self):
+        self._heap = []  # (due, seq, key)
+        self._pending = set()
+        self._seq = itertools.count()
+        self._unfinished = 0
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def put(self, handler, order_id):
+        metrics.incr('broadcasts_requested')
+        if getattr(settings, 'ORDER_BROADCAST_SYNC', False):
+            self._run_job(handler, order_id)
+            return
+        key = (handler, order_id)
+        with self._condition:
+            if key in self._pending:
+                # Already scheduled - that broadcast will carry this change too
+                metrics.incr('broadcasts_coalesced')
+                return
+            self._ensure_worker()
+            window = getattr(settings, 'ORDER_BROADCAST_COALESCE_MS', 150) / 1000
+            self._pending.add(key)
+            self._unfinished += 1
+            heapq.heappush(self._heap, (time.monotonic() + window, next(self._seq), key))
+            self._condition.notify()
+
+    def join(self):
+        """Block until every queued broadcast has been sent"""
+        with self._condition:
+            while self._unfinished:
+                self._condition.wait()
+
+    def _ensure_worker(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._drain, name='order-broadcast-outbox', daemon=True)
+            self._thread.start()
+
+    def _drain(self):
+        while True:
+            with self._condition:
+                while not self._heap or self._heap[0][0] > time.monotonic():
+                    self._condition.wait(self._heap[0][0] - time.monotonic() if self._heap else None)
+                _, _, key = heapq.heappop(self._heap)
+                # Changes committed from here on need a new broadcast
+                self._pending.discard(key)
+            try:
+                self._run_job(*key)
+            finally:
+                # The worker thread holds its own DB connection - don't let it go stale
+                close_old_connections()
+                with self._condition:
+                    self._unfinished -= 1
+                    self._condition.notify_all()
+
+    def _run_job(self, handler, order_id):
+        try:
+            handler(order_id)
+            metrics.incr('broadcasts_sent')
+        except Exception as e:
+            metrics.incr('broadcasts_failed')
+            logger.error(f"Error broadcasting order {order_id}: {e}", exc_info=True)
+
+
+outbox = BroadcastOutbox()
+
+
+def enqueue_broadcast(handler, order_id):
+    """Queue handler(order_id) to run on the outbox worker after the current transaction commits"""
+    transaction.on_commit(lambda: outbox.put(handler, order_id))
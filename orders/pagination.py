@@ -0,0 +1,46 @@
+"""
+Pagination classes for the high-volume list endpoints
+"""
+from rest_framework.pagination import BasePagination, CursorPagination, PageNumberPagination
+
+
+class CreatedAtCursorPagination(CursorPagination):
+    """
+    Keyset pagination on (created_at, id), newest first.
+    Pages are fetched with an indexed range scan - no COUNT(*) and no OFFSET.
+    """
+    ordering = ('-created_at', '-id')
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+
+
+class CursorOrPageNumberPagination(BasePagination):
+    """
+    Cursor pagination by default. Existing clients that pass ?page=N keep getting
+    page-number pagination (with count) from the same endpoint.
+    """
+    cursor_pagination_class = CreatedAtCursorPagination
+    page_number_pagination_class = PageNumberPagination
+    
+    def __init__(self):
+        self.paginator = self.cursor_pagination_class()
+    
+    def paginate_queryset(self, queryset, request, view=None):
+        if self.page_number_pagination_class.page_query_param in request.query_params:
+            self.paginator = self.page_number_pagination_class()
+            # Page numbers still need a stable order
+            queryset = queryset.order_by(*self.cursor_pagination_class.ordering)
+        return self.paginator.paginate_queryset(queryset, request, view)
+    
+    def get_paginated_response(self, data):
+        return self.paginator.get_paginated_response(data)
+    
+    def get_paginated_response_schema(self, schema):
+        return self.paginator.get_paginated_response_schema(schema)
+    
+    @property
+    def display_page_controls(self):
+        return getattr(self.paginator, 'display_page_controls', False)
+    
+    def to_html(self):
+        return self.paginator.to_html()
@@ -2,13 +2,12 @@ from rest_framework import serializers
 from django.contrib.auth.password_validation import validate_password
 from django.contrib.auth import authenticate
 from django.conf import settings
-from django.utils import timezone as tz
-from datetime import timedelta
 from .models import (
     User, Restaurant, Menu, MenuItem, CollectionOrder, 
     OrderItem, Payment, AuditLog, FeePreset, Recommendation
 )
 from .utils import format_item_name
+from .fee_split import FeeSplitError, parse_custom
 
 
 class OptionalUserField(serializers.PrimaryKeyRelatedField):
@@ -309,7 +308,7 @@ class CollectionOrderSerializer(serializers.ModelSerializer):
     payments = serializers.SerializerMethodField()
     total_items_cost = serializers.SerializerMethodField()
     total_cost = serializers.SerializerMethodField()
-    share_message = serializers.SerializerMethodField()
+    share_message = serializers.CharField(read_only=True)
     join_url = serializers.SerializerMethodField()
     restaurant = serializers.PrimaryKeyRelatedField(queryset=Restaurant.objects.all(), required=True)
     menu = serializers.PrimaryKeyRelatedField(queryset=Menu.objects.all(), required=False, allow_null=True)
@@ -323,25 +322,34 @@ class CollectionOrderSerializer(serializers.ModelSerializer):
         model = CollectionOrder
         fields = ['id', 'code', 'restaurant', 'restaurant_name', 'menu', 'menu_name', 'collector', 'collector_name', 'collector_instapay_link', 'collector_instapay_qr_code_url',
                   'status', 'cutoff_time', 'instapay_link', 'is_private', 'assigned_users', 'assigned_users_details',
-                  'delivery_fee', 'tip', 'service_fee', 'fee_split_rule', 'created_at', 'locked_at', 'ordered_at', 'closed_at',
+                  'delivery_fee', 'tip', 'service_fee', 'fee_split_rule', 'fee_split_custom', 'created_at', 'locked_at', 'ordered_at', 'closed_at',
                   'items', 'participants', 'payments', 'total_items_cost', 'total_cost', 
-                  'share_message', 'join_url']
-        read_only_fields = ['id', 'code', 'collector', 'created_at', 'locked_at', 'ordered_at', 'closed_at', 'assigned_users_details']
+                  'item_count', 'participant_count', 'share_message', 'join_url', 'version']
+        read_only_fields = ['id', 'code', 'collector', 'created_at', 'locked_at', 'ordered_at', 'closed_at', 'assigned_users_details',
+                            'item_count', 'participant_count', 'share_message', 'version']
+    
+    def validate_fee_split_custom(self, value):
+        try:
+            parse_custom(value)
+        except FeeSplitError as e:
+            raise serializers.ValidationError(str(e))
+        return value
     
     def get_assigned_users_details(self, obj):
         return [{'id': u.id, 'username': u.username, 'email': u.email} for u in obj.assigned_users.all()]
     
     def get_collector_instapay_qr_code_url(self, obj):
+        # Resolved against BACKEND_URL rather than the request, so order snapshots can be cached and shared
         if obj.collector.instapay_qr_code:
-            request = self.context.get('request')
-            if request:
-                return request.build_absolute_uri(obj.collector.instapay_qr_code.url)
-            return obj.collector.instapay_qr_code.url
+            backend_url = getattr(settings, 'BACKEND_URL', '')
+            return f"{backend_url}{obj.collector.instapay_qr_code.url}"
         return None
     
     def get_participants(self, obj):
-        participants = obj.get_participants()
-        return [{'id': p.id, 'username': p.username, 'email': p.email} for p in participants]
+        # Derived from the (prefetched) items instead of a separate distinct-users query
+        participants = {item.user_id: item.user for item in obj.items.all()}
+        return [{'id': p.id, 'username': p.username, 'email': p.email}
+                for _, p in sorted(participants.items())]
     
     def get_payments(self, obj):
         payments = obj.payments.all()
@@ -361,64 +369,41 @@ class CollectionOrderSerializer(serializers.ModelSerializer):
         return float(obj.get_total_cost())
     
     def get_join_url(self, obj):
-        request = self.context.get('request')
-        # Prefer request host over FRONTEND_URL to get actual host
-        if request:
-            scheme = request.scheme
-            host = request.get_host()
-            # Replace backend port with frontend port if needed
-            if ':19992' in host:
-                host = host.replace(':19992', ':19991')
-            elif ':8000' in host:
-                host = host.replace(':8000', ':19991')
-            # Always use request host, even if it's localhost (for development)
-            # In production, this will be the actual domain
-            if host:
-                return f"{scheme}://{host}/join/{obj.code}"
-        
-        # Fallback to FRONTEND_URL if no request available
-        frontend_url = getattr(settings, 'FRONTEND_URL', None)
-        if frontend_url:
-            return f"{frontend_url}/join/{obj.code}"
-        
-        return f'/join/{obj.code}'
-    
-    def get_share_message(self, obj):
-        request = self.context.get('request')
-        # Format cutoff time in GMT+2 (Egypt timezone)
-        if obj.cutoff_time:
-            utc_time = obj.cutoff_time
-            if tz.is_aware(utc_time):
-                # Convert to Egypt timezone (GMT+2)
-                try:
-                    import pytz
-                    egypt_tz = pytz.timezone('Africa/Cairo')
-                    cutoff_local = utc_time.astimezone(egypt_tz)
-                    cutoff_str = cutoff_local.strftime('%I:%M %p')
-                except (ImportError, Exception):
-                    # Fallback: add 2 hours manually if pytz not available
-                    cutoff_local = utc_time + timedelta(hours=2)
-                    cutoff_str = cutoff_local.strftime('%I:%M %p')
-            else:
-                # If naive, assume it's UTC and add 2 hours
-                cutoff_local = utc_time + timedelta(hours=2)
-                cutoff_str = cutoff_local.strftime('%I:%M %p')
-        else:
-            cutoff_str = 'N/A'
-        
-        join_url = self.get_join_url(obj)
-        message = (f"🍽️ OrderQ: Order from {obj.restaurant.name}\n"
-                  f"📋 Join code: {obj.code}\n"
-                  f"⏰ Cutoff: {cutoff_str}\n"
-                  f"🔗 Add your items here: {join_url}\n"
-                  f"👤 Collector: {obj.collector.username}")
-        
-        # Add assigned users info if any
-        if obj.assigned_users.exists():
-            assigned_names = ', '.join([u.username for u in obj.assigned_users.all()])
-            message += f"\n👥 Assigned to: {assigned_names}"
-        
-        return message
+        # Built from FRONTEND_URL rather than the request, so order snapshots can be cached and shared
+        return obj.get_join_url()
+
+
+class CollectionOrderChangesSerializer(CollectionOrderSerializer):
+    """
+    Order fields for the change feed. Expects an order loaded with
+    CollectionOrderQuerySet.with_changes_since(), so items and payments only hold changed rows.
+    """
+    class Meta(CollectionOrderSerializer.Meta):
+        fields = ['id', 'code', 'restaurant', 'restaurant_name', 'menu', 'menu_name', 'collector', 'collector_name',
+                  'collector_instapay_link', 'collector_instapay_qr_code_url',
+                  'status', 'cutoff_time', 'instapay_link', 'is_private', 'assigned_users', 'assigned_users_details',
+                  'delivery_fee', 'tip', 'service_fee', 'fee_split_rule', 'fee_split_custom', 'created_at', 'locked_at', 'ordered_at', 'closed_at',
+                  'items', 'payments', 'total_items_cost', 'total_cost', 'item_count', 'participant_count',
+                  'share_message', 'join_url', 'version']
+
+
+class CollectionOrderSummarySerializer(serializers.Serializer):
+    """Slim read-only order representation for list views, built from CollectionOrderQuerySet.summary() rows"""
+    id = serializers.IntegerField(read_only=True)
+    code = serializers.CharField(read_only=True)
+    restaurant = serializers.IntegerField(source='restaurant_id', read_only=True)
+    restaurant_name = serializers.CharField(read_only=True)
+    collector = serializers.IntegerField(source='collector_id', read_only=True)
+    collector_name = serializers.CharField(read_only=True)
+    status = serializers.CharField(read_only=True)
+    cutoff_time = serializers.DateTimeField(read_only=True)
+    is_private = serializers.BooleanField(read_only=True)
+    created_at = serializers.DateTimeField(read_only=True)
+    item_count = serializers.IntegerField(read_only=True)
+    participant_count = serializers.IntegerField(read_only=True)
+    total_items_cost = serializers.FloatField(read_only=True)
+    total_cost = serializers.FloatField(read_only=True)
+    version = serializers.IntegerField(read_only=True)
 
 
 class PaymentSerializer(serializers.ModelSerializer):
@@ -0,0 +1,94 @@
+"""
+Live per-participant shares of an order.
+
+Shares are what each participant would pay if the order were locked now: their running
+item total (ParticipantTotal, kept current on every item change) plus their fee share
+under the order's split rule (see orders/fee_split.py). Reading them costs one query
+however many items the order has, and lock freezes the same amounts into Payment rows.
+"""
+from decimal import Decimal
+from .fee_split import FeeSplitError, split_fees
+from .models import CollectionOrder, ParticipantTotal
+
+
+def participant_totals(order_id, version=None):
+    """
+    User id -> (username, running item total) of the order's participants. With a
+    `version`, None once the order has moved past it - the totals are read in the same
+    query as the version check, so they always belong to that version.
+    """
+    rows = ParticipantTotal.objects.filter(order_id=order_id)
+    if version is not None:
+        rows = rows.filter(order__version=version)
+    totals = {
+        user_id: (username, items_total)
+        for user_id, username, items_total in rows.values_list('user_id', 'user__username', 'items_total')
+    }
+    if not totals and version is not None and not CollectionOrder.objects.filter(pk=order_id, version=version).exists():
+        return None
+    return totals
+
+
+def compute_shares(totals, fees, rule, collector_id, collector_name, custom):
+    """Share rows [{user, user_name, items_total, fee_share, amount}] in user id order"""
+    items_totals = {user_id: items_total for user_id, (_, items_total) in totals.items()}
+    fee_shares = split_fees(items_totals, fees, rule, collector_id, custom)
+    rows = []
+    for user_id, fee_share in sorted(fee_shares.items()):
+        username, items_total = totals.get(user_id, (collector_name, Decimal('0')))
+        rows.append({
+            'user': user_id,
+            'user_name': username,
+            'items_total': float(items_total),
+            'fee_share': float(fee_share),
+            'amount': float(items_total + fee_share),
+        })
+    return rows
+
+
+def shares_payload(order_id, version, fees, rule, collector_id, collector_name, custom, totals=None):
+    """
+    {order_id, version, fee_split_rule, shares}, from `totals` or the current participant
+    totals; raises FeeSplitError when the order's custom split doesn't fit its fees
+    """
+    if totals is None:
+        totals = participant_totals(order_id)
+    return {
+        'order_id': order_id,
+        'version': version,
+        'fee_split_rule': rule,
+        'shares': compute_shares(totals, fees, rule, collector_id, collector_name, custom),
+    }
+
+
+def order_shares(order):
+    """Current shares of an order instance"""
+    return shares_payload(
+        order.pk, order.version, order.delivery_fee + order.tip + order.service_fee,
+        order.fee_split_rule, order.collector_id, order.collector.username, order.fee_split_custom
+    )
+
+
+def snapshot_shares(order_data):
+    """
+    Shares for an order snapshot, with the participant totals of the snapshot's version;
+    None when the order has already moved on (its own broadcast carries the shares).
+    A split the engine rejects is reported as an `error` with no shares instead of raising.
+    """
+    totals = participant_totals(order_data['id'], order_data['version'])
+    if totals is None:
+        return None
+    fees = sum(Decimal(str(order_data[field])) for field in ('delivery_fee', 'tip', 'service_fee'))
+    try:
+        return shares_payload(
+            order_data['id'], order_data['version'], fees, order_data['fee_split_rule'],
+            order_data['collector'], order_data['collector_name'], order_data['fee_split_custom'], totals
+        )
+    except FeeSplitError as e:
+        return {
+            'order_id': order_data['id'],
+            'version': order_data['version'],
+            'fee_split_rule': order_data['fee_split_rule'],
+            'shares': [],
+            'error': str(e),
+        }
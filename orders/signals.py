@@ -0,0 +1,125 @@
+"""
+Signal handlers for the orders app
+"""
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.models import Q
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from .authentication import clear_auth_state, store_auth_state
+from .middleware import principal_cache
+from .models import CollectionOrder, Menu, MenuItem, OrderItem, ParticipantTotal, Payment, Restaurant
+from .outbox import enqueue_broadcast
+from .snapshots import bump_order_versions
+from .websocket_utils import send_order_update
+
+User = get_user_model()
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidate_user_principal(sender, instance, **kwargs):
+    """Role or active-state changes must not be served from the WebSocket principal cache"""
+    principal_cache.discard(instance.pk)
+
+
+@receiver(post_save, sender=User)
+def publish_auth_state(sender, instance, update_fields=None, **kwargs):
+    """
+    Let REST token checks see auth_version/is_active changes without a user load, once
+    they commit - a rolled-back change must not be published
+    """
+    if update_fields is None or {'auth_version', 'is_active'} & set(update_fields):
+        transaction.on_commit(lambda: store_auth_state(instance))
+
+
+@receiver(post_delete, sender=User)
+def clear_deleted_auth_state(sender, instance, **kwargs):
+    """A deleted user's tokens must stop authenticating once the delete commits"""
+    user_id = instance.pk
+    transaction.on_commit(lambda: clear_auth_state(user_id))
+
+
+@receiver(post_save, sender=OrderItem)
+def record_item_share(sender, instance, created, raw=False, **kwargs):
+    """
+    Keep the owner's running participant total current on every item save - API, admin or
+    script - so share previews and lock read ParticipantTotal as-is
+    """
+    if raw:
+        return
+    with transaction.atomic():
+        CollectionOrder.objects.select_for_update().only('pk').get(pk=instance.order_id)
+        if created:
+            ParticipantTotal.record(instance.order_id, instance.user_id, instance.total_price, 1)
+        elif instance.previous_share is None:
+            # Saved from an instance that wasn't loaded with its owner and total
+            ParticipantTotal.rebuild(instance.order_id)
+        else:
+            ParticipantTotal.record_item_change(instance, *instance.previous_share)
+
+
+@receiver(post_delete, sender=OrderItem)
+def remove_item_share(sender, instance, origin=None, **kwargs):
+    """Take a deleted item out of its owner's running participant total"""
+    if not (isinstance(origin, OrderItem) or getattr(origin, 'model', None) is OrderItem):
+        return  # Deleting the order or the user cascades to their running totals as well
+    with transaction.atomic():
+        CollectionOrder.objects.select_for_update().only('pk').get(pk=instance.order_id)
+        ParticipantTotal.record(instance.order_id, instance.user_id, -instance.total_price, -1)
+
+
+def orders_showing_q(instance):
+    """Orders whose snapshots copy fields of a user, restaurant, menu or menu item"""
+    if isinstance(instance, Restaurant):
+        return Q(restaurant=instance)
+    if isinstance(instance, Menu):
+        return Q(menu=instance)
+    if isinstance(instance, MenuItem):
+        return Q(id__in=OrderItem.objects.filter(menu_item=instance).values('order'))
+    return (
+        Q(collector=instance) |
+        Q(assigned_users=instance) |
+        Q(id__in=OrderItem.objects.filter(user=instance).values('order')) |
+        Q(id__in=Payment.objects.filter(user=instance).values('order'))
+    )
+
+
+def orders_sharing_q(instance):
+    """Orders whose stored share message names a restaurant or user (collector or assignee)"""
+    if isinstance(instance, Restaurant):
+        return Q(restaurant=instance)
+    return Q(collector=instance) | Q(assigned_users=instance)
+
+
+def rows_showing(instance):
+    """Item and payment querysets whose rows copy fields of a user or menu item"""
+    if isinstance(instance, MenuItem):
+        return [OrderItem.objects.filter(menu_item=instance)]
+    if isinstance(instance, User):
+        return [OrderItem.objects.filter(user=instance), Payment.objects.filter(user=instance)]
+    return []
+
+
+@receiver(post_save, sender=User)
+@receiver(post_save, sender=Restaurant)
+@receiver(post_save, sender=Menu)
+@receiver(post_save, sender=MenuItem)
+def refresh_orders_showing(sender, instance, created=False, **kwargs):
+    """
+    New versions (and broadcasts) for the orders showing a renamed row or a changed payment
+    link. Closed orders are final and keep the values they closed with, so a profile edit
+    costs the user's live orders, not their whole history.
+    """
+    changed = getattr(instance, 'changed_snapshot_fields', set())
+    if created or not changed:
+        return
+    live_orders = CollectionOrder.objects.exclude(status='CLOSED')
+    if isinstance(instance, (User, Restaurant)) and {'username', 'name'} & changed:
+        # The stored share message names the restaurant, the collector and the assignees
+        sharing = live_orders.filter(orders_sharing_q(instance)).distinct()
+        for order in sharing.select_related('restaurant', 'collector').prefetch_related('assigned_users'):
+            order.refresh_share_message()
+    orders = live_orders.filter(orders_showing_q(instance))
+    for order_id in bump_order_versions(orders, rows_showing(instance)):
+        enqueue_broadcast(send_order_update, order_id)
@@ -0,0 +1,146 @@
+"""
+Shared serialized-order snapshots.
+
+A snapshot is the CollectionOrderSerializer output for one (order id, version). It is built
+once per version and kept in a small in-process LRU and in the shared Django cache (Redis),
+so REST responses and WebSocket broadcasts for the same version reuse one serialization.
+Snapshots are request-independent: URLs are resolved against FRONTEND_URL/BACKEND_URL.
+Both tiers expire after ORDER_SNAPSHOT_TTL seconds; edits to the users, restaurants and
+menus an order shows move the order to a new version (see bump_order_versions).
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import F, OuterRef, Subquery
+from .models import CollectionOrder
+from .serializers import CollectionOrderSerializer
+
+logger = logging.getLogger(__name__)
+
+
+class SnapshotLRU:
+    """
+    Bounded, thread-safe map of order id -> (version, snapshot), least recently used evicted
+    first. With a `ttl` (seconds), entries older than that are treated as missing.
+    """
+
+    def __init__(self, max_size, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()  # order id -> (version, snapshot, stored at)
+        self._lock = threading.Lock()
+
+    def _entry(self, order_id):
+        entry = self._entries.get(order_id)
+        if entry is not None and self.ttl is not None and time.monotonic() - entry[2] > self.ttl:
+            del self._entries[order_id]
+            return None
+        return entry
+
+    def get(self, order_id, version):
+        with self._lock:
+            entry = self._entry(order_id)
+            if entry is None or entry[0] != version:
+                return None
+            self._entries.move_to_end(order_id)
+            return entry[1]
+
+    def latest(self, order_id):
+        """(version, snapshot) of the newest entry for the order, or None"""
+        with self._lock:
+            entry = self._entry(order_id)
+            return entry[:2] if entry is not None else None
+
+    def set(self, order_id, version, data):
+        with self._lock:
+            entry = self._entry(order_id)
+            if entry is not None and entry[0] > version:
+                return  # Never replace a newer snapshot with an older one
+            self._entries[order_id] = (version, data, time.monotonic())
+            self._entries.move_to_end(order_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def discard(self, order_id):
+        with self._lock:
+            self._entries.pop(order_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+local_snapshots = SnapshotLRU(getattr(settings, 'ORDER_SNAPSHOT_LRU_SIZE', 256), getattr(settings, 'ORDER_SNAPSHOT_TTL', 600))
+
+
+def snapshot_cache_key(order_id, version):
+    return f'order-snapshot:{order_id}:{version}'
+
+
+def get_order_snapshot(order_id, version=None):
+    """
+    Serialized order for `version` (the current version if None).
+    Returns None if the order doesn't exist.
+    """
+    if version is None:
+        version = CollectionOrder.objects.filter(pk=order_id).values_list('version', flat=True).first()
+        if version is None:
+            return None
+
+    data = local_snapshots.get(order_id, version)
+    if data is not None:
+        return data
+
+    key = snapshot_cache_key(order_id, version)
+    try:
+        data = cache.get(key)
+    except Exception as e:
+        # The shared cache is an optimization - fall back to serializing
+        logger.warning(f"Order snapshot cache unavailable: {e}")
+        data = None
+
+    if data is None:
+        order = CollectionOrder.objects.with_related().filter(pk=order_id).first()
+        if order is None:
+            return None
+        # The order may have moved on since `version` was read - store under what was serialized
+        version = order.version
+        data = CollectionOrderSerializer(order).data
+        try:
+            cache.set(snapshot_cache_key(order_id, version), data, getattr(settings, 'ORDER_SNAPSHOT_TTL', 600))
+        except Exception as e:
+            logger.warning(f"Order snapshot cache unavailable: {e}")
+
+    local_snapshots.set(order_id, version, data)
+    return data
+
+
+def invalidate_order_snapshot(order_id, version):
+    """Drop cached snapshots of an order whose version just moved past `version`"""
+    local_snapshots.discard(order_id)
+    try:
+        cache.delete(snapshot_cache_key(order_id, version))
+    except Exception as e:
+        logger.warning(f"Order snapshot cache unavailable: {e}")
+
+
+def bump_order_versions(orders, rows=()):
+    """
+    Move every order of the queryset to a new version and drop their cached snapshots, for
+    changes to related rows a snapshot copies (user names, payment links, restaurant and
+    menu item names). `rows` are item/payment querysets showing the changed fields - they
+    get the new version as changed_version, so the change feed returns them.
+    Returns the ids of the orders bumped.
+    """
+    versions = dict(orders.order_by().values_list('id', 'version').distinct())
+    if versions:
+        CollectionOrder.objects.filter(id__in=versions).update(version=F('version') + 1)
+        new_version = Subquery(CollectionOrder.objects.filter(pk=OuterRef('order_id')).values('version')[:1])
+        for queryset in rows:
+            queryset.filter(order_id__in=versions).update(changed_version=new_version)
+        for order_id, version in versions.items():
+            invalidate_order_snapshot(order_id, version)
+    return list(versions)
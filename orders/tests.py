@@ -1,3 +1,1431 @@
-from django.test import TestCase
+import asyncio
+import json
+import random
+from datetime import datetime
+from decimal import Decimal
+from io import StringIO
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import IntegrityError, connection, transaction
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from unittest import mock
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.exceptions import InvalidToken
+from rest_framework_simplejwt.tokens import AccessToken, RefreshToken
+from .authentication import IdentityRefreshToken, get_auth_state
+from .balances import balance_deltas, bump_balance_versions
+from .consumers import OrderConsumer, StreamConsumer
+from .models import User, Restaurant, Menu, MenuItem, CollectionOrder, OrderItem, Payment, OrderEventLog, ParticipantTotal
+from .deltas import order_events
+from .fee_split import FeeSplitError, allocate, parse_custom, payment_amounts, split_fees
+from .metrics import metrics
+from .shares import snapshot_shares
+from .middleware import JWTAuthMiddleware, principal_cache
+from .outbox import BroadcastOutbox
+from .snapshots import SnapshotLRU, local_snapshots, get_order_snapshot
+from .utils import render_share_message
+from .views import CollectionOrderViewSet
+from .frames import order_frames, build_order_frames, encode_order
+from .websocket_utils import (
+    broadcast_history, send_new_order, send_order_update, new_order_groups, notification_groups, user_group,
+    PUBLIC_ORDERS_GROUP, STAFF_ORDERS_GROUP
+)
 
-# Create your tests here.
+
+class EmptyCachesMixin:
+    """Order ids can be reused between tests, so start from empty snapshot caches"""
+
+    def setUp(self):
+        local_snapshots.clear()
+        broadcast_history.clear()
+        order_frames.clear()
+        cache.clear()
+
+
+class OrderTestCase(EmptyCachesMixin, TestCase):
+    """Base test case"""
+
+
+class ConsumerTestCase(EmptyCachesMixin, TransactionTestCase):
+    """
+    Base test case for code reaching the database through database_sync_to_async, which
+    closes old connections around each call - fatal to a TestCase's wrapping transaction
+    """
+
+
+class OrderListQueryCountTests(OrderTestCase):
+    """The orders list must not issue extra queries per order on the page"""
+
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create(username='viewer')
+        self.restaurant = Restaurant.objects.create(name='Koshary Place')
+        self.menu = Menu.objects.create(restaurant=self.restaurant, name='Main Menu')
+        self.menu_item = MenuItem.objects.create(menu=self.menu, name='Koshary', price=50)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def create_orders(self, count):
+        for i in range(count):
+            collector = User.objects.create(username=f'collector{CollectionOrder.objects.count()}')
+            participant = User.objects.create(username=f'participant{CollectionOrder.objects.count()}')
+            order = CollectionOrder.objects.create(restaurant=self.restaurant, menu=self.menu, collector=collector)
+            order.assigned_users.set([collector, participant, self.user])
+            for user in (collector, participant):
+                OrderItem.objects.create(order=order, user=user, menu_item=self.menu_item, quantity=1, unit_price=50)
+                OrderItem.objects.create(order=order, user=user, custom_name='Extra Bread', quantity=2, unit_price=5)
+                Payment.objects.create(order=order, user=user, amount=60)
+            order.refresh_totals()
+            order.refresh_share_message()
+
+    def count_list_queries(self):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get('/api/orders/')
+        self.assertEqual(response.status_code, 200)
+        return len(ctx.captured_queries), response.data
+
+    def test_list_query_count_does_not_grow_with_page_size(self):
+        self.create_orders(2)
+        small_page_queries, small_page = self.count_list_queries()
+        self.assertEqual(len(small_page['results']), 2)
+
+        self.create_orders(8)
+        large_page_queries, large_page = self.count_list_queries()
+        self.assertEqual(len(large_page['results']), 10)
+
+        self.assertEqual(small_page_queries, large_page_queries)
+
+    def test_list_reads_prefetched_relations(self):
+        self.create_orders(1)
+        _, data = self.count_list_queries()
+        order = data['results'][0]
+        self.assertEqual(len(order['items']), 4)
+        self.assertEqual(len(order['payments']), 2)
+        self.assertEqual(len(order['participants']), 2)
+        self.assertEqual(len(order['assigned_users_details']), 3)
+        self.assertEqual(order['total_items_cost'], 120.0)
+        self.assertIn('Assigned to:', order['share_message'])
+
+    def test_summary_view_uses_single_query_per_page(self):
+        self.create_orders(3)
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get('/api/orders/', {'view': 'summary'})
+        self.assertEqual(response.status_code, 200)
+        # One flat keyset SELECT for the page - no COUNT(*)
+        self.assertEqual(len(ctx.captured_queries), 1)
+        order = response.data['results'][0]
+        self.assertNotIn('items', order)
+        self.assertEqual(order['item_count'], 4)
+        self.assertEqual(order['participant_count'], 2)
+        self.assertEqual(order['restaurant_name'], 'Koshary Place')
+        self.assertEqual(order['total_cost'], 180.0)
+
+    def test_cursor_pagination_with_page_number_opt_in(self):
+        self.create_orders(3)
+        response = self.client.get('/api/orders/', {'view': 'summary', 'page_size': 2})
+        self.assertNotIn('count', response.data)
+        self.assertEqual(len(response.data['results']), 2)
+        next_page = self.client.get(response.data['next'])
+        self.assertEqual(len(next_page.data['results']), 1)
+        seen = [o['id'] for o in response.data['results'] + next_page.data['results']]
+        self.assertEqual(seen, sorted(seen, reverse=True))
+
+        response = self.client.get('/api/orders/', {'view': 'summary', 'page': 1})
+        self.assertEqual(response.data['count'], 3)
+
+
+class OrderTotalsTests(OrderTestCase):
+    """Denormalized order totals follow every item change and recompute_order_totals repairs drift"""
+
+    def setUp(self):
+        super().setUp()
+        self.collector = User.objects.create(username='collector')
+        self.member = User.objects.create(username='member')
+        self.order = CollectionOrder.objects.create(restaurant=Restaurant.objects.create(name='Fish Market'), collector=self.collector)
+        self.client = APIClient()
+        self.client.force_authenticate(self.collector)
+
+    def totals(self):
+        self.order.refresh_from_db()
+        return (self.order.items_total, self.order.item_count, self.order.participant_count)
+
+    def test_item_changes_update_totals(self):
+        first = self.client.post('/api/order-items/', {'order': self.order.id, 'custom_name': 'Sardines', 'custom_price': '40.00'}, format='json').data
+        self.client.post('/api/order-items/', {'order': self.order.id, 'custom_name': 'Rice', 'custom_price': '15.00'}, format='json')
+        self.assertEqual(self.totals(), (Decimal('55.00'), 2, 1))
+
+        response = self.client.patch(f"/api/order-items/{first['id']}/", {'user': self.member.id, 'custom_name': 'Sardines', 'custom_price': '40.00'}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.totals(), (Decimal('55.00'), 2, 2))
+
+        self.client.delete(f"/api/order-items/{first['id']}/")
+        self.assertEqual(self.totals(), (Decimal('15.00'), 1, 1))
+
+    def test_assignment_items_update_totals(self):
+        response = self.client.patch(f'/api/orders/{self.order.id}/', {
+            'assigned_users': [self.collector.id, self.member.id], 'assignment_items': 2, 'assignment_total_cost': '100.00',
+        }, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.totals(), (Decimal('100.00'), 4, 2))
+
+    def test_recompute_repairs_drifted_order_totals(self):
+        OrderItem.objects.create(order=self.order, user=self.member, custom_name='Shrimp', quantity=2, unit_price=60)
+        self.order.refresh_totals()
+        CollectionOrder.objects.filter(pk=self.order.pk).update(items_total=5, item_count=9, participant_count=3)
+
+        out = StringIO()
+        call_command('recompute_order_totals', '--dry-run', stdout=out)
+        self.assertIn(f'Order {self.order.code}: stored', out.getvalue())
+        self.assertEqual(self.totals(), (Decimal('5.00'), 9, 3))
+
+        etag = self.client.get(f'/api/orders/{self.order.id}/')['ETag']
+        call_command('recompute_order_totals', stdout=StringIO())
+        self.assertEqual(self.totals(), (Decimal('120.00'), 1, 1))
+        # The repair moves the order to a new version - no stale snapshot or 304
+        response = self.client.get(f'/api/orders/{self.order.id}/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['total_items_cost'], 120.0)
+
+
+class OrderVisibilityTests(OrderTestCase):
+    """Private orders are only visible to their collector, participants, assignees and managers"""
+
+    def setUp(self):
+        super().setUp()
+        self.restaurant = Restaurant.objects.create(name='Pizza Corner')
+        self.collector = User.objects.create(username='collector')
+        self.participant = User.objects.create(username='participant')
+        self.assignee = User.objects.create(username='assignee')
+        self.outsider = User.objects.create(username='outsider')
+        self.manager = User.objects.create(username='manager', role='manager')
+        self.public_order = CollectionOrder.objects.create(restaurant=self.restaurant, collector=self.collector)
+        self.private_order = CollectionOrder.objects.create(restaurant=self.restaurant, collector=self.collector, is_private=True)
+        self.private_order.assigned_users.set([self.assignee])
+        OrderItem.objects.create(order=self.private_order, user=self.participant, custom_name='Margherita', quantity=1, unit_price=120)
+        OrderItem.objects.create(order=self.private_order, user=self.assignee, custom_name='Pepperoni', quantity=1, unit_price=140)
+
+    def visible_order_ids(self, user):
+        client = APIClient()
+        client.force_authenticate(user)
+        response = client.get('/api/orders/', {'view': 'summary'})
+        return {order['id'] for order in response.data['results']}
+
+    def test_private_order_visibility(self):
+        both = {self.public_order.id, self.private_order.id}
+        self.assertEqual(self.visible_order_ids(self.collector), both)
+        self.assertEqual(self.visible_order_ids(self.participant), both)
+        self.assertEqual(self.visible_order_ids(self.assignee), both)
+        self.assertEqual(self.visible_order_ids(self.manager), both)
+        self.assertEqual(self.visible_order_ids(self.outsider), {self.public_order.id})
+
+    def test_items_follow_order_visibility(self):
+        client = APIClient()
+        client.force_authenticate(self.outsider)
+        response = client.get('/api/order-items/', {'order': self.private_order.id})
+        self.assertEqual(response.data['results'], [])
+
+    def test_outsider_cannot_write_public_order_rows(self):
+        item = OrderItem.objects.create(order=self.public_order, user=self.participant, custom_name='Calzone', quantity=1, unit_price=100)
+        payment = Payment.objects.create(order=self.public_order, user=self.participant, amount=100)
+        client = APIClient()
+        client.force_authenticate(self.outsider)
+        # Public rows are readable by everyone...
+        self.assertEqual(client.get(f'/api/order-items/{item.id}/').status_code, 200)
+        self.assertEqual(client.get(f'/api/payments/{payment.id}/').status_code, 200)
+        # ...but only the order's collector and members may change them
+        self.assertEqual(client.patch(f'/api/payments/{payment.id}/', {'amount': '1.00', 'is_paid': True}, format='json').status_code, 404)
+        self.assertEqual(client.post(f'/api/payments/{payment.id}/mark_paid/').status_code, 404)
+        self.assertEqual(client.delete(f'/api/payments/{payment.id}/').status_code, 404)
+        self.assertEqual(client.patch(f'/api/order-items/{item.id}/', {'custom_name': 'Free', 'custom_price': '1.00'}, format='json').status_code, 404)
+        self.assertEqual(client.delete(f'/api/order-items/{item.id}/').status_code, 404)
+        payment.refresh_from_db()
+        self.assertEqual((payment.amount, payment.is_paid), (100, False))
+        self.assertTrue(OrderItem.objects.filter(pk=item.id).exists())
+
+        client.force_authenticate(self.collector)
+        self.assertEqual(client.patch(f'/api/payments/{payment.id}/', {'amount': '90.00'}, format='json').status_code, 200)
+
+
+class OrderConsumerConnectTests(ConsumerTestCase):
+    """OrderConsumer.connect applies the orders visibility rule"""
+
+    def setUp(self):
+        super().setUp()
+        restaurant = Restaurant.objects.create(name='Pizza Corner')
+        collector = User.objects.create(username='collector')
+        self.participant = User.objects.create(username='participant')
+        self.outsider = User.objects.create(username='outsider')
+        self.manager = User.objects.create(username='manager', role='manager')
+        self.private_order = CollectionOrder.objects.create(restaurant=restaurant, collector=collector, is_private=True)
+        OrderItem.objects.create(order=self.private_order, user=self.participant, custom_name='Margherita', quantity=1, unit_price=120)
+
+    def test_websocket_connect_checks_access_in_one_query(self):
+        get_connect_frames = async_to_sync(OrderConsumer().get_connect_frames)
+        get_order_snapshot(self.private_order.id)
+        with CaptureQueriesContext(connection) as ctx:
+            version, frames = get_connect_frames(self.private_order.id, self.participant)
+        # Access and version in one query - the snapshot comes from the cache
+        self.assertEqual(len(ctx.captured_queries), 1)
+        self.assertEqual(json.loads(frames[0])['order']['id'], self.private_order.id)
+        self.assertIsNone(get_connect_frames(self.private_order.id, self.outsider))
+        self.assertIsNotNone(get_connect_frames(self.private_order.id, self.manager))
+
+
+class OrderVersionTests(OrderTestCase):
+    """Every mutation bumps the order version, and reads honour If-None-Match"""
+
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create(username='collector')
+        self.restaurant = Restaurant.objects.create(name='Burger Lab')
+        self.order = CollectionOrder.objects.create(restaurant=self.restaurant, collector=self.user)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def current_version(self):
+        self.order.refresh_from_db()
+        return self.order.version
+
+    def test_mutations_bump_version(self):
+        versions = [self.current_version()]
+        response = self.client.post('/api/order-items/', {'order': self.order.id, 'custom_name': 'Cheeseburger', 'custom_price': '95.00'}, format='json')
+        item_id = response.data['id']
+        versions.append(self.current_version())
+        self.client.patch(f'/api/order-items/{item_id}/', {'user': self.user.id, 'custom_name': 'Cheeseburger', 'custom_price': '95.00', 'note': 'No onions'}, format='json')
+        versions.append(self.current_version())
+        self.client.patch(f'/api/orders/{self.order.id}/', {'tip': '10.00'}, format='json')
+        versions.append(self.current_version())
+        self.client.post(f'/api/orders/{self.order.id}/lock/')
+        versions.append(self.current_version())
+        self.client.post(f'/api/orders/{self.order.id}/unlock/')
+        versions.append(self.current_version())
+        self.client.delete(f'/api/order-items/{item_id}/')
+        versions.append(self.current_version())
+        self.assertEqual(versions, sorted(set(versions)))
+
+    def test_payment_writes_bump_version(self):
+        versions = [self.current_version()]
+        response = self.client.post('/api/payments/', {'order': self.order.id, 'user': self.user.id, 'amount': '50.00'}, format='json')
+        self.assertEqual(response.status_code, 201)
+        versions.append(self.current_version())
+        self.client.patch(f"/api/payments/{response.data['id']}/", {'amount': '60.00'}, format='json')
+        versions.append(self.current_version())
+        self.client.delete(f"/api/payments/{response.data['id']}/")
+        versions.append(self.current_version())
+        self.assertEqual(versions, sorted(set(versions)))
+        self.assertEqual(list(self.order.tombstones.values_list('kind', 'object_id')), [('payment', response.data['id'])])
+
+    def test_related_renames_refresh_snapshot(self):
+        participant = User.objects.create(username='alice')
+        menu_item = MenuItem.objects.create(menu=Menu.objects.create(restaurant=self.restaurant, name='Main'), name='Burger', price=Decimal('90.00'))
+        OrderItem.objects.create(order=self.order, user=participant, menu_item=menu_item, unit_price=Decimal('90.00'))
+        version = self.current_version()
+        self.assertEqual(get_order_snapshot(self.order.id, version)['restaurant_name'], 'Burger Lab')
+
+        self.restaurant.name = 'Burger Lab 2'
+        self.restaurant.save()
+        participant.username = 'alice2'
+        participant.save()
+        menu_item.name = 'Double Burger'
+        menu_item.save()
+        self.assertEqual(self.current_version(), version + 3)
+        snapshot = get_order_snapshot(self.order.id, self.order.version)
+        self.assertEqual(snapshot['restaurant_name'], 'Burger Lab 2')
+        self.assertEqual(snapshot['items'][0]['user_name'], 'alice2')
+        self.assertEqual(snapshot['items'][0]['item_name'], 'Double Burger')
+
+        # Fields no snapshot shows leave the orders alone
+        participant.last_login = timezone.now()
+        participant.save(update_fields=['last_login'])
+        menu_item.price = Decimal('95.00')
+        menu_item.save()
+        self.assertEqual(self.current_version(), version + 3)
+
+    def test_profile_edits_leave_closed_orders_alone(self):
+        participant = User.objects.create(username='alice')
+        closed = CollectionOrder.objects.create(restaurant=self.restaurant, collector=self.user, status='CLOSED')
+        old_item = OrderItem.objects.create(order=closed, user=participant, custom_name='Fries', unit_price=Decimal('30.00'))
+        OrderItem.objects.create(order=self.order, user=participant, custom_name='Fries', unit_price=Decimal('30.00'))
+        closed_version, version = CollectionOrder.objects.get(pk=closed.pk).version, self.current_version()
+
+        participant.instapay_link = 'https://ipn.eg/alice'
+        participant.save()
+        self.assertEqual(self.current_version(), version + 1)
+        self.assertEqual(CollectionOrder.objects.get(pk=closed.pk).version, closed_version)
+        self.assertEqual(OrderItem.objects.get(pk=old_item.pk).changed_version, old_item.changed_version)
+
+    def test_renames_reach_the_change_feed(self):
+        participant = User.objects.create(username='alice')
+        menu_item = MenuItem.objects.create(menu=Menu.objects.create(restaurant=self.restaurant, name='Main'), name='Burger', price=Decimal('90.00'))
+        item = OrderItem.objects.create(order=self.order, user=participant, menu_item=menu_item, unit_price=Decimal('90.00'))
+        other = OrderItem.objects.create(order=self.order, user=self.user, custom_name='Fries', unit_price=Decimal('30.00'))
+        payment = Payment.objects.create(order=self.order, user=participant, amount=Decimal('90.00'))
+
+        since = self.current_version()
+        menu_item.name = 'Double Burger'
+        menu_item.save()
+        response = self.client.get(f'/api/orders/{self.order.id}/changes/', {'since': since})
+        self.assertFalse(response.data['snapshot'])
+        self.assertEqual([(row['id'], row['item_name']) for row in response.data['order']['items']], [(item.id, 'Double Burger')])
+        self.assertEqual(response.data['order']['payments'], [])
+
+        since = self.current_version()
+        participant.username = 'alice2'
+        participant.save()
+        response = self.client.get(f'/api/orders/{self.order.id}/changes/', {'since': since})
+        self.assertEqual([(row['id'], row['user_name']) for row in response.data['order']['items']], [(item.id, 'alice2')])
+        self.assertEqual([(row['id'], row['user_name']) for row in response.data['order']['payments']], [(payment.id, 'alice2')])
+        self.assertNotIn(other.id, [row['id'] for row in response.data['order']['items']])
+
+    def test_local_snapshots_expire(self):
+        snapshots = SnapshotLRU(10, ttl=60)
+        with mock.patch('orders.snapshots.time.monotonic', return_value=1000):
+            snapshots.set(self.order.id, 1, {'id': self.order.id})
+        with mock.patch('orders.snapshots.time.monotonic', return_value=1059):
+            self.assertEqual(snapshots.get(self.order.id, 1), {'id': self.order.id})
+        with mock.patch('orders.snapshots.time.monotonic', return_value=1061):
+            self.assertIsNone(snapshots.get(self.order.id, 1))
+            self.assertIsNone(snapshots.latest(self.order.id))
+
+    def test_detail_and_by_code_return_304_for_current_etag(self):
+        response = self.client.get(f'/api/orders/{self.order.id}/')
+        etag = response['ETag']
+        self.assertEqual(etag, f'"order-{self.order.id}-v{self.order.version}"')
+
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(f'/api/orders/{self.order.id}/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(len(ctx.captured_queries), 1)
+
+        response = self.client.get('/api/orders/by_code/', {'code': self.order.code}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        self.client.patch(f'/api/orders/{self.order.id}/', {'tip': '10.00'}, format='json')
+        response = self.client.get(f'/api/orders/{self.order.id}/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_changes_since_version(self):
+        first = self.client.post('/api/order-items/', {'order': self.order.id, 'custom_name': 'Cheeseburger', 'custom_price': '95.00'}, format='json').data
+        since = self.current_version()
+        second = self.client.post('/api/order-items/', {'order': self.order.id, 'custom_name': 'Fries', 'custom_price': '30.00'}, format='json').data
+        self.client.delete(f"/api/order-items/{first['id']}/")
+
+        response = self.client.get(f'/api/orders/{self.order.id}/changes/', {'since': since})
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.data['snapshot'])
+        self.assertEqual(response.data['version'], self.current_version())
+        self.assertEqual([item['id'] for item in response.data['order']['items']], [second['id']])
+        self.assertEqual(response.data['deleted_items'], [first['id']])
+        self.assertEqual(response.data['order']['total_items_cost'], 30.0)
+
+        self.client.post(f'/api/orders/{self.order.id}/lock/')
+        response = self.client.get(f'/api/orders/{self.order.id}/changes/', {'since': self.current_version() - 1})
+        self.assertEqual(response.data['order']['items'], [])
+        self.assertEqual(len(response.data['order']['payments']), 1)
+
+    def test_changes_fall_back_to_snapshot_for_large_gaps(self):
+        self.client.post('/api/order-items/', {'order': self.order.id, 'custom_name': 'Cheeseburger', 'custom_price': '95.00'}, format='json')
+        with self.settings(ORDER_CHANGES_MAX_GAP=1):
+            response = self.client.get(f'/api/orders/{self.order.id}/changes/', {'since': 0})
+        self.assertTrue(response.data['snapshot'])
+        self.assertEqual(len(response.data['order']['items']), 1)
+        self.assertIn('participants', response.data['order'])
+
+        response = self.client.get(f'/api/orders/{self.order.id}/changes/', {'since': 'latest'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_detail_served_from_snapshot_until_next_mutation(self):
+        first = self.client.get(f'/api/orders/{self.order.id}/')
+        with CaptureQueriesContext(connection) as ctx:
+            second = self.client.get(f'/api/orders/{self.order.id}/')
+        # Only the visibility-checked row lookup - the snapshot is reused
+        self.assertEqual(len(ctx.captured_queries), 1)
+        self.assertEqual(first.data, second.data)
+        self.assertTrue(second.data['join_url'].endswith(f'/join/{self.order.code}'))
+
+        self.client.patch(f'/api/orders/{self.order.id}/', {'tip': '12.50'}, format='json')
+        self.assertEqual(get_order_snapshot(self.order.id)['tip'], '12.50')
+        response = self.client.get(f'/api/orders/{self.order.id}/')
+        self.assertEqual(response.data['tip'], '12.50')
+
+    def test_share_message_rendered_on_cutoff_change(self):
+        self.assertIn('Cutoff: N/A', self.order.share_message)
+        self.client.patch(f'/api/orders/{self.order.id}/', {'cutoff_time': '2026-01-15T10:30:00Z'}, format='json')
+        self.order.refresh_from_db()
+        # Shown in Cairo time (UTC+2 in January)
+        self.assertIn('Cutoff: 12:30 PM', self.order.share_message)
+        self.assertIn(f'/join/{self.order.code}', self.order.share_message)
+
+    def share_message_updates(self, ctx):
+        return [q['sql'] for q in ctx.captured_queries if q['sql'].startswith('UPDATE') and 'share_message' in q['sql']]
+
+    def test_share_message_kept_for_unrelated_user_changes(self):
+        participant = User.objects.create(username='guest')
+        OrderItem.objects.create(order=self.order, user=participant, custom_name='Taco', quantity=1, unit_price=20)
+        participant.email = 'guest@example.com'
+        participant.username = 'visitor'
+        with CaptureQueriesContext(connection) as ctx:
+            participant.save()
+        # Participants aren't named in the message - only the order version moves
+        self.assertFalse(self.share_message_updates(ctx))
+
+        self.user.email = 'chief@example.com'
+        with CaptureQueriesContext(connection) as ctx:
+            self.user.save()
+        self.assertFalse(self.share_message_updates(ctx))
+
+    def test_share_message_treats_naive_cutoff_as_utc(self):
+        message = render_share_message('Taco Town', 'ABC123', datetime(2026, 1, 15, 10, 30), 'https://example.com/join/ABC123', 'chief', [])
+        self.assertIn('Cutoff: 12:30 PM', message)
+
+    def test_share_message_follows_restaurant_and_renames(self):
+        assignee = User.objects.create(username='bob')
+        self.order.assigned_users.set([assignee])
+        other = Restaurant.objects.create(name='Taco Town')
+        self.client.patch(f'/api/orders/{self.order.id}/', {'restaurant': other.id}, format='json')
+        self.order.refresh_from_db()
+        self.assertIn('Order from Taco Town', self.order.share_message)
+
+        other.name = 'Taco Palace'
+        other.save()
+        self.user.username = 'chief'
+        self.user.save()
+        assignee.username = 'robert'
+        assignee.save()
+        self.order.refresh_from_db()
+        self.assertIn('Order from Taco Palace', self.order.share_message)
+        self.assertIn('Collector: chief', self.order.share_message)
+        self.assertIn('Assigned to: robert', self.order.share_message)
+        self.assertEqual(get_order_snapshot(self.order.id, self.order.version)['share_message'], self.order.share_message)
+
+
+@override_settings(ORDER_BROADCAST_SYNC=True)
+class BroadcastOutboxTests(OrderTestCase):
+    """Broadcasts are sent after commit and never for rolled-back writes"""
+
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create(username='collector')
+        self.restaurant = Restaurant.objects.create(name='Shawarma Stop')
+        self.order = CollectionOrder.objects.create(restaurant=self.restaurant, collector=self.user)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.channel_layer = get_channel_layer()
+        self.channel = async_to_sync(self.channel_layer.new_channel)()
+        async_to_sync(self.channel_layer.group_add)(f'order_{self.order.id}', self.channel)
+
+    def tearDown(self):
+        async_to_sync(self.channel_layer.flush)()
+
+    def receive(self):
+        return async_to_sync(self.channel_layer.receive)(self.channel)
+
+    def test_broadcast_sent_on_commit(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            response = self.client.post('/api/order-items/', {'order': self.order.id, 'custom_name': 'Wrap', 'custom_price': '60.00'}, format='json')
+            self.assertEqual(response.status_code, 201)
+        # Nothing was sent during the request - the broadcast waits for the commit
+        self.assertEqual(len(callbacks), 1)
+        for callback in callbacks:
+            callback()
+        message = self.receive()
+        # A claim check - the order itself doesn't travel through the channel layer
+        self.assertEqual(message, {'type': 'order_update', 'order_id': self.order.id, 'version': self.current_version()})
+
+    def test_sync_broadcast_keeps_request_connection(self):
+        # Only the worker thread recycles its connection - in sync mode it is the request's
+        with mock.patch('orders.outbox.close_old_connections') as close:
+            with self.captureOnCommitCallbacks(execute=True):
+                self.client.patch(f'/api/orders/{self.order.id}/', {'tip': '5.00'}, format='json')
+        close.assert_not_called()
+        self.assertEqual(self.receive()['version'], self.current_version())
+
+    def test_no_broadcast_for_rolled_back_transaction(self):
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            try:
+                with transaction.atomic():
+                    self.client.patch(f'/api/orders/{self.order.id}/', {'tip': '5.00'}, format='json')
+                    raise RuntimeError('rollback')
+            except RuntimeError:
+                pass
+        self.assertEqual(callbacks, [])
+
+    def current_version(self):
+        self.order.refresh_from_db()
+        return self.order.version
+
+    def test_new_order_claim_check_sent_to_both_groups(self):
+        notifications = async_to_sync(self.channel_layer.new_channel)()
+        async_to_sync(self.channel_layer.group_add)(PUBLIC_ORDERS_GROUP, notifications)
+        send_new_order(self.order.id)
+        claim = {'order_id': self.order.id, 'version': self.order.version}
+        self.assertEqual(async_to_sync(self.channel_layer.receive)(notifications), {'type': 'new_order', **claim})
+        self.assertEqual(self.receive(), {'type': 'order_update', **claim})
+
+    def test_private_new_order_only_reaches_users_who_can_see_it(self):
+        assignee = User.objects.create(username='assignee')
+        manager = User.objects.create(username='manager', role='manager')
+        self.order.is_private = True
+        self.order.save()
+        self.order.assigned_users.set([assignee, manager])
+        self.order.bump_version()
+        groups = new_order_groups(get_order_snapshot(self.order.id))
+        self.assertEqual(sorted(groups), sorted([STAFF_ORDERS_GROUP, user_group(self.user.id), user_group(assignee.id)]))
+        self.assertEqual(notification_groups(assignee), [user_group(assignee.id), PUBLIC_ORDERS_GROUP])
+        self.assertIn(STAFF_ORDERS_GROUP, notification_groups(manager))
+
+    def test_delta_frame_published_for_next_version(self):
+        send_order_update(self.order.id)
+        self.client.patch(f'/api/orders/{self.order.id}/', {'tip': '5.00'}, format='json')
+        send_order_update(self.order.id)
+        frames = build_order_frames(self.order.id, self.current_version())
+        self.assertEqual(frames['delta_from_version'], self.order.version - 1)
+        delta = json.loads(frames['delta_frame'])
+        self.assertEqual(delta['events'][0], {'type': 'fees_updated', 'fields': {'tip': '5.00'}})
+
+
+class FrameMemoTests(ConsumerTestCase):
+    """Consumers share the frames of each order version"""
+
+    def setUp(self):
+        super().setUp()
+        restaurant = Restaurant.objects.create(name='Shawarma Stop')
+        self.order = CollectionOrder.objects.create(restaurant=restaurant, collector=User.objects.create(username='collector'))
+
+    def test_frames_resolved_once_per_version(self):
+        async def resolve_many():
+            return await asyncio.gather(*[order_frames.get(self.order.id, self.order.version) for _ in range(20)])
+
+        with mock.patch('orders.frames.encode_order', wraps=encode_order) as encode:
+            results = async_to_sync(resolve_many)()
+            async_to_sync(order_frames.get)(self.order.id, self.order.version)
+        # The order and its new_order summary are encoded once, shared by every socket
+        self.assertEqual(encode.call_count, 2)
+        frames = results[0]
+        self.assertTrue(all(result is frames for result in results))
+        summary = json.loads(frames['new_order'])['order']
+        self.assertNotIn('items', summary)
+        self.assertEqual(summary['code'], json.loads(frames['order_update'])['order']['code'])
+
+
+@override_settings(ORDER_BROADCAST_COALESCE_MS=50)
+class BroadcastCoalescingTests(OrderTestCase):
+    """A burst of broadcasts for one order within the window is sent once"""
+
+    def setUp(self):
+        super().setUp()
+        metrics.reset()
+
+    def test_burst_is_coalesced_per_order(self):
+        sent = []
+        outbox = BroadcastOutbox()
+        for _ in range(30):
+            outbox.put(sent.append, 1)
+        outbox.put(sent.append, 2)
+        outbox.join()
+        self.assertEqual(sorted(sent), [1, 2])
+        self.assertEqual(metrics.get('broadcasts_requested'), 31)
+        self.assertEqual(metrics.get('broadcasts_coalesced'), 29)
+        self.assertEqual(metrics.get('broadcasts_sent'), 2)
+
+        # Once sent, the next change gets a broadcast of its own
+        outbox.put(sent.append, 1)
+        outbox.join()
+        self.assertEqual(sent.count(1), 2)
+
+    def test_metrics_endpoint_is_admin_only(self):
+        client = APIClient()
+        client.force_authenticate(User.objects.create(username='member'))
+        self.assertEqual(client.get('/api/metrics/').status_code, 403)
+        client.force_authenticate(User.objects.create(username='admin', role='admin'))
+        metrics.incr('broadcasts_coalesced', 3)
+        self.assertEqual(client.get('/api/metrics/').data['broadcasts_coalesced'], 3)
+
+
+class OrderDeltaTests(OrderTestCase):
+    """Protocol 2 events carry only the rows and fields that changed"""
+
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create(username='collector')
+        self.restaurant = Restaurant.objects.create(name='Falafel House')
+        self.order = CollectionOrder.objects.create(restaurant=self.restaurant, collector=self.user)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_item_events(self):
+        before = get_order_snapshot(self.order.id)
+        item = self.client.post('/api/order-items/', {'order': self.order.id, 'custom_name': 'Falafel', 'custom_price': '15.00'}, format='json').data
+        after_add = get_order_snapshot(self.order.id)
+        events = order_events(before, after_add)
+        self.assertEqual([e['type'] for e in events], ['item_added', 'order_updated'])
+        self.assertEqual(events[0]['item']['id'], item['id'])
+        self.assertEqual(events[1]['fields']['total_items_cost'], 15.0)
+        self.assertNotIn('items', events[1]['fields'])
+
+        self.client.delete(f"/api/order-items/{item['id']}/")
+        events = order_events(after_add, get_order_snapshot(self.order.id))
+        self.assertEqual(events[0], {'type': 'item_removed', 'item_id': item['id']})
+
+    def test_status_and_fee_events(self):
+        self.client.post('/api/order-items/', {'order': self.order.id, 'custom_name': 'Falafel', 'custom_price': '15.00'}, format='json')
+        before = get_order_snapshot(self.order.id)
+        self.client.patch(f'/api/orders/{self.order.id}/', {'tip': '20.00'}, format='json')
+        after_fees = get_order_snapshot(self.order.id)
+        self.assertEqual(order_events(before, after_fees)[0], {'type': 'fees_updated', 'fields': {'tip': '20.00'}})
+
+        self.client.post(f'/api/orders/{self.order.id}/lock/')
+        types = [e['type'] for e in order_events(after_fees, get_order_snapshot(self.order.id))]
+        self.assertIn('status_changed', types)
+        self.assertIn('payment_updated', types)
+
+
+class WebSocketAuthTests(ConsumerTestCase):
+    """WebSocket connects reuse cached user principals until the user changes"""
+
+    def setUp(self):
+        super().setUp()
+        principal_cache.clear()
+        self.user = User.objects.create(username='member')
+        self.token = str(AccessToken.for_user(self.user))
+        self.middleware = JWTAuthMiddleware(None)
+
+    def authenticate(self):
+        return async_to_sync(self.middleware.get_user_from_token)(self.token)
+
+    def test_principal_cached_between_connects(self):
+        with CaptureQueriesContext(connection) as ctx:
+            first = self.authenticate()
+            second = self.authenticate()
+        self.assertEqual(len(ctx.captured_queries), 1)
+        self.assertEqual((second.pk, second.username, second.role), (self.user.pk, 'member', 'user'))
+        self.assertTrue(first.is_authenticated)
+        # Principals work in ORM filters without loading the full user
+        CollectionOrder.objects.visible_to(second).exists()
+
+    def test_role_change_and_deactivation_invalidate(self):
+        self.authenticate()
+        self.user.role = 'manager'
+        self.user.save()
+        self.assertEqual(self.authenticate().role, 'manager')
+
+        self.user.is_active = False
+        self.user.save()
+        with self.assertRaises(InvalidToken):
+            self.authenticate()
+
+
+class ClaimsAuthenticationTests(OrderTestCase):
+    """REST requests authenticate from token claims instead of loading the user row"""
+
+    def setUp(self):
+        super().setUp()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user = User.objects.create(username='manager', role='manager')
+        self.restaurant = Restaurant.objects.create(name='Grill House')
+        self.client = APIClient()
+
+    def count_queries(self, token):
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {token}')
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get('/api/orders/', {'view': 'summary'})
+        self.assertEqual(response.status_code, 200)
+        return len(ctx.captured_queries)
+
+    def test_claims_token_skips_user_load(self):
+        legacy_queries = self.count_queries(RefreshToken.for_user(self.user).access_token)
+        claims_queries = self.count_queries(IdentityRefreshToken.for_user(self.user).access_token)
+        self.assertEqual(legacy_queries - claims_queries, 1)
+
+    def test_lazy_user_in_views(self):
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {IdentityRefreshToken.for_user(self.user).access_token}')
+        response = self.client.post('/api/orders/', {'restaurant': self.restaurant.id}, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data['collector_name'], 'manager')
+        self.assertEqual(self.client.get('/api/users/me/').data['role'], 'manager')
+
+    def test_role_change_forces_refresh(self):
+        refresh = IdentityRefreshToken.for_user(self.user)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {refresh.access_token}')
+        self.user.role = 'user'
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.save()
+        self.assertEqual(self.client.get('/api/orders/').status_code, 401)
+
+        response = APIClient().post('/api/auth/refresh/', {'refresh': str(refresh)}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(AccessToken(response.data['access'])['role'], 'user')
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {response.data['access']}")
+        self.assertEqual(self.client.get('/api/orders/').status_code, 200)
+
+    def test_auth_state_published_on_commit(self):
+        state = get_auth_state(self.user.pk)
+        try:
+            with transaction.atomic():
+                self.user.is_active = False
+                self.user.save()
+                self.assertEqual(get_auth_state(self.user.pk), state)
+                raise IntegrityError
+        except IntegrityError:
+            pass
+        self.assertEqual(get_auth_state(self.user.pk), state)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.save()
+        self.assertEqual(get_auth_state(self.user.pk), (state[0] + 1, False))
+
+    def test_deleted_user_token_rejected(self):
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {IdentityRefreshToken.for_user(self.user).access_token}')
+        self.assertEqual(self.client.get('/api/orders/').status_code, 200)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.delete()
+        self.assertEqual(self.client.get('/api/orders/').status_code, 401)
+
+    def test_deactivated_user_cannot_refresh(self):
+        refresh = IdentityRefreshToken.for_user(self.user)
+        self.user.is_active = False
+        self.user.save()
+        response = APIClient().post('/api/auth/refresh/', {'refresh': str(refresh)}, format='json')
+        self.assertEqual(response.status_code, 401)
+
+
+class StreamConsumerTests(ConsumerTestCase):
+    """ws/stream/ multiplexes order and topic subscriptions over one socket"""
+
+    def setUp(self):
+        super().setUp()
+        self.collector = User.objects.create(username='collector')
+        self.outsider = User.objects.create(username='outsider')
+        restaurant = Restaurant.objects.create(name='Sushi Bar')
+        self.public_order = CollectionOrder.objects.create(restaurant=restaurant, collector=self.collector)
+        self.private_order = CollectionOrder.objects.create(restaurant=restaurant, collector=self.collector, is_private=True)
+        self.sent = []
+        self.consumer = StreamConsumer()
+        self.consumer.scope = {'user': self.outsider}
+        self.consumer.channel_layer = get_channel_layer()
+        self.consumer.channel_name = async_to_sync(self.consumer.channel_layer.new_channel)()
+        self.consumer.orders, self.consumer.topics, self.consumer.seqs = {}, set(), {}
+
+        async def queue_send(text, key=None, superseding_text=None):
+            self.sent.append(json.loads(text))
+        self.consumer.queue_send = queue_send
+        self.consumer.send = lambda text_data: queue_send(text_data)
+
+    def tearDown(self):
+        async_to_sync(self.consumer.channel_layer.flush)()
+
+    def receive(self, message):
+        async_to_sync(self.consumer.receive)(json.dumps(message))
+
+    def test_subscribe_checks_access_in_one_query(self):
+        with CaptureQueriesContext(connection) as ctx:
+            self.receive({'type': 'subscribe', 'orders': [self.public_order.id, self.private_order.id], 'topics': ['notifications', 'unknown']})
+        ack = self.sent[0]
+        self.assertEqual(ack, {'type': 'subscribed', 'orders': [self.public_order.id], 'denied': [self.private_order.id], 'topics': ['notifications']})
+        self.assertEqual(self.sent[1]['sub'], f'order:{self.public_order.id}')
+        self.assertEqual(self.sent[1]['seq'], 1)
+        self.assertEqual(self.sent[1]['data']['type'], 'order_update')
+        # Access check, then the snapshot of the one granted order
+        self.assertEqual(ctx.captured_queries[0]['sql'].count('EXISTS'), 2)
+
+    def test_events_routed_with_per_subscription_sequence(self):
+        self.receive({'type': 'subscribe', 'orders': [self.public_order.id], 'topics': ['notifications']})
+        self.public_order.bump_version()
+        async_to_sync(self.consumer.order_update)({'order_id': self.public_order.id, 'version': self.public_order.version})
+        async_to_sync(self.consumer.new_order)({'order_id': self.public_order.id, 'version': self.public_order.version})
+        # Each update of the open order is followed by its shares
+        self.assertEqual([(m['sub'], m['seq'], m['data']['type']) for m in self.sent[1:]], [
+            (f'order:{self.public_order.id}', 1, 'order_update'),
+            (f'order:{self.public_order.id}', 2, 'order_shares'),
+            (f'order:{self.public_order.id}', 3, 'order_update'),
+            (f'order:{self.public_order.id}', 4, 'order_shares'),
+            ('notifications', 1, 'new_order'),
+        ])
+
+        self.receive({'type': 'unsubscribe', 'orders': [self.public_order.id]})
+        sent = len(self.sent)
+        async_to_sync(self.consumer.order_update)({'order_id': self.public_order.id, 'version': self.public_order.version + 1})
+        self.assertEqual(len(self.sent), sent)
+
+
+@override_settings(ORDER_EVENT_LOG_WINDOW=3, ORDER_BROADCAST_SYNC=True)
+class ReconnectReplayTests(ConsumerTestCase):
+    """Reconnecting protocol 2 clients replay missed events from the order's event log"""
+
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create(username='collector')
+        self.order = CollectionOrder.objects.create(restaurant=Restaurant.objects.create(name='Taco Truck'), collector=self.user)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.get_connect_frames = async_to_sync(OrderConsumer().get_connect_frames)
+        send_order_update(self.order.id)
+
+    def change_tip(self, tip):
+        # Commits right away - the broadcast logging the change runs before the response
+        self.client.patch(f'/api/orders/{self.order.id}/', {'tip': tip}, format='json')
+        self.order.refresh_from_db()
+        return self.order.version
+
+    def test_replays_missed_events(self):
+        seen = self.order.version
+        self.change_tip('1.00')
+        current = self.change_tip('2.00')
+        version, frames = self.get_connect_frames(self.order.id, self.user, seen)
+        self.assertEqual(version, current)
+        deltas = [json.loads(frame) for frame in frames]
+        self.assertEqual([(d['type'], d['from_version'], d['version']) for d in deltas], [
+            ('order_delta', seen, seen + 1),
+            ('order_delta', seen + 1, current),
+        ])
+        self.assertEqual(deltas[-1]['events'][0], {'type': 'fees_updated', 'fields': {'tip': '2.00'}})
+
+        # Up to date - nothing to send
+        self.assertEqual(self.get_connect_frames(self.order.id, self.user, current), (current, []))
+
+    def test_snapshot_when_gap_leaves_window(self):
+        seen = self.order.version
+        for tip in ('1.00', '2.00', '3.00', '4.00'):
+            current = self.change_tip(tip)
+        version, frames = self.get_connect_frames(self.order.id, self.user, seen)
+        self.assertEqual(version, current)
+        self.assertEqual(json.loads(frames[0])['type'], 'order_update')
+        self.assertEqual(OrderEventLog.objects.filter(order=self.order).count(), 3)
+
+
+@override_settings(WS_SEND_QUEUE_SIZE=3)
+class SlowConsumerTests(OrderTestCase):
+    """Slow sockets get the latest state instead of every update, and are closed if they keep lagging"""
+
+    def setUp(self):
+        super().setUp()
+        metrics.reset()
+
+    def run_with_slow_client(self, scenario):
+        consumer = OrderConsumer()
+        delivered = []
+        link = asyncio.Event()  # Set when the client's link drains
+
+        async def base_send(message):
+            if message['type'] == 'websocket.send':
+                await link.wait()
+                delivered.append(message['text'])
+            else:
+                delivered.append(message)
+
+        consumer.base_send = base_send
+
+        async def run():
+            consumer.start_send_queue()
+            await scenario(consumer, link)
+            link.set()
+            await asyncio.sleep(0.01)
+            consumer.stop_send_queue()
+
+        async_to_sync(run)()
+        return delivered
+
+    def test_latest_state_supersedes_unsent_updates(self):
+        async def scenario(consumer, link):
+            await consumer.queue_send('v1', key='order')
+            await asyncio.sleep(0)  # v1 is now being sent
+            await consumer.queue_send('pong')
+            await consumer.queue_send('delta v1->v2', key='order', superseding_text='full v2')
+            await consumer.queue_send('delta v2->v3', key='order', superseding_text='full v3')
+
+        self.assertEqual(self.run_with_slow_client(scenario), ['v1', 'pong', 'full v3'])
+        self.assertEqual(metrics.get('ws_frames_superseded'), 1)
+        self.assertEqual(metrics.get('ws_send_queue_depth'), 0)
+        self.assertEqual(metrics.get('ws_send_queue_depth_max'), 2)
+
+    def test_lagging_socket_closed_with_resumable_code(self):
+        async def scenario(consumer, link):
+            for i in range(5):
+                await consumer.queue_send(f'new order {i}', key=('new_order', i))
+                await asyncio.sleep(0)
+
+        delivered = self.run_with_slow_client(scenario)
+        self.assertIn({'type': 'websocket.close', 'code': OrderConsumer.SLOW_CONSUMER_CLOSE_CODE}, delivered)
+        self.assertEqual(metrics.get('ws_slow_consumers_closed'), 1)
+        self.assertEqual(metrics.get('ws_send_queue_depth'), 0)
+
+
+@override_settings(ORDER_BROADCAST_SYNC=True)
+class BalanceTests(OrderTestCase):
+    """Balances are served with a version and pushed to each user's own group"""
+
+    def setUp(self):
+        super().setUp()
+        self.collector = User.objects.create(username='collector')
+        self.payer = User.objects.create(username='payer')
+        restaurant = Restaurant.objects.create(name='Pizza Corner')
+        self.order = CollectionOrder.objects.create(restaurant=restaurant, collector=self.collector, fee_split_rule='collector_pays')
+        for user in (self.collector, self.payer):
+            OrderItem.objects.create(order=self.order, user=user, custom_name='Margherita', quantity=1, unit_price=80)
+        self.client = APIClient()
+        self.client.force_authenticate(self.collector)
+        self.payer_client = APIClient()
+        self.payer_client.force_authenticate(self.payer)
+        self.channel_layer = get_channel_layer()
+        self.channel = async_to_sync(self.channel_layer.new_channel)()
+        async_to_sync(self.channel_layer.group_add)(user_group(self.payer.id), self.channel)
+
+    def tearDown(self):
+        async_to_sync(self.channel_layer.flush)()
+        # Sync-mode balance pushes run on the request thread and must leave its connection open
+        self.assertFalse(connection.closed_in_transaction)
+
+    def post(self, client, url):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = client.post(url)
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def receive_balance(self):
+        message = async_to_sync(self.channel_layer.receive)(self.channel)
+        self.assertEqual(message['type'], 'balance_update')
+        return json.loads(message['frame'])
+
+    def test_lock_and_mark_paid_push_balance_updates(self):
+        self.post(self.client, f'/api/orders/{self.order.id}/lock/')
+        frame = self.receive_balance()
+        self.assertEqual(frame['order_id'], self.order.id)
+        self.assertEqual([row['amount'] for row in frame['owed_by_me']], [80.0])
+        self.assertEqual(frame['owed_to_me'], [])
+        self.assertEqual(frame['total_owed_by_me'], 80.0)
+        balance = self.payer_client.get('/api/orders/balance/').data
+        self.assertEqual(balance['version'], frame['version'])
+        self.assertEqual(balance['owed_by_me'], frame['owed_by_me'])
+
+        payment = Payment.objects.get(order=self.order, user=self.payer)
+        self.post(self.payer_client, f'/api/payments/{payment.id}/mark_paid/')
+        frame = self.receive_balance()
+        self.assertEqual(frame['version'], balance['version'] + 1)
+        self.assertEqual(frame['owed_by_me'], [])
+        self.assertEqual(frame['total_owed_by_me'], 0)
+
+    def test_payment_api_writes_push_balance_updates(self):
+        self.post(self.client, f'/api/orders/{self.order.id}/lock/')
+        version = self.receive_balance()['version']
+        payment = Payment.objects.get(order=self.order, user=self.payer)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.patch(f'/api/payments/{payment.id}/', {'amount': '70.00'}, format='json')
+        frame = self.receive_balance()
+        self.assertEqual(frame['version'], version + 1)
+        self.assertEqual(frame['total_owed_by_me'], 70.0)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.delete(f'/api/payments/{payment.id}/')
+        frame = self.receive_balance()
+        self.assertEqual(frame['version'], version + 2)
+        self.assertEqual(frame['owed_by_me'], [])
+        self.assertEqual(User.objects.get(pk=self.payer.pk).balance_version, version + 2)
+
+    def test_order_delete_pushes_balance_updates(self):
+        self.post(self.client, f'/api/orders/{self.order.id}/lock/')
+        version = self.receive_balance()['version']
+        order_id = self.order.id
+        User.objects.filter(pk=self.collector.pk).update(role='manager')  # Collectors only delete open orders
+        self.collector.role = 'manager'
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.delete(f'/api/orders/{order_id}/')
+        self.assertEqual(response.status_code, 204)
+        frame = self.receive_balance()
+        self.assertEqual(frame['order_id'], order_id)
+        self.assertEqual(frame['version'], version + 1)
+        self.assertEqual(frame['owed_by_me'], [])
+        self.assertEqual(frame['total_owed_by_me'], 0)
+        self.assertEqual(self.payer_client.get('/api/orders/balance/').data['version'], frame['version'])
+
+    def test_balance_endpoint_returns_304_until_balance_changes(self):
+        self.post(self.client, f'/api/orders/{self.order.id}/lock/')
+        response = self.client.get('/api/orders/balance/')
+        self.assertEqual(response.data['total_owed_to_me'], 80.0)
+        self.assertEqual([row['payer_name'] for row in response.data['owed_to_me']], ['payer'])
+        etag = response['ETag']
+        self.assertEqual(self.client.get('/api/orders/balance/', HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        self.post(self.client, f'/api/orders/{self.order.id}/unlock/')
+        response = self.client.get('/api/orders/balance/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(response.data['owed_to_me'], [])
+
+    def test_balance_deltas_query_count_does_not_grow_with_participants(self):
+        self.post(self.client, f'/api/orders/{self.order.id}/lock/')
+        with CaptureQueriesContext(connection) as small:
+            self.assertEqual(len(balance_deltas(self.order.id)), 2)
+        for i in range(5):
+            user = User.objects.create(username=f'extra{i}')
+            Payment.objects.create(order=self.order, user=user, amount=10)
+        with CaptureQueriesContext(connection) as large:
+            self.assertEqual(len(balance_deltas(self.order.id)), 7)
+        self.assertEqual(len(small.captured_queries), len(large.captured_queries))
+
+    def test_plain_user_save_keeps_balance_version(self):
+        user = User.objects.get(pk=self.payer.pk)
+        bump_balance_versions(self.order)
+        user.phone = '0100'
+        user.save()
+        self.assertEqual(User.objects.get(pk=self.payer.pk).balance_version, 1)
+
+
+class PaymentCalculationTests(OrderTestCase):
+    """Locking calculates every participant's payment in a fixed number of queries"""
+
+    def setUp(self):
+        super().setUp()
+        self.collector = User.objects.create(username='collector')
+        restaurant = Restaurant.objects.create(name='Office Lunch')
+        self.order = CollectionOrder.objects.create(restaurant=restaurant, collector=self.collector, delivery_fee=24, tip=6)
+        self.client = APIClient()
+        self.client.force_authenticate(self.collector)
+
+    def add_item(self, user, name, price):
+        OrderItem.objects.create(order=self.order, user=user, custom_name=name, quantity=1, unit_price=price)
+
+    def add_participants(self, count):
+        for i in range(count):
+            user = User.objects.create(username=f'participant{User.objects.count()}')
+            self.add_item(user, 'Sandwich', 40)
+            self.add_item(user, 'Juice', 20)
+
+    def count_calculation_queries(self):
+        self.order.refresh_totals()
+        self.order.refresh_from_db()
+        with CaptureQueriesContext(connection) as ctx:
+            CollectionOrderViewSet()._calculate_payments(self.order)
+        return len(ctx.captured_queries)
+
+    def test_query_count_does_not_grow_with_participants(self):
+        self.add_item(self.collector, 'Salad', 30)
+        self.add_participants(2)
+        self.count_calculation_queries()  # Later runs also replace existing payments
+        small = self.count_calculation_queries()
+        self.add_participants(20)
+        self.assertEqual(self.count_calculation_queries(), small)
+        self.assertEqual(Payment.objects.filter(order=self.order).count(), 23)
+
+    def test_lock_splits_fees_and_marks_collector_paid(self):
+        self.add_item(self.collector, 'Salad', 30)
+        self.add_participants(2)
+        response = self.client.post(f'/api/orders/{self.order.id}/lock/')
+        self.assertEqual(response.status_code, 200)
+        payments = {payment.user_id: payment for payment in Payment.objects.filter(order=self.order)}
+        self.assertEqual(len(payments), 3)
+        collector_payment = payments.pop(self.collector.id)
+        self.assertEqual(collector_payment.amount, 40)
+        self.assertTrue(collector_payment.is_paid)
+        self.assertIsNotNone(collector_payment.paid_at)
+        for payment in payments.values():
+            self.assertEqual(payment.amount, 70)
+            self.assertFalse(payment.is_paid)
+            self.assertEqual(payment.changed_version, response.data['version'])
+
+    def test_custom_split_on_lock(self):
+        self.add_item(self.collector, 'Salad', 30)
+        self.add_participants(2)
+        first, second = User.objects.filter(order_items__order=self.order).exclude(pk=self.collector.pk).distinct().order_by('id')
+        response = self.client.patch(f'/api/orders/{self.order.id}/', {
+            'fee_split_rule': 'custom',
+            'fee_split_custom': {'fixed': {str(first.id): '10.00'}, 'weights': {str(self.collector.id): 1, str(second.id): 2}},
+        }, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.client.post(f'/api/orders/{self.order.id}/lock/').status_code, 200)
+        amounts = dict(Payment.objects.filter(order=self.order).values_list('user', 'amount'))
+        # 30 fees: 10 fixed, the remaining 20 split 1:2
+        self.assertEqual(amounts, {self.collector.id: Decimal('36.67'), first.id: Decimal('70.00'), second.id: Decimal('73.33')})
+
+    def test_invalid_custom_split_rejected(self):
+        response = self.client.patch(f'/api/orders/{self.order.id}/', {'fee_split_custom': {'weights': {'1': -2}}}, format='json')
+        self.assertEqual(response.status_code, 400)
+
+        self.add_item(self.collector, 'Salad', 30)
+        self.order.fee_split_rule = 'custom'
+        self.order.fee_split_custom = {'fixed': {str(self.collector.id): '45.00'}}
+        self.order.save()
+        response = self.client.post(f'/api/orders/{self.order.id}/lock/')
+        self.assertEqual(response.status_code, 400)
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.status, 'OPEN')
+
+
+class FeeSplitTests(SimpleTestCase):
+    """Property tests of the fee split engine over randomized orders"""
+
+    def random_order(self, rng):
+        participants = rng.sample(range(1, 500), rng.randint(1, 40))
+        items_totals = {user_id: Decimal(rng.randint(0, 30000)) / 100 for user_id in participants}
+        fees = Decimal(rng.randint(0, 50000)) / 100
+        return items_totals, fees, rng.choice(participants)
+
+    def assert_exact_split(self, shares, fees):
+        for share in shares.values():
+            self.assertEqual(share, share.quantize(Decimal('0.01')))
+            self.assertGreaterEqual(share, 0)
+        self.assertEqual(sum(shares.values()), fees)
+
+    def test_builtin_rules_split_fees_exactly(self):
+        rng = random.Random(24)
+        for _ in range(300):
+            items_totals, fees, collector_id = self.random_order(rng)
+
+            equal = split_fees(items_totals, fees, 'equal', collector_id)
+            self.assert_exact_split(equal, fees)
+            self.assertEqual(set(equal), set(items_totals))
+            self.assertLessEqual(max(equal.values()) - min(equal.values()), Decimal('0.01'))
+
+            proportional = split_fees(items_totals, fees, 'proportional', collector_id)
+            self.assert_exact_split(proportional, fees)
+            total_items = sum(items_totals.values())
+            if total_items:
+                for user_id, share in proportional.items():
+                    self.assertLess(abs(share - fees * items_totals[user_id] / total_items), Decimal('0.01'))
+
+            collector_pays = split_fees(items_totals, fees, 'collector_pays', collector_id)
+            self.assert_exact_split(collector_pays, fees)
+            self.assertEqual(collector_pays[collector_id], fees)
+
+            amounts = payment_amounts(items_totals, fees, 'equal', collector_id)
+            self.assertEqual(sum(amounts.values()), sum(items_totals.values()) + fees)
+
+    def test_custom_rule_honours_fixed_amounts_and_weights(self):
+        rng = random.Random(25)
+        for _ in range(300):
+            items_totals, fees, collector_id = self.random_order(rng)
+            participants = list(items_totals)
+            fixed = {str(user_id): str(Decimal(rng.randint(0, 2000)) / 100) for user_id in rng.sample(participants, rng.randint(0, len(participants)))}
+            weights = {str(user_id): rng.randint(0, 5) for user_id in rng.sample(participants, rng.randint(0, len(participants)))}
+            custom = {'fixed': fixed, 'weights': weights}
+
+            if sum(Decimal(amount) for amount in fixed.values()) > fees:
+                with self.assertRaises(FeeSplitError):
+                    split_fees(items_totals, fees, 'custom', collector_id, custom)
+                continue
+            shares = split_fees(items_totals, fees, 'custom', collector_id, custom)
+            self.assert_exact_split(shares, fees)
+            weighted = {int(user_id) for user_id, weight in weights.items() if weight}
+            if not weighted and len(fixed) == len(participants):
+                continue  # Everyone has a fixed amount - any rest is split equally on top
+            for user_id, amount in fixed.items():
+                if int(user_id) not in weighted:
+                    self.assertEqual(shares[int(user_id)], Decimal(amount))
+
+    def test_leftover_cents_go_to_largest_remainders(self):
+        self.assertEqual(allocate(100, {1: 1, 2: 1, 3: 1}), {1: 34, 2: 33, 3: 33})
+        self.assertEqual(allocate(10, {1: 1, 2: 2}), {1: 3, 2: 7})
+        self.assertEqual(allocate(-100, {1: 1, 2: 1, 3: 1}), {1: -34, 2: -33, 3: -33})
+
+    def test_custom_rule_with_negative_fees(self):
+        items_totals = {1: Decimal('50.00'), 2: Decimal('30.00')}
+        self.assertEqual(
+            split_fees(items_totals, Decimal('-5.00'), 'custom', 1, {'weights': {'1': 1, '2': 4}}),
+            {1: Decimal('-1.00'), 2: Decimal('-4.00')}
+        )
+        self.assertEqual(split_fees(items_totals, Decimal('-5.00'), 'custom', 1, {}), {1: Decimal('-2.50'), 2: Decimal('-2.50')})
+        with self.assertRaisesMessage(FeeSplitError, 'negative'):
+            split_fees(items_totals, Decimal('-5.00'), 'custom', 1, {'fixed': {'1': '2.00'}})
+
+    def test_invalid_custom_config_rejected(self):
+        for custom in ({'fixed': {'a': '1'}}, {'weights': {'1': -1}}, {'other': {}}, {'fixed': ['1']}, {'weights': {'1': True}}):
+            with self.assertRaises(FeeSplitError):
+                parse_custom(custom)
+
+
+class ParticipantShareTests(OrderTestCase):
+    """Running participant totals follow every item change and feed the shares preview and lock"""
+
+    def setUp(self):
+        super().setUp()
+        self.collector = User.objects.create(username='collector')
+        self.member = User.objects.create(username='member')
+        restaurant = Restaurant.objects.create(name='Grill House')
+        self.order = CollectionOrder.objects.create(restaurant=restaurant, collector=self.collector, delivery_fee=20, tip=0)
+        self.client = APIClient()
+        self.client.force_authenticate(self.collector)
+
+    def add_item(self, name, price, user=None):
+        data = {'order': self.order.id, 'custom_name': name, 'custom_price': price}
+        if user:
+            data['user'] = user.id
+        response = self.client.post('/api/order-items/', data, format='json')
+        self.assertEqual(response.status_code, 201)
+        return response.data['id']
+
+    def running_totals(self):
+        return {row.user_id: (row.items_total, row.item_count) for row in ParticipantTotal.objects.filter(order=self.order)}
+
+    def test_totals_follow_item_add_update_and_delete(self):
+        burger = self.add_item('Burger', '90.00')
+        fries = self.add_item('Fries', '30.00')
+        self.add_item('Steak', '150.00', user=self.member)
+        self.assertEqual(self.running_totals(), {self.collector.id: (120, 2), self.member.id: (150, 1)})
+
+        # Reassigning an item moves its total to the new owner
+        self.assertEqual(self.client.patch(f'/api/order-items/{fries}/', {'user': self.member.id, 'custom_name': 'Fries', 'custom_price': '30.00'}, format='json').status_code, 200)
+        self.assertEqual(self.running_totals(), {self.collector.id: (90, 1), self.member.id: (180, 2)})
+
+        self.assertEqual(self.client.delete(f'/api/order-items/{burger}/').status_code, 204)
+        self.assertEqual(self.running_totals(), {self.member.id: (180, 2)})
+
+    def test_shares_endpoint_and_lock_agree(self):
+        self.add_item('Burger', '90.00')
+        self.add_item('Steak', '150.00', user=self.member)
+        response = self.client.get(f'/api/orders/{self.order.id}/shares/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [(row['user'], row['items_total'], row['fee_share'], row['amount']) for row in response.data['shares']],
+            [(self.collector.id, 90.0, 10.0, 100.0), (self.member.id, 150.0, 10.0, 160.0)]
+        )
+        etag = response['ETag']
+        self.assertEqual(self.client.get(f'/api/orders/{self.order.id}/shares/', HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        self.assertEqual(self.client.post(f'/api/orders/{self.order.id}/lock/').status_code, 200)
+        amounts = dict(Payment.objects.filter(order=self.order).values_list('user', 'amount'))
+        self.assertEqual(amounts, {row['user']: Decimal(str(row['amount'])) for row in response.data['shares']})
+
+    def test_item_cannot_move_to_another_order(self):
+        item_id = self.add_item('Burger', '10.00')
+        other = CollectionOrder.objects.create(restaurant=self.order.restaurant, collector=self.collector)
+        data = {'order': other.id, 'custom_name': 'Burger', 'custom_price': '10.00'}
+        self.assertEqual(self.client.patch(f'/api/order-items/{item_id}/', data, format='json').status_code, 400)
+        self.assertEqual(OrderItem.objects.get(pk=item_id).order_id, self.order.id)
+        self.assertEqual(self.running_totals(), {self.collector.id: (10, 1)})
+        # Resending the item's own order is fine, and leaving out the user keeps the owner
+        data['order'] = self.order.id
+        self.assertEqual(self.client.patch(f'/api/order-items/{item_id}/', data, format='json').status_code, 200)
+        self.assertEqual(OrderItem.objects.get(pk=item_id).user_id, self.collector.id)
+        self.assertEqual(self.running_totals(), {self.collector.id: (10, 1)})
+
+    def test_items_written_outside_the_item_endpoints_can_change(self):
+        self.add_item('Burger', '90.00')
+        steak = OrderItem.objects.create(order=self.order, user=self.member, custom_name='Steak', quantity=1, unit_price=150)
+        salad = OrderItem.objects.create(order=self.order, user=self.member, custom_name='Salad', quantity=1, unit_price=40)
+
+        # The ORM writes moved the running totals like the item endpoints do
+        self.assertEqual(self.running_totals(), {self.collector.id: (Decimal('90.00'), 1), self.member.id: (Decimal('190.00'), 2)})
+        response = self.client.patch(f'/api/order-items/{steak.id}/', {'user': self.collector.id, 'custom_name': 'Steak', 'custom_price': '150.00'}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.running_totals(), {self.collector.id: (Decimal('240.00'), 2), self.member.id: (Decimal('40.00'), 1)})
+        self.assertEqual(self.client.delete(f'/api/order-items/{salad.id}/').status_code, 204)
+        self.assertEqual(self.running_totals(), {self.collector.id: (Decimal('240.00'), 2)})
+
+        # Lock reads the running totals as they are
+        self.assertEqual(self.client.post(f'/api/orders/{self.order.id}/lock/').status_code, 200)
+        amounts = dict(Payment.objects.filter(order=self.order).values_list('user', 'amount'))
+        self.assertEqual(amounts, {self.collector.id: Decimal('260.00')})
+
+    def test_lock_charges_items_written_outside_the_item_endpoints(self):
+        self.add_item('Burger', '10.00')
+        OrderItem.objects.create(order=self.order, user=self.member, custom_name='Steak', quantity=1, unit_price=50)
+        self.assertEqual(self.client.post(f'/api/orders/{self.order.id}/lock/').status_code, 200)
+        amounts = dict(Payment.objects.filter(order=self.order).values_list('user', 'amount'))
+        self.assertEqual(amounts, {self.collector.id: Decimal('20.00'), self.member.id: Decimal('60.00')})
+
+    def test_first_item_inserts_only_its_users_total(self):
+        self.add_item('Burger', '90.00')
+        ParticipantTotal.objects.filter(order=self.order).update(items_total=99)
+        with CaptureQueriesContext(connection) as ctx:
+            ParticipantTotal.record(self.order.id, self.member.id, Decimal('30.00'), 1)
+        self.assertEqual(len(ctx.captured_queries), 2)
+        # The collector's row is left alone, not rebuilt from the items
+        self.assertEqual(self.running_totals(), {self.collector.id: (99, 1), self.member.id: (30, 1)})
+
+    def test_orm_item_update_and_delete_move_running_totals(self):
+        steak = OrderItem.objects.create(order=self.order, user=self.member, custom_name='Steak', quantity=1, unit_price=150)
+        steak = OrderItem.objects.get(pk=steak.pk)
+        steak.total_price = Decimal('120.00')
+        steak.save()
+        self.assertEqual(self.running_totals(), {self.member.id: (Decimal('120.00'), 1)})
+        steak.user = self.collector
+        steak.save()
+        self.assertEqual(self.running_totals(), {self.collector.id: (Decimal('120.00'), 1)})
+        steak.delete()
+        self.assertEqual(self.running_totals(), {})
+
+    def test_deleting_item_without_running_total(self):
+        self.add_item('Burger', '90.00')
+        fries = OrderItem.objects.create(order=self.order, user=self.member, custom_name='Fries', quantity=1, unit_price=30)
+        # Bulk writes send no signals - the member's running total is missing
+        ParticipantTotal.objects.filter(order=self.order, user=self.member).delete()
+        self.assertEqual(self.client.delete(f'/api/order-items/{fries.id}/').status_code, 204)
+        self.assertEqual(self.running_totals(), {self.collector.id: (Decimal('90.00'), 1)})
+
+    def test_menu_actions_refresh_totals_and_broadcast(self):
+        Menu.objects.create(restaurant=self.order.restaurant, name='Main', is_active=True)
+        item_id = self.add_item('Soup', '40.00')
+        self.order.refresh_from_db()
+        version = self.order.version
+
+        with self.captureOnCommitCallbacks() as callbacks:
+            response = self.client.post(f'/api/order-items/{item_id}/add_to_menu/')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(callbacks)
+        with self.captureOnCommitCallbacks() as callbacks:
+            response = self.client.post(f'/api/order-items/{item_id}/update_menu_item_price/', {'price': '55.00'}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(callbacks)
+
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.version, version + 2)
+        self.assertEqual(self.order.items_total, Decimal('55.00'))
+        self.assertEqual(self.running_totals(), {self.collector.id: (Decimal('55.00'), 1)})
+        self.assertEqual(OrderItem.objects.get(pk=item_id).total_price, Decimal('55.00'))
+
+    def test_shares_frame_sent_while_order_open(self):
+        self.add_item('Burger', '90.00')
+        self.order.refresh_from_db()
+        frame = json.loads(build_order_frames(self.order.id, self.order.version)['order_shares'])
+        self.assertEqual(frame['type'], 'order_shares')
+        self.assertEqual(frame['version'], self.order.version)
+        self.assertEqual(frame['shares'][0]['amount'], 110.0)
+
+        self.assertEqual(self.client.post(f'/api/orders/{self.order.id}/lock/').status_code, 200)
+        self.order.refresh_from_db()
+        self.assertIsNone(build_order_frames(self.order.id, self.order.version)['order_shares'])
+
+    def test_shares_frame_omitted_for_superseded_version(self):
+        self.add_item('Burger', '90.00')
+        self.order.refresh_from_db()
+        version = self.order.version
+        snapshot = get_order_snapshot(self.order.id, version)
+        self.add_item('Fries', '30.00')
+        # The fees of version N must not be combined with the totals of version N+1
+        self.assertIsNone(snapshot_shares(snapshot))
+        self.order.refresh_from_db()
+        self.assertEqual(snapshot_shares(get_order_snapshot(self.order.id, self.order.version))['shares'][0]['amount'], 140.0)
+
+        empty = CollectionOrder.objects.create(restaurant=self.order.restaurant, collector=self.collector, delivery_fee=20, tip=0)
+        snapshot = get_order_snapshot(empty.id, empty.version)
+        self.assertEqual(snapshot_shares(snapshot)['shares'], [])
+        empty.bump_version()
+        self.assertIsNone(snapshot_shares(snapshot))
+
+
+class RecomputeOrderTotalsTests(OrderTestCase):
+    """recompute_order_totals repairs drifted participant totals"""
+
+    def test_drifted_participant_total_rebuilt(self):
+        collector = User.objects.create(username='collector')
+        restaurant = Restaurant.objects.create(name='Falafel Stand')
+        order = CollectionOrder.objects.create(restaurant=restaurant, collector=collector)
+        OrderItem.objects.create(order=order, user=collector, custom_name='Falafel', quantity=1, unit_price=25)
+        order.refresh_totals()
+        ParticipantTotal.rebuild(order.id)
+        ParticipantTotal.objects.filter(order=order).update(items_total=99)
+
+        out = StringIO()
+        call_command('recompute_order_totals', '--dry-run', stdout=out)
+        self.assertIn('participant totals differ', out.getvalue())
+        self.assertEqual(ParticipantTotal.objects.get(order=order).items_total, 99)
+
+        call_command('recompute_order_totals', stdout=StringIO())
+        total = ParticipantTotal.objects.get(order=order)
+        self.assertEqual((total.user_id, total.items_total, total.item_count), (collector.id, 25, 1))
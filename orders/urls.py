@@ -4,7 +4,8 @@ from rest_framework_simplejwt.views import TokenRefreshView
 from .views import (
     UserViewSet, LoginView, RegisterView, RestaurantViewSet, MenuViewSet,
     MenuItemViewSet, CollectionOrderViewSet, OrderItemViewSet,
-    PaymentViewSet, AuditLogViewSet, FeePresetViewSet, RecommendationViewSet
+    PaymentViewSet, AuditLogViewSet, FeePresetViewSet, RecommendationViewSet,
+    MetricsView
 )
 
 router = DefaultRouter()
@@ -24,5 +25,6 @@ urlpatterns = [
     path('auth/register/', RegisterView.as_view(), name='register'),
     path('auth/login/', LoginView.as_view(), name='token_obtain_pair'),
     path('auth/refresh/', TokenRefreshView.as_view(), name='token_refresh'),
+    path('metrics/', MetricsView.as_view(), name='metrics'),
 ]
 
@@ -1,3 +1,41 @@
+import datetime
+from django.conf import settings
+from django.utils import timezone
+
+
+def render_share_message(restaurant_name, code, cutoff_time, join_url, collector_username, assigned_usernames):
+    """
+    Render the WhatsApp/Teams share message for an order.
+    The cutoff is shown in the project timezone (Africa/Cairo).
+    """
+    if cutoff_time:
+        if timezone.is_naive(cutoff_time):
+            cutoff_time = timezone.make_aware(cutoff_time, datetime.timezone.utc)
+        cutoff_str = timezone.localtime(cutoff_time).strftime('%I:%M %p')
+    else:
+        cutoff_str = 'N/A'
+    
+    message = (f"🍽️ OrderQ: Order from {restaurant_name}\n"
+              f"📋 Join code: {code}\n"
+              f"⏰ Cutoff: {cutoff_str}\n"
+              f"🔗 Add your items here: {join_url}\n"
+              f"👤 Collector: {collector_username}")
+    
+    # Add assigned users info if any
+    if assigned_usernames:
+        message += f"\n👥 Assigned to: {', '.join(assigned_usernames)}"
+    
+    return message
+
+
+def build_join_url(code):
+    """Frontend link for joining an order by code"""
+    frontend_url = getattr(settings, 'FRONTEND_URL', None)
+    if frontend_url:
+        return f"{frontend_url}/join/{code}"
+    return f'/join/{code}'
+
+
 def format_item_name(name):
     """
     Format item name to ensure proper capitalization and spacing.
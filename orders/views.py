@@ -3,23 +3,32 @@ from rest_framework.decorators import action
 from rest_framework.response import Response
 from rest_framework.views import APIView
 from rest_framework.exceptions import ValidationError
-from django.db.models import Q, Sum, Count
+from django.utils.http import parse_etags
+from django.conf import settings
+from django.db.models import Sum, Count
 from django.utils import timezone
 from django.db import transaction, IntegrityError
 from decimal import Decimal
 from .models import (
     User, Restaurant, Menu, MenuItem, CollectionOrder, 
-    OrderItem, Payment, AuditLog, FeePreset, Recommendation
+    OrderItem, Payment, AuditLog, FeePreset, Recommendation, OrderTombstone, ParticipantTotal,
+    order_visibility_q, order_member_q
 )
 from .serializers import (
     UserSerializer, UserRegistrationSerializer, LoginSerializer, ChangePasswordSerializer,
     RestaurantSerializer, MenuSerializer, MenuItemSerializer, CollectionOrderSerializer,
-    OrderItemSerializer, PaymentSerializer, AuditLogSerializer, FeePresetSerializer,
+    CollectionOrderSummarySerializer, CollectionOrderChangesSerializer, OrderItemSerializer, PaymentSerializer, AuditLogSerializer, FeePresetSerializer,
     RecommendationSerializer
 )
 from .utils import format_item_name
-from .websocket_utils import broadcast_order_update, broadcast_new_order
-from rest_framework_simplejwt.tokens import RefreshToken
+from .pagination import CursorOrPageNumberPagination
+from .websocket_utils import broadcast_order_update, broadcast_new_order, broadcast_balance_update
+from .balances import balance_user_ids, bump_balance_versions, balance_snapshot, payments_owed_by, payments_owed_to
+from .fee_split import FeeSplitError, payment_amounts
+from .shares import order_shares
+from .snapshots import get_order_snapshot
+from .metrics import metrics
+from .authentication import IdentityRefreshToken
 
 
 class IsManagerOrReadOnly(permissions.BasePermission):
@@ -87,7 +96,8 @@ class UserViewSet(viewsets.ModelViewSet):
     
     @action(detail=False, methods=['get'])
     def me(self, request):
-        serializer = self.get_serializer(request.user)
+        # request.user only holds the token's identity claims - load the full profile
+        serializer = self.get_serializer(User.objects.get(pk=request.user.pk))
         return Response(serializer.data)
     
     @action(detail=False, methods=['post'])
@@ -110,7 +120,7 @@ class LoginView(APIView):
         serializer = LoginSerializer(data=request.data)
         if serializer.is_valid():
             user = serializer.validated_data['user']
-            refresh = RefreshToken.for_user(user)
+            refresh = IdentityRefreshToken.for_user(user)
             return Response({
                 'access': str(refresh.access_token),
                 'refresh': str(refresh),
@@ -139,6 +149,19 @@ class RegisterView(APIView):
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
+class MetricsView(APIView):
+    """Realtime pipeline counters for this process (admins only)"""
+    permission_classes = [permissions.IsAuthenticated]
+    
+    def get(self, request):
+        if request.user.role != 'admin':
+            return Response(
+                {'error': 'Only administrators can view metrics'},
+                status=status.HTTP_403_FORBIDDEN
+            )
+        return Response(metrics.snapshot())
+
+
 class RestaurantViewSet(viewsets.ModelViewSet):
     queryset = Restaurant.objects.all()
     serializer_class = RestaurantSerializer
@@ -375,27 +398,74 @@ class CollectionOrderViewSet(viewsets.ModelViewSet):
     queryset = CollectionOrder.objects.all()
     serializer_class = CollectionOrderSerializer
     permission_classes = [permissions.IsAuthenticated]
+    pagination_class = CursorOrPageNumberPagination
     
     def get_queryset(self):
         user = self.request.user
         status_filter = self.request.query_params.get('status')
         queryset = CollectionOrder.objects.all()
         
+        if self.action == 'list' and not self.is_summary_view():
+            # Prefetch everything the serializer reads so the query count doesn't grow with page size
+            queryset = queryset.with_related()
+        
         if status_filter:
             queryset = queryset.filter(status=status_filter)
         
-        # Show public orders to everyone, private orders only to participants/managers/admins
-        # Also show orders where user is assigned
-        if user.role not in ['manager', 'admin']:
-            queryset = queryset.filter(
-                Q(is_private=False) |  # Public orders
-                Q(collector=user) |    # Orders I collected
-                Q(items__user=user) |  # Orders I'm participating in
-                Q(assigned_users=user) # Orders I'm assigned to
-            ).distinct()
+        # Show public orders to everyone, private orders only to participants/assignees/managers/admins
+        queryset = queryset.visible_to(user)
+        
+        if self.is_summary_view():
+            queryset = queryset.summary()
         
         return queryset
     
+    def is_summary_view(self):
+        """Lists requested with ?view=summary get the slim representation"""
+        return self.action == 'list' and self.request.query_params.get('view') == 'summary'
+    
+    def get_serializer_class(self):
+        if self.is_summary_view():
+            return CollectionOrderSummarySerializer
+        return super().get_serializer_class()
+    
+    def _is_not_modified(self, request, order):
+        """True if the client's If-None-Match already names the order's current version"""
+        if_none_match = request.headers.get('If-None-Match')
+        if not if_none_match:
+            return False
+        return order.etag in parse_etags(if_none_match)
+    
+    def _conditional_order_response(self, request, order):
+        """
+        304 Not Modified (without serializing) when the client has the current version,
+        otherwise the full order with its ETag
+        """
+        if self._is_not_modified(request, order):
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': order.etag})
+        return Response(get_order_snapshot(order.pk, order.version), headers={'ETag': order.etag})
+    
+    def retrieve(self, request, *args, **kwargs):
+        order = self.get_object()
+        return self._conditional_order_response(request, order)
+    
+    @action(detail=True, methods=['get'])
+    def shares(self, request, pk=None):
+        """
+        What each participant would pay if the order were locked now (304 for the current
+        version's ETag). Pushed to the order's WebSocket as `order_shares` frames while open.
+        """
+        order = self.get_object()
+        if self._is_not_modified(request, order):
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': order.etag})
+        try:
+            return Response(order_shares(order), headers={'ETag': order.etag})
+        except FeeSplitError as e:
+            return Response(
+                {'error': f'Cannot split fees: {e}'}, 
+                status=status.HTTP_400_BAD_REQUEST
+            )
+    
     def get_serializer_context(self):
         context = super().get_serializer_context()
         context['request'] = self.request
@@ -411,6 +481,8 @@ class CollectionOrderViewSet(viewsets.ModelViewSet):
             order.is_private = True
             order.save()
         
+        order.refresh_share_message()
+        
         # Note: Order can be created without items initially, but items should be added before locking
         # This allows for flexibility in order creation workflow
         
@@ -424,6 +496,12 @@ class CollectionOrderViewSet(viewsets.ModelViewSet):
         # Broadcast new order event to all connected clients
         broadcast_new_order(order)
     
+    def perform_update(self, serializer):
+        order = serializer.save()
+        if any(field in serializer.validated_data for field in ['cutoff_time', 'assigned_users', 'restaurant', 'collector']):
+            order.refresh_share_message()
+        order.bump_version()
+    
     def update(self, request, *args, **kwargs):
         """Allow updating fees and assigned_users for open orders"""
         instance = self.get_object()
@@ -441,7 +519,7 @@ class CollectionOrderViewSet(viewsets.ModelViewSet):
             )
         
         # Check if this is a fee update - fees can only be updated when order is OPEN
-        has_fee_update = any(key in request.data for key in ['delivery_fee', 'tip', 'service_fee', 'fee_split_rule'])
+        has_fee_update = any(key in request.data for key in ['delivery_fee', 'tip', 'service_fee', 'fee_split_rule', 'fee_split_custom'])
         if has_fee_update and instance.status != 'OPEN':
             return Response(
                 {'error': 'Fees can only be updated when order is open'}, 
@@ -468,25 +546,33 @@ class CollectionOrderViewSet(viewsets.ModelViewSet):
                         cost_per_user = Decimal(str(assignment_total_cost)) / Decimal(str(num_users))
                         unit_price = cost_per_user / Decimal(str(assignment_items))
                         
-                        # Delete existing items for assigned users (to avoid duplicates)
-                        OrderItem.objects.filter(
-                            order=instance,
-                            user__in=assigned_users_data
-                        ).delete()
-                        
-                        # Create items for each assigned user
-                        for user_id in assigned_users_data:
-                            user = User.objects.get(id=user_id)
-                            for i in range(assignment_items):
-                                OrderItem.objects.create(
-                                    order=instance,
-                                    user=user,
-                                    custom_name=f"Shared Item {i+1}",
-                                    custom_price=unit_price,
-                                    quantity=1,
-                                    unit_price=unit_price,
-                                    total_price=unit_price
-                                )
+                        with transaction.atomic():
+                            version = instance.bump_version()
+                            
+                            # Delete existing items for assigned users (to avoid duplicates)
+                            existing_items = OrderItem.objects.filter(
+                                order=instance,
+                                user__in=assigned_users_data
+                            )
+                            OrderTombstone.record(instance, 'item', existing_items.values_list('id', flat=True))
+                            existing_items.delete()
+                            
+                            # Create items for each assigned user
+                            for user_id in assigned_users_data:
+                                user = User.objects.get(id=user_id)
+                                for i in range(assignment_items):
+                                    OrderItem.objects.create(
+                                        order=instance,
+                                        user=user,
+                                        custom_name=f"Shared Item {i+1}",
+                                        custom_price=unit_price,
+                                        quantity=1,
+                                        unit_price=unit_price,
+                                        total_price=unit_price,
+                                        changed_version=version
+                                    )
+                            
+                            instance.refresh_totals()
                         
                         AuditLog.objects.create(
                             order=instance,
@@ -502,11 +588,12 @@ class CollectionOrderViewSet(viewsets.ModelViewSet):
             else:
                 instance.assigned_users.clear()
             instance.save()
-            # Return updated data with assigned_users
-            serializer = self.get_serializer(instance, context={'request': request})
+            instance.refresh_share_message()
+            instance.bump_version()
             # Broadcast order update via WebSocket
             broadcast_order_update(instance)
-            return Response(serializer.data)
+            # Return updated data with assigned_users
+            return Response(get_order_snapshot(instance.pk, instance.version))
         
         # Broadcast order update via WebSocket (for fee updates, etc.)
         instance.refresh_from_db()
@@ -537,7 +624,14 @@ class CollectionOrderViewSet(viewsets.ModelViewSet):
             details={'restaurant': order.restaurant.name, 'code': order.code, 'status': order.status}
         )
         
-        return super().destroy(request, *args, **kwargs)
+        # The payments go with the order - find whose balances they touch while they still exist
+        user_ids = balance_user_ids(order)
+        with transaction.atomic():
+            bump_balance_versions(order)
+            response = super().destroy(request, *args, **kwargs)
+        broadcast_balance_update(order, user_ids)
+        
+        return response
     
     @action(detail=True, methods=['post'])
     def lock(self, request, pk=None):
@@ -561,12 +655,20 @@ class CollectionOrderViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_400_BAD_REQUEST
             )
         
-        order.status = 'LOCKED'
-        order.locked_at = timezone.now()
-        order.save()
-        
-        # Calculate payments based on fee split rule
-        self._calculate_payments(order)
+        try:
+            with transaction.atomic():
+                order.status = 'LOCKED'
+                order.locked_at = timezone.now()
+                order.save()
+                order.bump_version()
+                
+                # Calculate payments based on fee split rule
+                self._calculate_payments(order)
+        except FeeSplitError as e:
+            return Response(
+                {'error': f'Cannot split fees: {e}'}, 
+                status=status.HTTP_400_BAD_REQUEST
+            )
         
         AuditLog.objects.create(
             order=order,
@@ -578,7 +680,7 @@ class CollectionOrderViewSet(viewsets.ModelViewSet):
         # Broadcast order update via WebSocket
         broadcast_order_update(order)
         
-        return Response(CollectionOrderSerializer(order).data)
+        return Response(get_order_snapshot(order.pk, order.version))
     
     @action(detail=True, methods=['post'])
     def unlock(self, request, pk=None):
@@ -596,12 +698,16 @@ class CollectionOrderViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_403_FORBIDDEN
             )
         
-        order.status = 'OPEN'
-        order.locked_at = None
-        order.save()
-        
-        # Delete payments when unlocking (they'll be recalculated on next lock)
-        Payment.objects.filter(order=order).delete()
+        with transaction.atomic():
+            order.status = 'OPEN'
+            order.locked_at = None
+            order.save()
+            order.bump_version()
+            
+            # Delete payments when unlocking (they'll be recalculated on next lock)
+            bump_balance_versions(order)
+            self._delete_payments(order)
+            broadcast_balance_update(order)
         
         AuditLog.objects.create(
             order=order,
@@ -613,7 +719,7 @@ class CollectionOrderViewSet(viewsets.ModelViewSet):
         # Broadcast order update via WebSocket
         broadcast_order_update(order)
         
-        return Response(CollectionOrderSerializer(order).data)
+        return Response(get_order_snapshot(order.pk, order.version))
     
     @action(detail=True, methods=['post'])
     def mark_ordered(self, request, pk=None):
@@ -633,6 +739,7 @@ class CollectionOrderViewSet(viewsets.ModelViewSet):
         order.status = 'ORDERED'
         order.ordered_at = timezone.now()
         order.save()
+        order.bump_version()
         
         AuditLog.objects.create(
             order=order,
@@ -644,7 +751,7 @@ class CollectionOrderViewSet(viewsets.ModelViewSet):
         # Broadcast order update via WebSocket
         broadcast_order_update(order)
         
-        return Response(CollectionOrderSerializer(order).data)
+        return Response(get_order_snapshot(order.pk, order.version))
     
     @action(detail=True, methods=['post'])
     def close(self, request, pk=None):
@@ -664,6 +771,7 @@ class CollectionOrderViewSet(viewsets.ModelViewSet):
         order.status = 'CLOSED'
         order.closed_at = timezone.now()
         order.save()
+        order.bump_version()
         
         AuditLog.objects.create(
             order=order,
@@ -675,7 +783,7 @@ class CollectionOrderViewSet(viewsets.ModelViewSet):
         # Broadcast order update via WebSocket
         broadcast_order_update(order)
         
-        return Response(CollectionOrderSerializer(order).data)
+        return Response(get_order_snapshot(order.pk, order.version))
     
     @action(detail=False, methods=['get'])
     def by_code(self, request):
@@ -697,14 +805,53 @@ class CollectionOrderViewSet(viewsets.ModelViewSet):
                         status=status.HTTP_403_FORBIDDEN
                     )
             
-            serializer = self.get_serializer(order, context={'request': request})
-            return Response(serializer.data)
+            return self._conditional_order_response(request, order)
         except CollectionOrder.DoesNotExist:
             return Response(
                 {'error': 'Order not found'}, 
                 status=status.HTTP_404_NOT_FOUND
             )
     
+    @action(detail=True, methods=['get'])
+    def changes(self, request, pk=None):
+        """
+        Changes since an order version: GET /orders/{id}/changes/?since=<version>
+        Returns the order fields plus only the items/payments changed after `since` and the ids
+        of deleted ones. Falls back to a full snapshot when the client is too far behind.
+        """
+        try:
+            since = int(request.query_params.get('since', ''))
+        except ValueError:
+            return Response(
+                {'error': 'since parameter must be an order version number'}, 
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        order = self.get_object()
+        max_gap = getattr(settings, 'ORDER_CHANGES_MAX_GAP', 50)
+        
+        if since < 0 or since > order.version or order.version - since > max_gap:
+            return Response({
+                'since': since,
+                'version': order.version,
+                'snapshot': True,
+                'order': get_order_snapshot(order.pk, order.version),
+            }, headers={'ETag': order.etag})
+        
+        order = CollectionOrder.objects.with_changes_since(since).get(pk=order.pk)
+        deleted = {'item': [], 'payment': []}
+        for kind, object_id in order.tombstones.filter(version__gt=since).values_list('kind', 'object_id'):
+            deleted[kind].append(object_id)
+        
+        return Response({
+            'since': since,
+            'version': order.version,
+            'snapshot': False,
+            'order': CollectionOrderChangesSerializer(order, context={'request': request}).data,
+            'deleted_items': deleted['item'],
+            'deleted_payments': deleted['payment'],
+        }, headers={'ETag': order.etag})
+    
     @action(detail=True, methods=['post'])
     def transfer_collector(self, request, pk=None):
         """Transfer collector role to another participant"""
@@ -749,6 +896,8 @@ class CollectionOrderViewSet(viewsets.ModelViewSet):
         old_collector = order.collector
         order.collector = new_collector
         order.save()
+        order.refresh_share_message()
+        order.bump_version()
         
         AuditLog.objects.create(
             order=order,
@@ -757,58 +906,32 @@ class CollectionOrderViewSet(viewsets.ModelViewSet):
             details={'action': 'collector_transferred', 'old_collector': old_collector.username, 'new_collector': new_collector.username}
         )
         
-        return Response(CollectionOrderSerializer(order, context={'request': request}).data)
+        return Response(get_order_snapshot(order.pk, order.version))
     
     @action(detail=False, methods=['get'])
     def pending_payments(self, request):
         """Get all orders where the user has pending payments (payments user owes)"""
-        payments = Payment.objects.filter(
-            user=request.user,
-            is_paid=False,
-            order__status__in=['LOCKED', 'ORDERED', 'CLOSED']
-        ).select_related('order', 'order__restaurant', 'order__collector')
-        
-        result = []
-        for payment in payments:
-            # Skip collector's payment if they are the collector (should be auto-paid)
-            if payment.user == payment.order.collector:
-                continue
-            result.append({
-                'order_id': payment.order.id,
-                'order_code': payment.order.code,
-                'restaurant_name': payment.order.restaurant.name,
-                'collector_name': payment.order.collector.username,
-                'amount': float(payment.amount),
-                'payment_id': payment.id,
-                'order_status': payment.order.status,
-                'payment_type': 'owed_by_me',  # User owes this payment
-            })
-        
-        return Response(result)
+        return Response(payments_owed_by(request.user))
     
     @action(detail=False, methods=['get'])
     def pending_payments_to_me(self, request):
         """Get all orders where others owe money to the user (when user is collector)"""
-        payments = Payment.objects.filter(
-            order__collector=request.user,
-            is_paid=False,
-            order__status__in=['LOCKED', 'ORDERED', 'CLOSED']
-        ).exclude(user=request.user).select_related('order', 'order__restaurant', 'user')
-        
-        result = []
-        for payment in payments:
-            result.append({
-                'order_id': payment.order.id,
-                'order_code': payment.order.code,
-                'restaurant_name': payment.order.restaurant.name,
-                'payer_name': payment.user.username,
-                'amount': float(payment.amount),
-                'payment_id': payment.id,
-                'order_status': payment.order.status,
-                'payment_type': 'owed_to_me',  # Others owe this to user
-            })
-        
-        return Response(result)
+        return Response(payments_owed_to(request.user))
+    
+    @action(detail=False, methods=['get'])
+    def balance(self, request):
+        """
+        What the user owes and is owed, with the balance version - 304 when If-None-Match
+        already names it. Kept current afterwards by balance_update WebSocket frames.
+        """
+        if_none_match = request.headers.get('If-None-Match')
+        if if_none_match:
+            version = User.objects.values_list('balance_version', flat=True).get(pk=request.user.pk)
+            etag = f'"balance-{request.user.pk}-{version}"'
+            if etag in parse_etags(if_none_match):
+                return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+        snapshot = balance_snapshot(request.user)
+        return Response(snapshot, headers={'ETag': f'"balance-{request.user.pk}-{snapshot["version"]}"'})
     
     @action(detail=False, methods=['get'])
     def monthly_report(self, request):
@@ -937,75 +1060,52 @@ class CollectionOrderViewSet(viewsets.ModelViewSet):
             'total_owed_to_user': float(total_owed_to_user),
         })
     
+    def _delete_payments(self, order):
+        """Delete the order's payments, leaving tombstones for the change feed"""
+        payments = Payment.objects.filter(order=order)
+        OrderTombstone.record(order, 'payment', payments.values_list('id', flat=True))
+        payments.delete()
+    
     def _calculate_payments(self, order):
-        """Calculate payments based on fee split rule"""
-        total_items = order.get_total_items_cost()
-        total_fees = order.delivery_fee + order.tip + order.service_fee
-        participants = order.get_participants()
+        """
+        Freeze the order's current shares into payments (see orders/shares.py): the running
+        participant totals plus fee shares under the order's split rule, written in one bulk
+        insert and stamped with the current order version. Raises FeeSplitError if the
+        custom split doesn't fit the fees.
+        """
+        items_totals = dict(ParticipantTotal.objects.filter(order=order).values_list('user', 'items_total'))
+        amounts = payment_amounts(
+            items_totals, order.delivery_fee + order.tip + order.service_fee,
+            order.fee_split_rule, order.collector_id, order.fee_split_custom
+        )
         
         # Delete existing payments
-        Payment.objects.filter(order=order).delete()
+        self._delete_payments(order)
         
-        if order.fee_split_rule == 'collector_pays':
-            # Collector pays all fees
-            for user in participants:
-                user_items_total = sum(
-                    item.total_price for item in order.items.filter(user=user)
-                )
-                payment = Payment.objects.create(
-                    order=order,
-                    user=user,
-                    amount=user_items_total
-                )
-                # Auto-mark collector's payment as paid
-                if user == order.collector:
-                    payment.is_paid = True
-                    payment.paid_at = timezone.now()
-                    payment.save()
-        elif order.fee_split_rule == 'equal':
-            # Split fees equally among participants
-            fee_per_person = total_fees / len(participants) if participants else 0
-            for user in participants:
-                user_items_total = sum(
-                    item.total_price for item in order.items.filter(user=user)
-                )
-                payment = Payment.objects.create(
-                    order=order,
-                    user=user,
-                    amount=user_items_total + fee_per_person
-                )
-                # Auto-mark collector's payment as paid
-                if user == order.collector:
-                    payment.is_paid = True
-                    payment.paid_at = timezone.now()
-                    payment.save()
-        elif order.fee_split_rule == 'proportional':
-            # Split fees proportionally based on item cost
-            for user in participants:
-                user_items_total = sum(
-                    item.total_price for item in order.items.filter(user=user)
-                )
-                if total_items > 0:
-                    user_fee_share = (user_items_total / total_items) * total_fees
-                else:
-                    user_fee_share = 0
-                payment = Payment.objects.create(
-                    order=order,
-                    user=user,
-                    amount=user_items_total + user_fee_share
-                )
-                # Auto-mark collector's payment as paid
-                if user == order.collector:
-                    payment.is_paid = True
-                    payment.paid_at = timezone.now()
-                    payment.save()
-        # Custom split handled separately via API
+        # Collector's payment is created already paid
+        now = timezone.now()
+        Payment.objects.bulk_create([
+            Payment(
+                order=order,
+                user_id=user_id,
+                amount=amount,
+                is_paid=user_id == order.collector_id,
+                paid_at=now if user_id == order.collector_id else None,
+                changed_version=order.version
+            )
+            for user_id, amount in amounts.items()
+        ])
+        
+        # Payers' and collector's balances changed
+        bump_balance_versions(order)
+        broadcast_balance_update(order)
 
 
 class OrderItemViewSet(viewsets.ModelViewSet):
     queryset = OrderItem.objects.all()
     serializer_class = OrderItemSerializer
     permission_classes = [permissions.IsAuthenticated]
+    pagination_class = CursorOrPageNumberPagination
     
     def get_queryset(self):
         order_id = self.request.query_params.get('order')
@@ -1017,12 +1117,13 @@ class OrderItemViewSet(viewsets.ModelViewSet):
         if user_id:
             queryset = queryset.filter(user_id=user_id)
         
-        # Users can only see their own items unless they're the collector, manager, or admin
+        # Users see items of orders visible to them (same rule as the orders list), but only
+        # change items of orders they collect or have items in
         if self.request.user.role not in ['manager', 'admin']:
-            order_ids = CollectionOrder.objects.filter(
-                Q(collector=self.request.user) | Q(items__user=self.request.user)
-            ).values_list('id', flat=True)
-            queryset = queryset.filter(order_id__in=order_ids)
+            if self.request.method in permissions.SAFE_METHODS:
+                queryset = queryset.filter(order_visibility_q(self.request.user, prefix='order__'))
+            else:
+                queryset = queryset.filter(order_member_q(self.request.user, OrderItem, prefix='order__'))
         
         return queryset
     
@@ -1083,7 +1184,10 @@ class OrderItemViewSet(viewsets.ModelViewSet):
                 suggest_add_to_menu = True
         
         try:
-            item = serializer.save(user=user_to_assign)
+            with transaction.atomic():
+                version = order.bump_version()
+                item = serializer.save(user=user_to_assign, changed_version=version)
+                order.refresh_totals()
         except IntegrityError as e:
             # Handle unique_together constraint violation
             if 'unique' in str(e).lower() or 'duplicate' in str(e).lower():
@@ -1134,6 +1238,14 @@ class OrderItemViewSet(viewsets.ModelViewSet):
         
         order = instance.order
         
+        # An omitted user validates as None (OptionalUserField) - keep the item's owner
+        if 'user' in serializer.validated_data and serializer.validated_data['user'] is None:
+            serializer.validated_data.pop('user')
+        
+        # Items stay in their order - the totals, versions and change feed only follow this one
+        if serializer.validated_data.get('order', order) != order:
+            raise ValidationError("Items cannot be moved to another order")
+        
         # Check if order is open
         if order.status != 'OPEN':
             raise ValidationError("Cannot update items in a locked/closed order")
@@ -1159,7 +1271,8 @@ class OrderItemViewSet(viewsets.ModelViewSet):
         elif serializer.validated_data.get('menu_item'):
             serializer.validated_data['unit_price'] = serializer.validated_data['menu_item'].price
         
-        self.perform_update(serializer)
+        with transaction.atomic():
+            self.perform_update(serializer)
         
         # Refresh instance from database to get updated values
         instance.refresh_from_db()
@@ -1178,7 +1291,10 @@ class OrderItemViewSet(viewsets.ModelViewSet):
         return Response(response_data)
     
     def perform_update(self, serializer):
-        serializer.save()
+        order = serializer.instance.order
+        version = order.bump_version()
+        serializer.save(changed_version=version)
+        order.refresh_totals()
     
     def perform_destroy(self, instance):
         order = instance.order
@@ -1197,7 +1313,11 @@ class OrderItemViewSet(viewsets.ModelViewSet):
             }
         )
         
-        instance.delete()
+        with transaction.atomic():
+            order.bump_version()
+            OrderTombstone.record(order, 'item', [instance.id])
+            instance.delete()
+            order.refresh_totals()
         
         # Broadcast order update via WebSocket
         order.refresh_from_db()
@@ -1243,27 +1363,34 @@ class OrderItemViewSet(viewsets.ModelViewSet):
             name__iexact=item.custom_name
         ).first()
         
-        if existing_item:
-            # Update existing item price
-            existing_item.price = item.custom_price
-            existing_item.save()
-            menu_item = existing_item
-        else:
-            # Create new menu item
-            menu_item = MenuItem.objects.create(
-                menu=menu,
-                name=item.custom_name,
-                price=item.custom_price,
-                description='',
-                is_available=True
-            )
+        with transaction.atomic():
+            if existing_item:
+                # Update existing item price
+                existing_item.price = item.custom_price
+                existing_item.save()
+                menu_item = existing_item
+            else:
+                # Create new menu item
+                menu_item = MenuItem.objects.create(
+                    menu=menu,
+                    name=item.custom_name,
+                    price=item.custom_price,
+                    description='',
+                    is_available=True
+                )
+            
+            # Update the order item to use the menu item
+            item.menu_item = menu_item
+            item.custom_name = ''
+            item.custom_price = None
+            item.unit_price = menu_item.price
+            item.total_price = item.unit_price * item.quantity
+            item.changed_version = order.bump_version()
+            item.save()
+            order.refresh_totals()
         
-        # Update the order item to use the menu item
-        item.menu_item = menu_item
-        item.custom_name = ''
-        item.custom_price = None
-        item.unit_price = menu_item.price
-        item.save()
+        # Broadcast order update via WebSocket
+        broadcast_order_update(order)
         
         AuditLog.objects.create(
             order=order,
@@ -1309,15 +1436,23 @@ class OrderItemViewSet(viewsets.ModelViewSet):
         # Update menu item price
         menu_item = item.menu_item
         old_price = menu_item.price
-        menu_item.price = new_price
-        menu_item.save()
+        order = item.order
+        with transaction.atomic():
+            menu_item.price = new_price
+            menu_item.save()
+            
+            # Update order item unit price
+            item.unit_price = new_price
+            item.total_price = item.unit_price * item.quantity
+            item.changed_version = order.bump_version()
+            item.save()
+            order.refresh_totals()
         
-        # Update order item unit price
-        item.unit_price = new_price
-        item.save()
+        # Broadcast order update via WebSocket
+        broadcast_order_update(order)
         
         AuditLog.objects.create(
-            order=item.order,
+            order=order,
             user=request.user,
             action='fee_updated',
             details={
@@ -1336,6 +1471,7 @@ class PaymentViewSet(viewsets.ModelViewSet):
     queryset = Payment.objects.all()
     serializer_class = PaymentSerializer
     permission_classes = [permissions.IsAuthenticated]
+    pagination_class = CursorOrPageNumberPagination
     
     def get_queryset(self):
         order_id = self.request.query_params.get('order')
@@ -1347,15 +1483,54 @@ class PaymentViewSet(viewsets.ModelViewSet):
         if user_id:
             queryset = queryset.filter(user_id=user_id)
         
-        # Users can only see their own payments or payments for orders they collected
+        # Users see payments of orders visible to them (same rule as the orders list), but only
+        # change payments of orders they collect or pay in
         if self.request.user.role not in ['manager', 'admin']:
-            order_ids = CollectionOrder.objects.filter(
-                Q(collector=self.request.user) | Q(payments__user=self.request.user)
-            ).values_list('id', flat=True)
-            queryset = queryset.filter(order_id__in=order_ids)
+            if self.request.method in permissions.SAFE_METHODS:
+                queryset = queryset.filter(order_visibility_q(self.request.user, prefix='order__'))
+            else:
+                queryset = queryset.filter(order_member_q(self.request.user, Payment, prefix='order__'))
         
         return queryset
     
+    # Payments are part of the order snapshot and of balances - every write moves their order
+    # to a new version and bumps the balance_version of the users they touch
+    def perform_create(self, serializer):
+        order = serializer.validated_data['order']
+        with transaction.atomic():
+            serializer.save(changed_version=order.bump_version())
+            bump_balance_versions(order)
+        broadcast_order_update(order)
+        broadcast_balance_update(order)
+    
+    def perform_update(self, serializer):
+        old_order = serializer.instance.order
+        order = serializer.validated_data.get('order', old_order)
+        with transaction.atomic():
+            # A new payer (or order) drops the old one from the payments - note them first
+            user_ids = balance_user_ids(old_order)
+            payment = serializer.save(changed_version=order.bump_version())
+            if order.pk != old_order.pk:
+                old_order.bump_version()
+                OrderTombstone.record(old_order, 'payment', [payment.id])
+            bump_balance_versions(order, user_ids)
+        broadcast_order_update(order)
+        broadcast_balance_update(order, user_ids)
+        if order.pk != old_order.pk:
+            broadcast_order_update(old_order)
+            broadcast_balance_update(old_order, user_ids)
+    
+    def perform_destroy(self, instance):
+        order = instance.order
+        with transaction.atomic():
+            user_ids = balance_user_ids(order)
+            bump_balance_versions(order)
+            order.bump_version()
+            OrderTombstone.record(order, 'payment', [instance.id])
+            instance.delete()
+        broadcast_order_update(order)
+        broadcast_balance_update(order, user_ids)
+    
     @action(detail=True, methods=['post'])
     def mark_paid(self, request, pk=None):
         payment = self.get_object()
@@ -1369,10 +1544,14 @@ class PaymentViewSet(viewsets.ModelViewSet):
         
         payment.is_paid = True
         payment.paid_at = timezone.now()
-        payment.save()
+        with transaction.atomic():
+            payment.changed_version = payment.order.bump_version()
+            payment.save()
+            bump_balance_versions(payment.order)
         
         # Broadcast order update via WebSocket
         broadcast_order_update(payment.order)
+        broadcast_balance_update(payment.order)
         
         return Response(PaymentSerializer(payment).data)
 
@@ -1381,6 +1560,7 @@ class AuditLogViewSet(viewsets.ReadOnlyModelViewSet):
     queryset = AuditLog.objects.all()
     serializer_class = AuditLogSerializer
     permission_classes = [permissions.IsAuthenticated]
+    pagination_class = CursorOrPageNumberPagination
     
     def get_queryset(self):
         order_id = self.request.query_params.get('order')
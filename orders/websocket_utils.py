@@ -1,88 +1,163 @@
 """
 Utility functions for broadcasting order updates via WebSocket
+
+The public broadcast_* functions only enqueue the broadcast on the on-commit outbox;
+the send_* functions publish the snapshot and group_send a claim check on the outbox worker.
 """
+import json
+import logging
+from functools import partial
 from channels.layers import get_channel_layer
 from asgiref.sync import async_to_sync
-from django.db.models import Prefetch
-from .serializers import CollectionOrderSerializer
-from .models import OrderItem, Payment
+from django.conf import settings
+from .outbox import enqueue_broadcast
+from .balances import balance_deltas
+from .deltas import order_events
+from .frames import delta_frame, store_delta_frame
+from .models import OrderEventLog, User
+from .snapshots import SnapshotLRU, get_order_snapshot
+
+logger = logging.getLogger(__name__)
+
+# Last snapshot broadcast per order by this process - the base for protocol 2 deltas
+broadcast_history = SnapshotLRU(getattr(settings, 'ORDER_SNAPSHOT_LRU_SIZE', 256))
+
+# New-order notification groups: public orders go to everyone, private orders only to
+# managers/admins and to the collector's and assignees' own groups
+PUBLIC_ORDERS_GROUP = 'orders_public'
+STAFF_ORDERS_GROUP = 'orders_staff'
+STAFF_ROLES = ['manager', 'admin']
+
+
+def user_group(user_id):
+    return f'user_{user_id}'
+
+
+def notification_groups(user):
+    """Groups a user's notification socket joins"""
+    groups = [user_group(user.pk), PUBLIC_ORDERS_GROUP]
+    if user.role in STAFF_ROLES:
+        groups.append(STAFF_ORDERS_GROUP)
+    return groups
+
+
+def new_order_groups(order_data):
+    """Groups whose members can see a new order - each member is in exactly one of them"""
+    if not order_data['is_private']:
+        return [PUBLIC_ORDERS_GROUP]
+    # Staff see every private order through the staff group - skip their own groups
+    members = User.objects.filter(
+        id__in={order_data['collector'], *order_data['assigned_users']}
+    ).exclude(role__in=STAFF_ROLES).values_list('id', flat=True)
+    return [STAFF_ORDERS_GROUP] + [user_group(user_id) for user_id in members]
 
 
 def broadcast_order_update(order):
     """
     Broadcast order update to all connected WebSocket clients for this order
-    Refreshes the order from database with all related data before serializing
+    Sent once the current transaction commits - nothing is sent if it rolls back
+    """
+    enqueue_broadcast(send_order_update, order.id)
+
+
+def broadcast_new_order(order):
+    """
+    Notify the users who can see a new order (see new_order_groups)
+    This allows users to be notified when a new order is created, regardless of which device created it
+    """
+    enqueue_broadcast(send_new_order, order.id)
+
+
+def broadcast_balance_update(order, user_ids=()):
+    """
+    Push the balance changes of an order's payments to the personal group of every
+    user they touch (see orders/balances.py), once the current transaction commits.
+    `user_ids` are also sent theirs - users the change removed from the order's payments,
+    or everyone the order touched when it is being deleted (see balance_user_ids).
+    """
+    handler = partial(send_balance_update, user_ids=tuple(user_ids)) if user_ids else send_balance_update
+    enqueue_broadcast(handler, order.id)
+
+
+def send_order_update(order_id):
+    """
+    Send a claim check for the order's current version to its room group
+    The message carries only {order_id, version}; consumers resolve the frames from the shared
+    snapshot cache (see orders/frames.py). When this process broadcast an earlier version,
+    the protocol 2 order_delta frame since then is published alongside the snapshot and
+    its events are appended to the order's event log.
     """
     channel_layer = get_channel_layer()
     if not channel_layer:
         return  # Channels not configured
-    
-    # Refresh order from database with all related data to ensure latest items/payments are included
-    from .models import CollectionOrder
-    refreshed_order = CollectionOrder.objects.prefetch_related(
-        Prefetch('items', queryset=OrderItem.objects.select_related('user', 'menu_item').order_by('-created_at')),
-        Prefetch('payments', queryset=Payment.objects.select_related('user').order_by('-created_at')),
-        'assigned_users'
-    ).select_related('restaurant', 'menu', 'collector').get(id=order.id)
-    
-    # Serialize order data with request context (if available)
-    # Note: We can't pass request context here, but serializer should work without it for most fields
-    serializer = CollectionOrderSerializer(refreshed_order)
-    order_data = serializer.data
-    
+
+    # Makes sure the current version's snapshot is in the shared cache
+    order_data = get_order_snapshot(order_id)
+    if order_data is None:
+        return  # Order was deleted
+    version = order_data['version']
+
+    previous = broadcast_history.latest(order_id)
+    if previous is not None and previous[0] < version:
+        events = order_events(previous[1], order_data)
+        store_delta_frame(order_id, version, previous[0], delta_frame(previous[0], version, events))
+        # Kept for clients reconnecting with ?after_seq=
+        OrderEventLog.record(order_id, previous[0], version, events)
+    broadcast_history.set(order_id, version, order_data)
+
     # Broadcast to the order's room group
-    room_group_name = f'order_{order.id}'
-    
+    room_group_name = f'order_{order_id}'
+
     async_to_sync(channel_layer.group_send)(
         room_group_name,
         {
             'type': 'order_update',
-            'order': order_data
+            'order_id': order_id,
+            'version': version
         }
     )
 
 
-def broadcast_new_order(order):
-    """
-    Broadcast new order creation to all connected WebSocket clients via the general notifications channel
-    This allows all users to be notified when a new order is created, regardless of which device created it
-    """
-    import logging
-    logger = logging.getLogger(__name__)
-    
+def send_new_order(order_id):
+    """Send a new order's claim check to the users who can see it and to its own room group"""
     channel_layer = get_channel_layer()
     if not channel_layer:
         logger.warning("Channel layer not configured, cannot broadcast new order")
         return  # Channels not configured
-    
-    try:
-        # Refresh order from database with all related data
-        from .models import CollectionOrder
-        refreshed_order = CollectionOrder.objects.prefetch_related(
-            Prefetch('items', queryset=OrderItem.objects.select_related('user', 'menu_item').order_by('-created_at')),
-            Prefetch('payments', queryset=Payment.objects.select_related('user').order_by('-created_at')),
-            'assigned_users'
-        ).select_related('restaurant', 'menu', 'collector').get(id=order.id)
-        
-        # Serialize order data
-        serializer = CollectionOrderSerializer(refreshed_order)
-        order_data = serializer.data
-        
-        logger.info(f"Broadcasting new order {order.code} (ID: {order.id}) to notifications channel")
-        
-        # Broadcast to the general notifications group
+
+    order_data = get_order_snapshot(order_id)
+    if order_data is None:
+        return  # Order was deleted
+
+    groups = new_order_groups(order_data)
+    logger.info(f"Broadcasting new order {order_data['code']} (ID: {order_id}) to {len(groups)} notification group(s)")
+
+    for group in groups:
         async_to_sync(channel_layer.group_send)(
-            'notifications',
+            group,
             {
                 'type': 'new_order',
-                'order': order_data
+                'order_id': order_id,
+                'version': order_data['version']
             }
         )
-        
-        logger.info(f"Successfully broadcast new order {order.code} to notifications channel")
-        
-        # Also broadcast to the specific order's room group
-        broadcast_order_update(order)
-    except Exception as e:
-        logger.error(f"Error broadcasting new order {order.id}: {e}", exc_info=True)
 
+    # Also broadcast to the specific order's room group
+    send_order_update(order_id)
+
+
+def send_balance_update(order_id, user_ids=()):
+    """Send each user the order's balance rows and their new totals as a balance_update frame"""
+    channel_layer = get_channel_layer()
+    if not channel_layer:
+        return  # Channels not configured
+
+    for user_id, delta in balance_deltas(order_id, user_ids).items():
+        async_to_sync(channel_layer.group_send)(
+            user_group(user_id),
+            {
+                'type': 'balance_update',
+                'order_id': order_id,
+                'frame': json.dumps({'type': 'balance_update', **delta})
+            }
+        )